@@ -26,6 +26,7 @@ import wiki
 import model
 import util
 import stats
+import search
 import workflow
 import rpcsupport
 import admin
@@ -28,13 +28,18 @@ from operator import itemgetter
 from trac.core import *
 from trac.db import *
 from trac.web.chrome import add_notice, add_warning, add_stylesheet
+from trac.admin.api import IAdminCommandProvider
 from trac.admin.web_ui import IAdminPanelProvider
 from trac.wiki.formatter import format_to_html
 from trac.mimeview.api import Context
+from trac.util.text import printout
 
 from tracgenericclass.model import GenericClassModelProvider
 
 from testmanager.api import *
+from testmanager.model import TestManagerModelProvider
+from testmanager.stats import DailyStatsRollup, TestStatsPlugin
+from testmanager.search import TestSearchIndex
 from tracgenericclass.util import *
 from testmanager.util import *
 
@@ -285,6 +290,61 @@ class TestManagerAdmin(Component):
         add_stylesheet(req, 'testmanager/css/admin.css')
         return 'admin_templates.html', data
 
+
+class TestManagerAdminCommands(Component):
+    """
+    Provide trac-admin commands to maintain the Test Manager
+    derived data.
+    """
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('testmanager index rebuild', '',
+               'Rebuild the test pages index from the wiki pages',
+               None, self._do_index_rebuild)
+        yield ('testmanager stats rebuild', '',
+               'Rebuild the daily test statistics from the test case history and the tickets',
+               None, self._do_stats_rebuild)
+        yield ('testmanager stats check', '[days]',
+               'Check that the daily test statistics give the same ticket chart as the tickets, over the last days (default 30)',
+               None, self._do_stats_check)
+        yield ('testmanager search rebuild', '',
+               'Rebuild the full text search index of the test objects',
+               None, self._do_search_rebuild)
+        yield ('testmanager tickets rebuild', '',
+               'Rebuild the index of the tickets related to test cases and test plans',
+               None, self._do_tickets_rebuild)
+
+    def _do_index_rebuild(self):
+        count = TestManagerModelProvider(self.env).rebuild_test_page_index()
+        printout(_("Test pages index rebuilt: %(count)s pages indexed.", count=count))
+
+    def _do_stats_rebuild(self):
+        count = DailyStatsRollup(self.env).rebuild()
+        printout(_("Daily test statistics rebuilt: %(count)s daily rows written.", count=count))
+
+    def _do_stats_check(self, days='30'):
+        differences = TestStatsPlugin(self.env).check_daily_rollup(int(days))
+        
+        for planid, cur_date, metric, expected, actual in differences:
+            printout(_("Plan '%(planid)s', %(date)s, %(metric)s: %(expected)s from the tickets, %(actual)s from the daily statistics", 
+                planid=planid, date=cur_date.date().isoformat(), metric=metric, expected=expected, actual=actual))
+
+        if len(differences) == 0:
+            printout(_("The daily test statistics match the tickets."))
+        else:
+            printout(_("Run 'testmanager stats rebuild' to rebuild the daily test statistics."))
+
+    def _do_search_rebuild(self):
+        count = TestSearchIndex(self.env).rebuild()
+        printout(_("Test search index rebuilt: %(count)s objects indexed.", count=count))
+
+    def _do_tickets_rebuild(self):
+        count = TestManagerModelProvider(self.env).rebuild_test_ticket_index()
+        printout(_("Related tickets index rebuilt: %(count)s tickets indexed.", count=count))
+
         
 def get_all_table_columns_for_object(env, objtype, settings):
     genericClassModelProvider = GenericClassModelProvider(env)
@@ -334,6 +394,7 @@ def get_all_table_columns_for_object(env, objtype, settings):
         result.append({'name': 'status', 'label': _("Status"), 'visible': _is_column_visible(objtype, 'status', settings), 'totals': _get_column_total_operation(objtype, 'status', settings)})
         result.append({'name': 'author', 'label': _("Author"), 'visible': _is_column_visible(objtype, 'author', settings), 'totals': _get_column_total_operation(objtype, 'author', settings)})
         result.append({'name': 'time', 'label': _("Last Change"), 'visible': _is_column_visible(objtype, 'time', settings), 'totals': _get_column_total_operation(objtype, 'time', settings)})
+        result.append({'name': 'tickets', 'label': _("Tickets"), 'visible': _is_column_visible(objtype, 'tickets', settings), 'totals': _get_column_total_operation(objtype, 'tickets', settings)})
 
         # Custom testcaseinplan columns
         if tcip_has_custom:
@@ -352,10 +413,16 @@ def get_all_table_columns_for_object(env, objtype, settings):
 def _get_column_settings(objtype, field, settings):
     return {'name': field['name'], 'label': field['label'], 'visible': _is_column_visible(objtype, field['name'], settings), 'totals': _get_column_total_operation(objtype, field['name'], settings)}
 
+# Columns not shown unless enabled in the settings
+_hidden_by_default_columns = {'testplan': ('tickets',)}
+
 def _is_column_visible(objtype, column_name, settings):
     visible = settings.get('testmanager', objtype + '.visible_'+column_name)
     
-    if visible is None or visible == '' or visible == 'True':
+    if visible is None or visible == '':
+        return ('True', 'False')[column_name in _hidden_by_default_columns.get(objtype, ())]
+        
+    if visible == 'True':
         return 'True'
     
     return 'False'
@@ -366,7 +433,10 @@ def _set_columns_visible(env, objtype, args, settings):
     for column in columns:
         col_name = objtype + '.' + column['name']
         if args.get(col_name, '') == 'on':
-            settings.remove('testmanager', objtype + '.visible_'+column['name'])
+            if column['name'] in _hidden_by_default_columns.get(objtype, ()):
+                settings.set('testmanager', objtype + '.visible_'+column['name'], 'True')
+            else:
+                settings.remove('testmanager', objtype + '.visible_'+column['name'])
         else:
             settings.set('testmanager', objtype + '.visible_'+column['name'], 'False')
 
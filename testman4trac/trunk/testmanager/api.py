@@ -21,6 +21,7 @@
 #
 
 import csv
+import hashlib
 import json
 import os
 import pkg_resources
@@ -29,15 +30,17 @@ import shutil
 import sys
 import time
 import traceback
+import uuid
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 from StringIO import StringIO
 
 from trac.core import *
 from trac.mimeview.api import Context
 from trac.perm import IPermissionRequestor, PermissionError
-from trac.resource import Resource, IResourceManager, render_resource_link, get_resource_url
+from trac.resource import Resource, ResourceNotFound, IResourceManager, render_resource_link, get_resource_url
 from trac.util import get_reporter_id, format_datetime, format_date
 from trac.util.datefmt import utc
 from trac.web.api import IRequestHandler
@@ -46,10 +49,11 @@ from trac.wiki.formatter import Formatter, format_to_html
 from trac.wiki.model import WikiPage
 from trac.wiki.parser import WikiParser
 
-from tracgenericclass.model import GenericClassModelProvider
+from tracgenericclass.api import GenericClassSystem, IGenericObjectBatchChangeListener
+from tracgenericclass.model import GenericClassModelProvider, UnitOfWork
 from tracgenericclass.util import *
 
-from testmanager.model import TestCatalog, TestCase, TestCaseInPlan, TestPlan
+from testmanager.model import TestCatalog, TestCase, TestCaseInPlan, TestPlan, TestManagerModelProvider, BulkLoader, PrefetchedValues
 from testmanager.util import *
 
 try:
@@ -64,7 +68,7 @@ except ImportError:
 class TestManagerSystem(Component):
     """Test Manager system for Trac."""
 
-    implements(IPermissionRequestor, IRequestHandler, IResourceManager)
+    implements(IPermissionRequestor, IRequestHandler, IResourceManager, IGenericObjectBatchChangeListener)
 
     NEXT_PROPERTY_NAME = {
         'catalog':  'NEXT_CATALOG_ID',
@@ -78,6 +82,11 @@ class TestManagerSystem(Component):
     TEMPLATE_TYPE_TESTCATALOG = 'TCAT'
     DOUBLE_QUOTES = re.compile("\"")
 
+    # Prefix of the 'testconfig' properties holding the generation stamps
+    # of the cached catalog data models
+    DATA_MODEL_GENERATION = 'DATA_MODEL_GENERATION'
+    TEST_REALMS = ('testcatalog', 'testcase', 'testcaseinplan', 'testplan')
+
     outcomes_by_color = {}
     outcomes_by_name = {}
     default_outcome = None
@@ -106,6 +115,15 @@ class TestManagerSystem(Component):
         """
         Component.__init__(self, *args, **kwargs)
 
+        # Cache of the catalog data models built by 
+        # get_test_catalog_data_model()
+        self._data_model_cache = LRUCache(self.config.getint('testmanager', 'datamodel.cache_size', 100))
+
+        # Cache of the rendered test catalog and test case descriptions,
+        # optionally persisted under the environment directory
+        self._description_cache = LRUCache(self.config.getint('testmanager', 'description_cache.size', 1000))
+        self.description_cache_persistent = self.config.get('testmanager', 'description_cache.persistent', '') == 'True'
+
         import pkg_resources
         # bind the 'testmanager' catalog to the specified locale directory
         locale_dir = pkg_resources.resource_filename(__name__, 'locale')
@@ -156,6 +174,24 @@ class TestManagerSystem(Component):
 
         return latest_id
     
+    def get_next_ids(self, type_, count, base_number='0'):
+        """
+        Reserves the specified number of consecutive IDs for the desired
+        object type at once, returning them as a list.
+        """
+        if type_ not in self.NEXT_PROPERTY_NAME:
+            return [-1] * count
+            
+        propname = self.NEXT_PROPERTY_NAME[type_]
+        
+        latest_id = self.get_config_property(propname)
+        if not latest_id:
+            latest_id = base_number
+
+        self.set_config_property(propname, str(int(latest_id)+count))
+
+        return [str(int(latest_id)+i) for i in range(count)]
+    
     def set_next_id(self, type_, value):
         propname = self.NEXT_PROPERTY_NAME[type_]
         self.set_config_property(type_, value)
@@ -206,6 +242,63 @@ class TestManagerSystem(Component):
         
         return self.default_outcome
     
+    def set_testcase_statuses(self, statuses, author, remote_addr=None):
+        """
+        Sets the status of many test cases in test plans, in a single
+        transaction.
+        
+        The test cases in plan are written through a unit of work and 
+        the history rows all at once, so that the data models containing
+        the test cases are invalidated once for the whole batch.
+
+        :statuses: a list of (test case ID, test plan ID, test case page
+                   name, status).
+        """
+        tcips = BulkLoader(self.env).load_test_cases_in_plan([(s[0], s[1]) for s in statuses])
+
+        uow = UnitOfWork(self.env)
+        when = datetime.now(utc)
+        
+        history_rows = []
+        status_changes = []
+        
+        for i, (tc_id, planid, page_name, status) in enumerate(statuses):
+            status = status.lower()
+
+            # Distinct timestamps keep the history in order, also for a 
+            # test case set more than once in the batch
+            ts = when + timedelta(microseconds=i)
+            
+            tcip = tcips.get((tc_id, planid))
+            if tcip is None:
+                tcip = TestCaseInPlan(self.env)
+                tcip.set_loaded_values({'id': tc_id, 'planid': planid, 'page_name': page_name}, exists=False)
+                tcips[(tc_id, planid)] = tcip
+                uow.register_new(tcip)
+            elif tcip.exists:
+                uow.register_dirty(tcip)
+
+            status_changes.append((planid, tcip['status'], status, ts))
+            history_rows.append((tc_id, planid, to_any_timestamp(ts), author, status))
+            
+            tcip['status'] = status
+            tcip.author = author
+            tcip.remote_addr = remote_addr
+
+        gclass_system = GenericClassSystem(self.env)
+
+        @gclass_system.with_deferred_listeners()
+        def do_set_statuses(db):
+            from testmanager.stats import DailyStatsRollup
+            DailyStatsRollup(self.env).statuses_changed(status_changes, db)
+            
+            cursor = db.cursor()
+            cursor.executemany('INSERT INTO testcasehistory (id, planid, time, author, status) VALUES (%s, %s, %s, %s, %s)', 
+                history_rows)
+
+            # The change listeners also invalidate the data models once
+            uow.flush(author, "Status changed", when, db)
+
     def get_tc_statuses_by_name(self):
         """
         Returns the available test case in plan statuses, along with
@@ -279,6 +372,24 @@ class TestManagerSystem(Component):
     def get_permission_actions(self):
         return ['TEST_VIEW', 'TEST_MODIFY', 'TEST_EXECUTE', 'TEST_DELETE', 'TEST_PLAN_ADMIN']
 
+
+    # IGenericObjectBatchChangeListener methods
+    def objects_changed(self, changes):
+        # Invalidate each affected top-level catalog only once per batch
+        scopes = {}
+        for change in changes:
+            if change.realm in self.TEST_REALMS:
+                page_names = [change.g_object['page_name']]
+                if change.action == 'changed' and 'page_name' in change.old_values:
+                    # The object has been moved into a different catalog
+                    page_names.append(change.old_values['page_name'])
+                    
+                for page_name in page_names:
+                    scopes[self._get_data_model_scope(page_name)] = page_name
+                
+        for page_name in scopes.itervalues():
+            self.invalidate_test_catalog_data_models(page_name)
+
         
     # IRequestHandler methods
 
@@ -806,6 +917,28 @@ class TestManagerSystem(Component):
                     
                     return 'testimportresults.html', testcaseimport_info, None
                     
+        elif req.path_info.startswith('/testexport') and req.args.get('format') == 'jsonl':
+            planid = req.args.get('planid')
+            
+            tp = TestPlan(self.env, planid)
+            if not tp.exists:
+                raise ResourceNotFound(_("Test plan %(planid)s not found.", planid=planid))
+
+            fields = None
+            if req.args.get('fields'):
+                fields = [f.strip() for f in req.args.get('fields').split(',')]
+
+            lines = self.generate_plan_jsonl(tp, fields)
+
+            req.send_header("Content-Type", "application/x-ndjson")
+            req.send_header("Content-Disposition", "attachment;filename=Test_plan_%s.jsonl" % planid)
+            for line in lines:
+                if isinstance(line, unicode): 
+                    line = line.encode('utf-8') 
+
+                req.write(line)
+            return
+
         elif req.path_info.startswith('/testexport'):
             object_type = req.args.get('type')
             cat_name = req.args.get('cat_name')
@@ -1272,6 +1405,407 @@ class TestManagerSystem(Component):
         return sorted(items, key=itemgetter('title'))
 
     def get_test_catalog_data_model(self, pagename, include_status=False, planid=None, sortby='custom'):
+        """
+        Returns the tree of the catalogs and test cases under the 
+        specified catalog page, optionally with their status in the
+        specified test plan.
+        
+        Models are cached, and validated against the generation stamps
+        kept in the 'testconfig' table, so that all the Trac processes 
+        see the changes made by any of them.
+        The returned model is shared, and must not be modified.
+        """
+        key = (pagename, include_status, planid, sortby)
+
+        # Read the generation before building the model, so that any
+        # change occurring meanwhile makes the new cache entry stale
+        generation = self.get_data_model_generation(pagename)
+        if generation is None:
+            return self._build_test_catalog_data_model(pagename, include_status, planid, sortby)
+
+        cached = self._data_model_cache.get(key)
+        if cached is not None:
+            cached_generation, components = cached
+            if cached_generation == generation:
+                return components
+
+        components = self._build_test_catalog_data_model(pagename, include_status, planid, sortby)
+
+        self._data_model_cache.set(key, (generation, components))
+
+        return components
+
+    def invalidate_test_catalog_data_models(self, page_name=None, db=None):
+        """
+        Invalidates the cached data models containing the specified
+        test catalog or test case page, by changing the generation 
+        stamp of its top-level catalog.
+        If no page is specified, all the cached data models are 
+        invalidated.
+        """
+        propname = self.DATA_MODEL_GENERATION
+        scope = self._get_data_model_scope(page_name)
+        if scope is not None:
+            propname += ':' + scope
+        
+        # A unique value rather than an incremented counter, so that 
+        # concurrent invalidations cannot end up writing the same value
+        db_set_config_property(self.env, 'testconfig', propname, uuid.uuid4().hex, db)
+
+    def render_description(self, context, page_name, version, text=None, mode='html', changetime=None):
+        """
+        Returns the HTML rendering of the description of the specified
+        version of a test catalog or test case page.
+        
+        The renderings are cached by (page name, version, time of the 
+        version, mode) and by rendering context, so the wiki text is 
+        only parsed the first time for each base URL and user. The time
+        tells apart a version deleted and saved again, in all the 
+        processes. If the wiki text or the time are not provided, they
+        are read from the wiki page only when needed.
+        """
+        key = self._get_description_key(context, page_name, version, mode, changetime)
+        
+        description = self._description_cache.get(key)
+        if description is not None:
+            return description
+
+        description = self._read_cached_description(key)
+        
+        if description is None:
+            if text is None:
+                text = get_page_description(WikiPage(self.env, page_name, version).text)
+
+            # Relative links are resolved against the page itself, so
+            # that the rendering does not depend on where it is shown
+            page_context = context.child(Resource('wiki', page_name, version))
+
+            wikidom = WikiParser(self.env).parse(text)
+            out = StringIO()
+            f = Formatter(self.env, page_context)
+            f.reset(wikidom)
+            f.format(wikidom, out, False)
+            description = out.getvalue()
+            
+            self._write_cached_description(key, description)
+
+        self._description_cache.set(key, description)
+            
+        return description
+
+    def is_description_cached(self, context, page_name, version, changetime, mode='html'):
+        return self._get_description_key(context, page_name, version, mode, changetime) in self._description_cache
+        
+    def invalidate_rendered_descriptions(self, page_name):
+        """
+        Discards the cached renderings of all the versions of the 
+        specified page description.
+        """
+        self._description_cache.remove_matching(lambda key: key[0] == page_name)
+        
+        if self.description_cache_persistent:
+            path = self._get_description_cache_dir(page_name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+            except:
+                self.env.log.error("Error removing the cached descriptions for page %s" % page_name)
+                self.env.log.error(formatExceptionInfo())
+
+    def _get_description_key(self, context, page_name, version, mode, changetime):
+        if changetime is None:
+            sql = "SELECT version, time FROM wiki WHERE name = %s"
+            args = [page_name]
+            if version is not None:
+                sql += " AND version = %s"
+                args.append(version)
+                
+            cursor = self.env.get_read_db().cursor()
+            cursor.execute(sql + " ORDER BY version DESC", args)
+            row = cursor.fetchone()
+            if row is not None:
+                version, changetime = row
+
+        return (page_name, version, changetime, mode, self._get_description_context_key(context))
+
+    def _get_description_context_key(self, context):
+        """
+        Returns what the rendering of a description depends on, besides
+        the page text: the base URL the links are built against and the 
+        user whose permissions decide what links and macros show.
+        """
+        base = context.href is not None and context.href.base or ''
+        username = context.perm is not None and context.perm.username or 'anonymous'
+        
+        return (base, username)
+
+    def _get_description_cache_dir(self, page_name):
+        return os.path.join(self.env.path, 'cache', 'testmanager', 'descriptions', 
+            hashlib.md5(page_name.encode('utf-8')).hexdigest())
+
+    def _get_description_cache_file(self, key):
+        page_name, version, changetime, mode, context_key = key
+        context_hash = hashlib.md5(repr(context_key).encode('utf-8')).hexdigest()
+        return os.path.join(self._get_description_cache_dir(page_name), '%s_%s_%s_%s.html' % (version, changetime, mode, context_hash))
+        
+    def _read_cached_description(self, key):
+        if not self.description_cache_persistent:
+            return None
+            
+        path = self._get_description_cache_file(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            f = open(path, 'rb')
+            try:
+                return f.read().decode('utf-8')
+            finally:
+                f.close()
+        except:
+            self.env.log.error("Error reading the cached description %s" % path)
+            self.env.log.error(formatExceptionInfo())
+
+        return None
+        
+    def _write_cached_description(self, key, description):
+        if not self.description_cache_persistent:
+            return
+            
+        path = self._get_description_cache_file(key)
+        
+        try:
+            dir_path = os.path.dirname(path)
+            if not os.path.isdir(dir_path):
+                os.makedirs(dir_path)
+
+            # Write to a temporary file first, so that concurrent readers
+            # never see a partially written file
+            tmp_path = '%s.%s' % (path, uuid.uuid4().hex)
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(description.encode('utf-8'))
+            finally:
+                f.close()
+            
+            os.rename(tmp_path, path)
+        except:
+            self.env.log.error("Error writing the cached description %s" % path)
+            self.env.log.error(formatExceptionInfo())
+
+    def _get_data_model_scope(self, page_name):
+        """
+        Returns the top-level catalog page containing the specified page,
+        or None if the page is the root catalog or is unknown.
+        """
+        if page_name is None or not page_name.startswith('TC_'):
+            return None
+
+        return '_'.join(page_name.split('_')[:2])
+        
+    def get_data_model_generation(self, pagename):
+        """
+        Returns the generation stamps the data model for the specified 
+        catalog page depends on.
+        """
+        generations = {}
+        
+        try:
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("SELECT propname, value FROM testconfig WHERE propname LIKE %s", 
+                (self.DATA_MODEL_GENERATION+'%',))
+                
+            for propname, value in cursor:
+                generations[propname] = value
+        except:
+            self.env.log.error("Error reading the data model generations")
+            self.env.log.error(formatExceptionInfo())
+            
+            return None
+
+        scope = self._get_data_model_scope(pagename)
+        if scope is None:
+            # The root catalog depends on all the top-level catalogs
+            return tuple(sorted(generations.items()))
+            
+        return (generations.get(self.DATA_MODEL_GENERATION), 
+            generations.get(self.DATA_MODEL_GENERATION + ':' + scope))
+
+    def get_test_catalog_last_change(self, pagename, planid=None):
+        """
+        Returns the time of the latest change to the pages in the 
+        specified catalog subtree and, if a test plan is specified, to 
+        the status of its test cases, or None if unknown.
+        """
+        times = []
+        
+        try:
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            
+            cursor.execute("SELECT MAX(time) FROM testpageindex WHERE name = %s OR name LIKE %s ESCAPE '|'", 
+                (pagename, db_escape_like(pagename+'_') + '%'))
+            times.append(cursor.fetchone()[0])
+
+            if planid is not None:
+                cursor.execute("SELECT MAX(time) FROM testcasehistory WHERE planid = %s", (planid,))
+                times.append(cursor.fetchone()[0])
+        except:
+            self.env.log.error("Error reading the last change time of catalog %s" % pagename)
+            self.env.log.error(formatExceptionInfo())
+            
+            return None
+
+        times = [t for t in times if t is not None]
+        if len(times) == 0:
+            return None
+
+        return from_any_timestamp(max(times))
+
+    # Sources of the change feed, as (realm, key names, columns, tables,
+    # time column, tiebreaker columns). The columns are the key values
+    # followed by time, author, field, old value and new value. The 
+    # tiebreaker columns order the changes with the same time and 
+    # identify each of them within its source.
+    CHANGE_FEED_SOURCES = [
+        ('testcatalog', ('id',), "id, time, author, field, oldvalue, newvalue",
+            "testcatalog_change WHERE 1=1", 'time', ('id', 'field')),
+        ('testcase', ('id',), "id, time, author, field, oldvalue, newvalue",
+            "testcase_change WHERE 1=1", 'time', ('id', 'field')),
+        ('testcaseinplan', ('id', 'planid'), "id, planid, time, author, field, oldvalue, newvalue",
+            "testcaseinplan_change WHERE 1=1", 'time', ('id', 'planid', 'field')),
+        ('testplan', ('id',), "id, time, author, field, oldvalue, newvalue",
+            "testplan_change WHERE 1=1", 'time', ('id', 'field')),
+        ('testplan', ('id',), "id, time, author, 'created', NULL, name",
+            "testplan WHERE 1=1", 'time', ('id',)),
+        ('testcaseinplan', ('id', 'planid'), "id, planid, time, author, 'status', NULL, status",
+            "testcasehistory WHERE 1=1", 'time', ('id', 'planid')),
+        ('testcatalog', ('id',), "o.id, w.time, w.author, 'page_version', NULL, w.version",
+            "wiki w INNER JOIN testcatalog o ON o.page_name = w.name WHERE 1=1", 'w.time', ('o.id', 'w.version')),
+        ('testcase', ('id',), "o.id, w.time, w.author, 'page_version', NULL, w.version",
+            "wiki w INNER JOIN testcase o ON o.page_name = w.name WHERE 1=1", 'w.time', ('o.id', 'w.version')),
+        ('testcatalog', ('id',), "id, time, '', 'deleted', NULL, NULL",
+            "testdeletion WHERE realm = 'testcatalog'", 'time', ('id',)),
+        ('testcase', ('id',), "id, time, '', 'deleted', NULL, NULL",
+            "testdeletion WHERE realm = 'testcase'", 'time', ('id',)),
+        ('testcaseinplan', ('id', 'planid'), "id, planid, time, '', 'deleted', NULL, NULL",
+            "testdeletion WHERE realm = 'testcaseinplan'", 'time', ('id', 'planid')),
+        ('testplan', ('id',), "id, time, '', 'deleted', NULL, NULL",
+            "testdeletion WHERE realm = 'testplan'", 'time', ('id',))
+        ]
+
+    def list_changes(self, cursor=None, realms=None, limit=500):
+        """
+        Returns the changes to the test objects made after the specified
+        cursor, ordered by time, as a tuple (changes, next cursor).
+        
+        Each change is a dictionary with the 'realm' and 'key' of the 
+        object, and the 'time', 'author', 'field', 'oldvalue' and 
+        'newvalue' of the change.
+        Besides the field changes, the feed reports test plan creations
+        ('created' field), test case status changes ('status' field), 
+        new versions of the catalog and test case wiki pages 
+        ('page_version' field) and deleted objects ('deleted' field).
+        The deletion of a test case or of a test plan is also reported
+        for each of its test cases in plan.
+        
+        The cursor is an opaque string, made of the time, source and 
+        tiebreaker values of the last change returned, so that each 
+        page starts right after it. Pass None to start from the 
+        beginning, and always the same realms to continue with the 
+        returned cursor.
+        """
+        since, since_rank, since_values = 0, -1, []
+        if cursor:
+            try:
+                since, since_rank, since_values = self._parse_changes_cursor(cursor)
+            except ValueError:
+                raise TracError(_("Invalid changes cursor: %(cursor)s", cursor=cursor))
+
+        rows = []
+        db = self.env.get_read_db()
+        for rank, (realm, key_names, columns, tables, time_column, tiebreakers) in enumerate(self.CHANGE_FEED_SOURCES):
+            if realms and realm not in realms:
+                continue
+
+            # Changes with the same time are sorted by source, and then
+            # by the tiebreaker columns
+            if rank < since_rank:
+                where, args = "%s > %%s" % time_column, [since]
+            elif rank > since_rank:
+                where, args = "%s >= %%s" % time_column, [since]
+            else:
+                where, args = self._get_after_condition(list(tiebreakers), since_values)
+                where = "%s > %%s OR (%s = %%s AND (%s))" % (time_column, time_column, where)
+                args = [since, since] + args
+
+            tiebreaker_list = ', '.join(tiebreakers)
+            
+            cur = db.cursor()
+            cur.execute("SELECT %s, %s FROM %s AND %s >= %%s AND (%s) ORDER BY %s, %s LIMIT %%s" % 
+                (columns, tiebreaker_list, tables, time_column, where, time_column, tiebreaker_list), 
+                [since] + args + [limit])
+
+            num_columns = len(key_names) + 5
+            for i, row in enumerate(cur):
+                rows.append(((row[len(key_names)], rank, i), realm, key_names, row[:num_columns], row[num_columns:]))
+
+        rows.sort(key=itemgetter(0))
+        rows = rows[:limit]
+        
+        changes = []
+        for (ts, rank, i), realm, key_names, row, tiebreaker_values in rows:
+            author, field, oldvalue, newvalue = row[len(key_names)+1:]
+            changes.append({
+                'realm': realm,
+                'key': dict(zip(key_names, row[:len(key_names)])),
+                'time': from_any_timestamp(ts),
+                'author': author,
+                'field': field,
+                'oldvalue': oldvalue is not None and unicode(oldvalue) or '',
+                'newvalue': newvalue is not None and unicode(newvalue) or ''
+                })
+
+        if len(rows) == 0:
+            return changes, cursor or ''
+
+        (last_ts, last_rank, i), realm, key_names, row, last_values = rows[-1]
+
+        return changes, u':'.join([unicode(last_ts), unicode(last_rank)] + [unicode(v) for v in last_values])
+
+    def _parse_changes_cursor(self, cursor):
+        """
+        Returns the time, source rank and tiebreaker values in a changes
+        cursor, raising ValueError if it is not valid.
+        """
+        since, rank, values = cursor.split(':', 2)
+        since, rank = long(since), int(rank)
+        
+        if rank < 0 or rank >= len(self.CHANGE_FEED_SOURCES):
+            raise ValueError(cursor)
+        
+        # Only the last tiebreaker, a field name, could contain ':'
+        count = len(self.CHANGE_FEED_SOURCES[rank][5])
+        values = values.split(':', count - 1)
+        if len(values) != count:
+            raise ValueError(cursor)
+            
+        return since, rank, values
+
+    def _get_after_condition(self, columns, values):
+        """
+        Returns the SQL condition, and its arguments, matching the rows
+        coming after the specified values in the order of the columns.
+        """
+        if len(columns) == 1:
+            return "%s > %%s" % columns[0], [values[0]]
+            
+        where, args = self._get_after_condition(columns[1:], values[1:])
+        
+        return "%s > %%s OR (%s = %%s AND (%s))" % (columns[0], columns[0], where), [values[0], values[0]] + args
+
+    def _build_test_catalog_data_model(self, pagename, include_status=False, planid=None, sortby='custom'):
         
         default_status = self.get_default_tc_status()
         default_status_color = self.outcomes_by_name[default_status][0]
@@ -1300,9 +1834,7 @@ class TestManagerSystem(Component):
 
         unique_idx = 0
 
-        for subpage_name, text in self.list_matching_subpages(pagename+'_'):
-            subpage_title = get_page_title(text)
-
+        for subpage_name, subpage_title in self.list_matching_subpages(pagename+'_'):
             path_name = subpage_name.partition(pagename+'_')[2]
             tokens = path_name.split("_")
             parent = components
@@ -1388,6 +1920,334 @@ class TestManagerSystem(Component):
 
         return components
     
+    def get_test_catalog_level_data_model(self, pagename, include_status=False, planid=None, sortby='custom'):
+        """
+        Returns only the first level of the tree of catalogs and test 
+        cases under the specified catalog page, in the same format as
+        get_test_catalog_data_model().
+        
+        Sub-catalogs have no children, but they carry the total number
+        of test cases they contain, their aggregated status color and
+        a 'has_children' flag.
+        Only the direct children are read, through the parent column of
+        the test pages index, while the totals and colors of the 
+        sub-catalogs are aggregated by the database.
+        """
+        default_status = self.get_default_tc_status()
+        default_status_color = self.outcomes_by_name[default_status][0]
+
+        components = {'id': pagename, 'tcat_id': pagename.rpartition('_TT')[2], 'name': pagename.rpartition('_')[2], 'title': '', 'childrenC': {},'childrenT': {}, 'tot': 0, 'color': 'none'}
+
+        if include_status:
+            tp = TestPlan(self.env, planid)
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+
+        # Sub-catalogs at the first level
+        cursor.execute("SELECT name, title FROM testpageindex WHERE parent = %s AND kind = 'testcatalog'", (pagename,))
+        subcats = {}
+        for name, title in cursor.fetchall():
+            path_name = name.rpartition('_')[2]
+            subcats[name] = components['childrenC'][path_name] = {'id': name, 'tcat_id': path_name.partition('TT')[2], 'name': path_name, 'title': title, 'childrenC': {},'childrenT': {}, 'tot': 0, 'color': 'none', 'has_children': False}
+
+        subcat_names = subcats.keys()
+        for i in range(0, len(subcat_names), 500):
+            chunk = subcat_names[i:i+500]
+            cursor.execute("SELECT DISTINCT parent FROM testpageindex WHERE parent IN (" + ','.join(['%s'] * len(chunk)) + ")", chunk)
+            for row in cursor:
+                subcats[row[0]]['has_children'] = True
+
+        # Totals and colors over the whole subtree, aggregated per 
+        # catalog by the database
+        from_where, args = self._get_test_catalog_table_query(pagename, include_status, planid, None)
+        if include_status:
+            cursor.execute("SELECT p.parent, tcip.status, COUNT(*) " + from_where + " GROUP BY p.parent, tcip.status", args)
+        else:
+            cursor.execute("SELECT p.parent, '', COUNT(*) " + from_where + " GROUP BY p.parent", args)
+
+        prefix = pagename + '_'
+        for parent, status, count in cursor.fetchall():
+            comps = [components]
+            if parent != pagename:
+                first_token = parent[len(prefix):].partition('_')[0]
+                if prefix+first_token in subcats:
+                    comps.append(subcats[prefix+first_token])
+
+            if include_status:
+                status = (status or default_status).lower()
+                
+            for comp in comps:
+                comp['tot'] += count
+                if include_status:
+                    comp['color'] = self._calc_worse_color(comp['color'], status, default_status_color)
+
+        # Test cases at the first level
+        from_where, args = self._get_test_catalog_table_query(pagename, include_status, planid, None, direct_only=True)
+        if include_status:
+            cursor.execute("SELECT p.name, p.title, t.id, t.exec_order, tcip.id, tcip.status, tcip.page_version " + from_where, args)
+        else:
+            cursor.execute("SELECT p.name, p.title, t.id, t.exec_order, NULL, NULL, NULL " + from_where, args)
+        direct_tcs = cursor.fetchall()
+        
+        direct_tc_ids = [row[2] for row in direct_tcs]
+
+        # Latest status change of the test cases at the first level
+        history = {}
+        if include_status:
+            for i in range(0, len(direct_tc_ids), 500):
+                chunk = direct_tc_ids[i:i+500]
+                cursor.execute("SELECT id, time, author, status FROM testcasehistory WHERE planid = %s AND id IN (" +
+                    ','.join(['%s'] * len(chunk)) + ") ORDER BY time", to_list((planid, chunk)))
+                for tc_id, ts, author, status in cursor:
+                    history[tc_id] = (from_any_timestamp(ts), author, status)
+
+        unique_idx = 0
+        for name, title, tc_id, tc_exec_order, tcip_id, status, version in direct_tcs:
+            ts = 0
+            author = ''
+
+            if not include_status:
+                status = ''
+                version = -1
+            elif tcip_id is None:
+                # Not yet executed, in a plan containing all test cases
+                status = default_status
+                version = -1
+                ts = tp['time']
+                author = tp['author']
+            else:
+                status = (status or default_status).lower()
+                if tc_id in history:
+                    ts, author, hist_status = history[tc_id]
+                    if hist_status:
+                        status = hist_status.lower()
+
+            exec_order = "-1"
+            if sortby == 'name':
+                key = title
+            elif sortby == 'custom':
+                if tc_exec_order is not None:
+                    key = "%05d" % (tc_exec_order,)
+                    exec_order = key
+                else:
+                    key = title
+            elif isinstance(ts, datetime):
+                key = ts.isoformat()
+            else:
+                key = title
+
+            if key in components['childrenT']:
+                unique_idx += 1
+                key = key+str(unique_idx)
+
+            components['childrenT'][key] = {'id': name, 'tcat_id': components['tcat_id'], 'tc_id': tc_id, 'title': title, 'status': status, 'ts': ts, 'author': author, 'version': version, 'exec_order': exec_order}
+
+        return components
+
+    def list_test_catalog_table_rows(self, pagename, include_status=False, planid=None, sort='custom', filter_terms=None, offset=0, limit=50):
+        """
+        Returns a page of the test cases contained, at any depth, in
+        the specified catalog, as a tuple (rows, total), where rows is
+        a list of test case entries as in get_test_catalog_data_model()
+        and total is the number of test cases matching the filter.
+        
+        Filtering, sorting and paging are performed by the database.
+        
+        :sort: one of 'custom', 'title', and for test plans also 
+               'status' and 'time'.
+        :filter_terms: list of lowercase terms, each of which must match
+                       the ID or the status of the test case, or words
+                       in its title or description, by prefix.
+        """
+        default_status = self.get_default_tc_status()
+
+        if include_status:
+            tp = TestPlan(self.env, planid)
+            
+        from_where, args = self._get_test_catalog_table_query(pagename, include_status, planid, filter_terms)
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+
+        cursor.execute("SELECT COUNT(*) " + from_where, args)
+        total = cursor.fetchone()[0]
+
+        sort_columns = {'custom': 'p.parent, t.exec_order', 'title': 'p.title'}
+        select_args = []
+        sql = "SELECT p.name, p.title, p.parent, t.id, t.exec_order"
+        if include_status:
+            sort_columns['status'] = 'status, p.title'
+            sort_columns['time'] = 'last_time DESC, p.title'
+            sql += ", COALESCE(tcip.status, %s) AS status, tcip.page_version, " + \
+                "(SELECT MAX(h.time) FROM testcasehistory h WHERE h.id = t.id AND h.planid = %s) AS last_time"
+            select_args = [default_status, planid]
+        
+        sql += " " + from_where + " ORDER BY " + sort_columns.get(sort, sort_columns['custom']) + \
+            " LIMIT %s OFFSET %s"
+
+        cursor.execute(sql, to_list((select_args, list(args), int(limit), int(offset))))
+
+        rows = []
+        for row in cursor:
+            name, title, parent, tc_id, exec_order = row[:5]
+            
+            tick = {'id': name, 'tcat_id': parent.rpartition('_TT')[2], 'tc_id': tc_id, 'title': title, 'status': '', 'ts': 0, 'author': '', 'version': -1, 'exec_order': exec_order}
+
+            if include_status:
+                status, version, last_time = row[5:]
+                tick['status'] = status.lower()
+                if version is not None:
+                    tick['version'] = version
+                tick['ts'] = tp['time']
+                tick['author'] = tp['author']
+                
+            rows.append(tick)
+
+        if include_status and len(rows) > 0:
+            # Latest status change of the test cases in the page
+            ticks_by_id = dict([(tick['tc_id'], tick) for tick in rows])
+            tc_ids = ticks_by_id.keys()
+            cursor.execute("SELECT id, time, author FROM testcasehistory WHERE planid = %s AND id IN (" +
+                ','.join(['%s'] * len(tc_ids)) + ") ORDER BY time", to_list((planid, tc_ids)))
+            for tc_id, ts, author in cursor:
+                ticks_by_id[tc_id]['ts'] = from_any_timestamp(ts)
+                ticks_by_id[tc_id]['author'] = author
+
+        return rows, total
+
+    def list_test_catalog_table_custom_value_counts(self, realm, names, pagename, include_status=False, planid=None, filter_terms=None):
+        """
+        Returns an iterator over (name, value, count) of the specified 
+        custom fields, counting how many objects have each distinct
+        value, in the same scope as list_test_catalog_table_rows().
+        
+        For realm 'testcatalog' the scope is all the catalogs contained
+        in the specified catalog.
+        
+        Aggregating on the distinct values lets the caller compute
+        totals without reading every single row.
+        """
+        if len(names) == 0:
+            return
+            
+        if realm == 'testcatalog':
+            from_where = "FROM testcatalog t WHERE t.page_name LIKE %s ESCAPE '|'"
+            args = [db_escape_like(pagename+'_') + '%']
+        else:
+            from_where, args = self._get_test_catalog_table_query(pagename, include_status, planid, filter_terms)
+            args = list(args)
+
+        sql = "SELECT c.name, c.value, COUNT(*) FROM %s_custom c WHERE c.id IN (SELECT t.id %s)" % (realm, from_where)
+        if realm == 'testcaseinplan':
+            sql += " AND c.planid = %s"
+            args.append(planid)
+
+        sql += " AND c.name IN (" + ','.join(['%s'] * len(names)) + ") GROUP BY c.name, c.value"
+        args.extend(names)
+        
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute(sql, args)
+
+        for name, value, count in cursor:
+            yield name, value, count
+
+    def filter_test_catalog_tree(self, pagename, include_status=False, planid=None, filter_terms=None):
+        """
+        Returns an iterator over (name, path) of the test catalogs and 
+        test cases contained, at any depth, in the specified catalog and
+        matching the filter, where path is the list of the catalog pages
+        between the specified catalog and the matching one.
+        
+        Test cases are filtered as in list_test_catalog_table_rows(),
+        and catalogs by ID or by the words in their title or 
+        description, through the search index, so that a tree can be 
+        filtered without building it.
+        """
+        from testmanager.search import TestSearchIndex
+        search_index = TestSearchIndex(self.env)
+        
+        from_where, args = self._get_test_catalog_table_query(pagename, include_status, planid, filter_terms)
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT p.name " + from_where, args)
+        names = [row[0] for row in cursor]
+        
+        sql = "SELECT p.name FROM testpageindex p INNER JOIN testcatalog c ON c.page_name = p.name WHERE p.kind = 'testcatalog' AND p.name LIKE %s ESCAPE '|'"
+        args = [db_escape_like(pagename+'_') + '%']
+        
+        for term in (filter_terms or []):
+            conditions = ["c.id = %s"]
+            args.append(term)
+            
+            match = search_index.get_match_condition(db, 'testcatalog', 'c.id', term)
+            if match is not None:
+                conditions.append(match[0])
+                args.extend(match[1])
+                
+            sql += " AND (" + " OR ".join(conditions) + ")"
+        
+        cursor.execute(sql, args)
+        names.extend([row[0] for row in cursor])
+
+        prefix = pagename + '_'
+        for name in sorted(names):
+            tokens = name[len(prefix):].split('_')
+            yield name, [prefix + '_'.join(tokens[:i]) for i in range(1, len(tokens))]
+
+    def _get_test_catalog_table_query(self, pagename, include_status, planid, filter_terms, direct_only=False):
+        """
+        Returns the FROM and WHERE clauses, along with their arguments,
+        selecting the test cases in a catalog table, or only the ones
+        directly in the catalog if `direct_only` is True.
+        """
+        default_status = self.get_default_tc_status()
+        
+        sql = "FROM testpageindex p INNER JOIN testcase t ON t.page_name = p.name"
+        args = []
+
+        if include_status:
+            tp = TestPlan(self.env, planid)
+            join = ('INNER', 'LEFT OUTER')[tp['contains_all'] == 1]
+            sql += " %s JOIN testcaseinplan tcip ON tcip.id = t.id AND tcip.planid = %%s" % join
+            args.append(planid)
+        
+        if direct_only:
+            sql += " WHERE p.kind = 'testcase' AND p.parent = %s"
+            args.append(pagename)
+        else:
+            sql += " WHERE p.kind = 'testcase' AND p.name LIKE %s ESCAPE '|'"
+            args.append(db_escape_like(pagename+'_') + '%')
+
+        if filter_terms:
+            # Terms are matched through the search index rather than by
+            # scanning all the titles
+            from testmanager.search import TestSearchIndex
+            search_index = TestSearchIndex(self.env)
+            db = self.env.get_read_db()
+            
+        for term in (filter_terms or []):
+            conditions = ["t.id = %s"]
+            args.append(term)
+            
+            match = search_index.get_match_condition(db, 'testcase', 't.id', term)
+            if match is not None:
+                conditions.append(match[0])
+                args.extend(match[1])
+
+            if include_status:
+                statuses = [s for s in self.outcomes_by_name if term in s or term in self.outcomes_by_name[s][1].lower()]
+                if len(statuses) > 0:
+                    conditions.append("COALESCE(tcip.status, %s) IN (" + ','.join(['%s'] * len(statuses)) + ")")
+                    args.append(default_status)
+                    args.extend(statuses)
+
+            sql += " AND (" + " OR ".join(conditions) + ")"
+
+        return sql, tuple(args)
+
     def _calc_worse_color(self, old_color, new_status, default_status_color):
         new_color = self.outcomes_by_name[new_status][0]
         
@@ -1467,17 +2327,277 @@ class TestManagerSystem(Component):
 
         text += '\r\n'
 
+        # Load all the objects' data in advance, instead of one object per row
+        self._prefetch_export_data(context, planid, components, custom_ctx, include_status, fulldetails, raw_wiki_format)
+
         text += self._get_catalog_csv_markup(context, planid, components, 0, None, '', custom_ctx, separator, include_status, fulldetails, raw_wiki_format)
         text += self._get_subtree_csv_markup(context, planid, components, ind, 0, None, root_catalog_id, custom_ctx, separator, include_status, fulldetails, raw_wiki_format)
 
         return text
 
+    PLAN_EXPORT_DEFAULT_FIELDS = ('title', 'author', 'time', 'version', 'status', 'status_author', 'status_time')
+    
+    def generate_plan_jsonl(self, tp, fields=None):
+        """
+        Generates the whole content of the specified test plan in JSON
+        Lines format, one JSON object per line:
+        
+          * First, the test plan itself, with type 'testplan'.
+          * Then, the catalogs and the test cases in the plan, sorted
+            by page name, with type 'testcatalog' and 'testcase'.
+
+        Each test case carries the ID of its catalog and the specified 
+        fields, among 'title', 'description', 'author', 'time', 
+        'version', 'status', 'status_author', 'status_time' and the 
+        names of the test case and test case in plan custom fields.
+        By default, all the fields except the description are exported.
+        
+        Data is read with a constant number of queries, regardless of 
+        the size of the plan.
+        """
+        planid = tp['id']
+        default_status = self.get_default_tc_status()
+        
+        gcm_provider = GenericClassModelProvider(self.env)
+        tc_custom_names = [f['name'] for f in gcm_provider.get_custom_fields_for_realm('testcase')]
+        tcip_custom_names = [f['name'] for f in gcm_provider.get_custom_fields_for_realm('testcaseinplan')]
+        
+        if fields is None:
+            fields = list(self.PLAN_EXPORT_DEFAULT_FIELDS) + tc_custom_names + tcip_custom_names
+            
+        tc_custom_names = [name for name in tc_custom_names if name in fields]
+        tcip_custom_names = [name for name in tcip_custom_names if name in fields]
+
+        prefix = tp['page_name'] + '_'
+        loader = BulkLoader(self.env)
+        
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+
+        yield self._to_json_line({
+            'type': 'testplan',
+            'id': tp['id'],
+            'name': tp['name'],
+            'catid': tp['catid'],
+            'page_name': tp['page_name'],
+            'author': tp['author'],
+            'time': self._to_iso_string(tp['time']),
+            'contains_all': tp['contains_all'],
+            'freeze_tc_versions': tp['freeze_tc_versions'],
+            'custom': self._get_custom_values(loader.load_custom_values('testplan', ids=[tp['id']]).get(tp['id'], {}), 'testplan')
+            })
+
+        # Status and latest status change of all the test cases in 
+        # the plan
+        tcip_statuses = {}
+        cursor.execute("SELECT id, status, page_version FROM testcaseinplan WHERE planid = %s", (planid,))
+        for tc_id, status, version in cursor:
+            tcip_statuses[tc_id] = (status, version)
+
+        history = {}
+        cursor.execute("""
+            SELECT h.id, h.time, h.author FROM testcasehistory h 
+                INNER JOIN (SELECT id, MAX(time) AS maxtime FROM testcasehistory WHERE planid = %s GROUP BY id) m 
+                    ON m.id = h.id AND m.maxtime = h.time
+                WHERE h.planid = %s
+            """, (planid, planid))
+        for tc_id, ts, author in cursor:
+            history[tc_id] = (ts, author)
+
+        texts = {}
+        if 'description' in fields:
+            texts = loader.load_page_texts(page_prefix=prefix)
+
+        tcat_custom = loader.load_custom_values('testcatalog', page_prefix=prefix)
+        
+        tc_custom = {}
+        if len(tc_custom_names) > 0:
+            tc_custom = loader.load_custom_values('testcase', page_prefix=prefix)
+
+        tcip_custom = {}
+        if len(tcip_custom_names) > 0:
+            tcip_custom = loader.load_custom_values('testcaseinplan', planid=planid)
+
+        cursor.execute("""
+            SELECT name, version, title, kind, author, time FROM testpageindex
+                WHERE name LIKE %s ESCAPE '|' ORDER BY name
+            """, (db_escape_like(prefix) + '%',))
+        
+        for name, version, title, kind, author, ts in cursor.fetchall():
+            path_name = name[len(prefix):]
+            parent_id = name.rpartition('_')[0].rpartition('_TT')[2]
+            
+            if kind == 'testcatalog':
+                tcat_id = path_name.rpartition('TT')[2]
+                yield self._to_json_line({
+                    'type': 'testcatalog',
+                    'id': tcat_id,
+                    'page_name': name,
+                    'parent': parent_id,
+                    'title': title,
+                    'custom': self._get_custom_values(tcat_custom.get(tcat_id, {}), 'testcatalog')
+                    })
+                
+            elif kind == 'testcase':
+                tc_id = path_name.rpartition('TC')[2]
+                
+                if tc_id in tcip_statuses:
+                    status = tcip_statuses[tc_id][0] or default_status
+                elif tp['contains_all']:
+                    status = default_status
+                else:
+                    continue
+                
+                status_ts, status_author = history.get(tc_id, (None, None))
+
+                values = {
+                    'title': title,
+                    'description': get_page_description(texts.get(name, '')),
+                    'author': author,
+                    'time': self._to_iso_string(ts),
+                    'version': version,
+                    'status': status.lower(),
+                    'status_author': status_author or '',
+                    'status_time': self._to_iso_string(status_ts)
+                    }
+                
+                for custom_names, custom_values in ((tc_custom_names, tc_custom), (tcip_custom_names, tcip_custom)):
+                    obj_values = custom_values.get(tc_id, {})
+                    for custom_name in custom_names:
+                        values[custom_name] = obj_values.get(custom_name) or ''
+                
+                tc_line = {'type': 'testcase', 'id': tc_id, 'page_name': name, 'catalog': parent_id}
+                for field in fields:
+                    if field in values:
+                        tc_line[field] = values[field]
+                
+                yield self._to_json_line(tc_line)
+
+    def _get_custom_values(self, obj_values, realm):
+        result = {}
+        for f in GenericClassModelProvider(self.env).get_custom_fields_for_realm(realm):
+            result[f['name']] = obj_values.get(f['name']) or ''
+            
+        return result
+        
+    def _to_iso_string(self, ts):
+        if ts is None:
+            return ''
+            
+        if not isinstance(ts, datetime):
+            ts = from_any_timestamp(ts)
+            
+        return ts.isoformat()
+
+    def _to_json_line(self, obj):
+        return json.dumps(obj, separators=(',', ':')) + '\n'
+
+    def _prefetch_export_data(self, context, planid, components, custom_ctx, include_status, fulldetails, raw_wiki_format):
+        """
+        Loads in advance, with a constant number of queries, the data
+        needed by the CSV rows of the specified data model, storing it
+        into the custom context:
+        
+          * 'custom': the custom field values, {realm: {id: values}}
+          * 'descriptions': the descriptions, {page name: description},
+            already rendered unless the raw wiki format is requested.
+            
+        The descriptions are rendered by a pool of 
+        [testmanager] export.render_workers threads, which helps when
+        macros wait on I/O. The default of one worker, or any failure 
+        of the pool, renders them serially.
+        """
+        page_names = []
+        self._collect_page_names(components, page_names)
+
+        tcat_ids = []
+        tc_ids = []
+        self._collect_object_ids(components, tcat_ids, tc_ids)
+
+        loader = BulkLoader(self.env)
+
+        custom_values = {}
+        if custom_ctx['testcatalog'][0]:
+            custom_values['testcatalog'] = loader.load_custom_values('testcatalog', ids=tcat_ids)
+        if custom_ctx['testcase'][0]:
+            custom_values['testcase'] = loader.load_custom_values('testcase', ids=tc_ids)
+        if include_status and custom_ctx['testcaseinplan'][0]:
+            custom_values['testcaseinplan'] = loader.load_custom_values('testcaseinplan', ids=tc_ids, planid=planid)
+        custom_ctx['custom'] = custom_values
+
+        if fulldetails:
+            texts = loader.load_page_texts(page_names=page_names)
+            
+            descriptions = {}
+            if raw_wiki_format:
+                for page_name in page_names:
+                    descriptions[page_name] = get_page_description(texts.get(page_name)) or ''
+            else:
+                versions = loader.load_page_versions(page_names=page_names)
+                
+                def do_render(page_name):
+                    text = texts.get(page_name)
+                    if text is not None:
+                        text = get_page_description(text)
+                    
+                    version, changetime = versions.get(page_name, (None, None))
+                    return self.render_description(context, page_name, version, text, changetime=changetime)
+
+                workers = min(self.config.getint('testmanager', 'export.render_workers', 1), len(page_names))
+                
+                rendered = None
+                if workers > 1:
+                    try:
+                        # Pool.map() preserves the order of the pages
+                        pool = ThreadPool(workers)
+                        try:
+                            rendered = pool.map(do_render, page_names)
+                        finally:
+                            pool.close()
+                            pool.join()
+                    except:
+                        self.env.log.error("Error rendering the descriptions in parallel, falling back to serial rendering")
+                        self.env.log.error(formatExceptionInfo())
+
+                if rendered is None:
+                    rendered = [do_render(page_name) for page_name in page_names]
+                    
+                descriptions = dict(zip(page_names, rendered))
+
+            custom_ctx['descriptions'] = descriptions
+
+    def _collect_object_ids(self, data, tcat_ids, tc_ids):
+        if 'id' in data:
+            tcat_ids.append(data['id'].rpartition('TT')[2])
+            
+        for tick in data.get('childrenT', {}).itervalues():
+            tc_ids.append(tick['tc_id'])
+
+        for comp in data.get('childrenC', {}).itervalues():
+            self._collect_object_ids(comp, tcat_ids, tc_ids)
+
+    def _get_prefetched_description(self, page_name, custom_ctx, separator):
+        description = custom_ctx['descriptions'].get(page_name) or ''
+        return separator + '"' + re.sub(self.DOUBLE_QUOTES, "\"\"", description) + '"'
+
+    def _get_prefetched_custom_values(self, realm, obj_id, custom_ctx):
+        return custom_ctx['custom'].get(realm, {}).get(obj_id, PrefetchedValues())
+
+    def _collect_page_names(self, data, page_names):
+        if 'id' in data:
+            page_names.append(data['id'])
+            
+        for tick in data.get('childrenT', {}).itervalues():
+            page_names.append(tick['id'])
+
+        for comp in data.get('childrenC', {}).itervalues():
+            self._collect_page_names(comp, page_names)
+        
     # Render a single catalog in CSV
     def _get_catalog_csv_markup(self, context, planid, data, level, tp=None, parent_id='', custom_ctx=None, separator=',', include_status=False, fulldetails=False, raw_wiki_format=True):
         text = ''
 
         tcat_id = data['id'].rpartition('TT')[2]
-        tcat = TestCatalog(self.env, tcat_id)
         tcat_title = data['title']
         
         object_type = 'testcatalog'
@@ -1505,12 +2625,12 @@ class TestManagerSystem(Component):
 
         # Include long description only if required
         if fulldetails:
-            description = self._get_object_description(tcat.description, raw_wiki_format, context)
-            text += separator+description
+            text += self._get_prefetched_description(data['id'], custom_ctx, separator)
             
         # Custom testcatalog columns
         if custom_ctx['testcatalog'][0]:
-            text += self._get_custom_fields_columns(tcat, custom_ctx['testcatalog'][1], separator)
+            tcat_values = self._get_prefetched_custom_values('testcatalog', tcat_id, custom_ctx)
+            text += self._get_custom_fields_columns(tcat_values, custom_ctx['testcatalog'][1], separator)
         
         if object_type == 'testplan':
             # Custom testplan columns
@@ -1545,7 +2665,6 @@ class TestManagerSystem(Component):
                 index = str(ind['count'])
 
                 tcat_id = comp['id'].rpartition('TT')[2]
-                tcat = TestCatalog(self.env, tcat_id)
                 
                 # Common columns
                 text += 'testcatalog'+separator+tcat_id+separator+parent_id
@@ -1557,12 +2676,12 @@ class TestManagerSystem(Component):
 
                 # Include long description only if required
                 if fulldetails:
-                    description = self._get_object_description(tcat.description, raw_wiki_format, context)
-                    text += separator+description
+                    text += self._get_prefetched_description(comp['id'], custom_ctx, separator)
                     
                 # Custom testcatalog columns
                 if custom_ctx['testcatalog'][0]:
-                    text += self._get_custom_fields_columns(tcat, custom_ctx['testcatalog'][1], separator)
+                    tcat_values = self._get_prefetched_custom_values('testcatalog', tcat_id, custom_ctx)
+                    text += self._get_custom_fields_columns(tcat_values, custom_ctx['testcatalog'][1], separator)
 
                 # Custom testplan columns
                 if include_status and custom_ctx['testplan'][0]:
@@ -1596,10 +2715,6 @@ class TestManagerSystem(Component):
             version = tick['version']
             version_str = (str(version), '')[version == -1]
 
-            tc = None
-            if fulldetails or custom_ctx['testcase'][0]:
-                tc = TestCase(self.env, tick['tc_id'])
-
             # Common columns
             text += object_type+separator+tick['tc_id']+separator+parent_id
             
@@ -1612,8 +2727,7 @@ class TestManagerSystem(Component):
                 text += separator+separator
 
             if fulldetails:
-                description = self._get_object_description(tc.description, raw_wiki_format, context)
-                text += separator+description
+                text += self._get_prefetched_description(tick['id'], custom_ctx, separator)
                         
             # Custom testcatalog columns
             if custom_ctx['testcatalog'][0]:
@@ -1627,11 +2741,8 @@ class TestManagerSystem(Component):
 
             # Custom testcase columns
             if custom_ctx['testcase'][0]:
-                if tc and tc.exists:
-                    text += self._get_custom_fields_columns(tc, custom_ctx['testcase'][1], separator)
-                else:
-                    for f in custom_ctx['testcase'][1]:
-                        text += separator
+                tc_values = self._get_prefetched_custom_values('testcase', tick['tc_id'], custom_ctx)
+                text += self._get_custom_fields_columns(tc_values, custom_ctx['testcase'][1], separator)
 
             has_status = False
             if include_status:
@@ -1643,30 +2754,13 @@ class TestManagerSystem(Component):
             
                 # Custom testcaseinplan columns
                 if custom_ctx['testcaseinplan'][0]:
-                    tcip = TestCaseInPlan(self.env, tick['tc_id'], planid)
-                    if tcip and tcip.exists:
-                        text += self._get_custom_fields_columns(tcip, custom_ctx['testcaseinplan'][1], separator)
-                    else:
-                        for f in custom_ctx['testcaseinplan'][1]:
-                            text += separator
+                    tcip_values = self._get_prefetched_custom_values('testcaseinplan', tick['tc_id'], custom_ctx)
+                    text += self._get_custom_fields_columns(tcip_values, custom_ctx['testcaseinplan'][1], separator)
 
             text += '\r\n'
 
         return text
 
-    def _get_object_description(self, text, raw_wiki_format, context):
-        if raw_wiki_format:
-            description = re.sub(self.DOUBLE_QUOTES, "\"\"", text)
-        else:
-            wikidom = WikiParser(self.env).parse(text)
-            out = StringIO()
-            f = Formatter(self.env, context)
-            f.reset(wikidom)
-            f.format(wikidom, out, False)
-            description = re.sub(self.DOUBLE_QUOTES, "\"\"", out.getvalue())
-
-        return '"' + description + '"'
-
     def _get_custom_fields_columns(self, obj, fields, separator):
         result = ''
         
@@ -1694,14 +2788,15 @@ class TestManagerSystem(Component):
         return do_sort
         
     def list_matching_subpages(self, curpage):
-        db = self.env.get_read_db()
-        cursor = db.cursor()
-
-        sql = "SELECT w1.name, w1.text, w1.version FROM wiki w1, (SELECT name, max(version) as ver FROM wiki WHERE name LIKE '%s%%' GROUP BY name) w2 WHERE w1.version = w2.ver AND w1.name = w2.name ORDER BY w2.name" % curpage
+        """
+        Returns an iterator over (name, title) of all the test pages
+        whose name starts with curpage, sorted by name.
         
-        cursor.execute(sql)
-        for name, text, version in cursor:
-            yield name, text
+        Titles are read from the test pages index, so the wiki table
+        and the page bodies are not touched.
+        """
+        for name, title, kind in TestManagerModelProvider(self.env).list_indexed_subpages(curpage):
+            yield name, title
         
         return
         
@@ -405,6 +405,10 @@ var htimer = null;
 var searchResults = 0;
 
 function toggleAll(tableId, isexpand) {
+    if (isexpand) {
+        loadTree(tableId);
+    }
+    
     var nodes=document.getElementById(tableId).getElementsByTagName("span");
     for(var i=0;i<nodes.length;i++) {
         if(nodes.item(i).getAttribute("name") === "toggable") {
@@ -429,12 +433,52 @@ function collapse(id) {
 function expand(id) {
     el = document.getElementById(id);
     if (el.getAttribute("name") === "toggable") {
+        loadSubtree(el);
         el.firstChild['expanded'] = true;
         el.firstChild.innerHTML = '<img class="iconElement" src="'+baseLocation+'/chrome/testmanager/images/minus.png" />';
         document.getElementById(el.id+"_list").style.display = "";
     }
 }
 
+/**
+ * When the tree is loaded lazily, fetches the children of a catalog 
+ * node from the server the first time it is expanded.
+ */
+function loadSubtree(el) {
+    var page = el.getAttribute("lazypage");
+    if (page === null || el.getAttribute("lazyloaded") === "true") {
+        return;
+    }
+
+    var url = baseLocation+"/testtreefragment?page="+page+"&planid="+el.getAttribute("lazyplanid")+"&node="+el.id;
+    var result = doAjaxCall(url, "GET", "");
+
+    if (result != 'ERROR') {
+        document.getElementById(el.id+"_list").innerHTML = result;
+        el.setAttribute("lazyloaded", "true");
+    }
+}
+
+/**
+ * When the tree is loaded lazily, fetches all the nodes not loaded yet
+ * with a single request, as needed to expand the whole tree.
+ */
+function loadTree(tableId) {
+    var container = document.getElementById(tableId);
+    var page = container.getAttribute("lazypage");
+    if (page === null || container.getAttribute("lazyloaded") === "true") {
+        return;
+    }
+
+    var url = baseLocation+"/testtreefragment?page="+page+"&planid="+container.getAttribute("lazyplanid")+"&node=b&all=true";
+    var result = doAjaxCall(url, "GET", "");
+
+    if (result != 'ERROR') {
+        container.getElementsByTagName("ul")[0].innerHTML = result;
+        container.setAttribute("lazyloaded", "true");
+    }
+}
+
 function toggle(id) {
     var el=document.getElementById(id);
     if (el.firstChild['expanded']) {
@@ -548,14 +592,68 @@ function starthighlight(tableId, str,now) {
         clearTimeout(htimer);
     } 
     if (now) {
-        highlight(tableId, str);
+        filterTree(tableId, str);
     } else {
         htimer = setTimeout(function() {
-                                highlight(tableId, str);
+                                filterTree(tableId, str);
                             },500);
     }
 }
 
+/**
+ * When the tree is loaded lazily, asks the server for the test cases 
+ * matching the filter, loads only the catalogs containing them, and 
+ * hides the other catalogs.
+ */
+function filterTree(tableId, str) {
+    var container = document.getElementById(tableId);
+    var page = container.getAttribute("lazypage");
+    if (page === null || container.getAttribute("lazyloaded") === "true" || !str || str === "") {
+        /* All the nodes are in the page */
+        highlight(tableId, str);
+        return;
+    }
+
+    var url = baseLocation+"/testtreefilter?page="+page+"&planid="+container.getAttribute("lazyplanid")+"&filter="+encodeURIComponent(str);
+    var result = doAjaxCall(url, "GET", "");
+    if (result == 'ERROR') {
+        highlight(tableId, str);
+        return;
+    }
+    
+    var matches = jQuery_testmanager.parseJSON(result).matches;
+    var paths = {};
+    for (var i=0;i<matches.length;i++) {
+        /* Matching catalogs are loaded and shown too */
+        paths[matches[i].id] = true;
+        for (var j=0;j<matches[i].path.length;j++) {
+            paths[matches[i].path[j]] = true;
+        }
+    }
+
+    /* The live list grows with the subtrees being loaded */
+    var nodes = container.getElementsByTagName("span");
+    for (var i=0;i<nodes.length;i++) {
+        if (nodes.item(i).getAttribute("lazypage") in paths) {
+            loadSubtree(nodes.item(i));
+        }
+    }
+
+    highlight(tableId, str);
+
+    if (selectHide) {
+        for (var i=0;i<nodes.length;i++) {
+            var n = nodes.item(i);
+            if (n.getAttribute("lazypage") !== null && !(n.getAttribute("lazypage") in paths)) {
+                n.parentNode.style.display = "none";
+                deselectData[tableId][deselectData[tableId].length]=n.parentNode;
+            }
+        }
+    }
+    
+    document.getElementById(tableId+'_searchResultsNumberId').innerHTML = _("Results: ")+matches.length;
+}
+
 function checkFilter(tableId, now) {
     var f=document.getElementById("tcFilter");
     if (f) {
@@ -1028,22 +1126,33 @@ function sendUpdate(realm, name) {
    	var objPropsField = document.getElementById("obj_props_field");
     var objProps = objPropsField.value;
 
-   	var inputField = document.getElementById("custom_field_"+name);
-	var value = inputField.value;
-    
-    params = "realm="+realm+"&key="+objKey+"&props="+objProps+"&name="+name+"&value="+encodeURIComponent(value);
-    var url = baseLocation+"/propertyupdate?" + params;
+    // Save, along with this field, all the other fields being edited
+    var names = [name];
+    jQuery_testmanager("input[id^='update_button_']").each(function() {
+        var otherName = this.id.substring('update_button_'.length);
+        if (otherName != name && this.style.display != 'none') {
+            names.push(otherName);
+        }
+    });
+
+    var updates = [];
+    for (var i = 0; i < names.length; i++) {
+        var inputField = document.getElementById("custom_field_"+names[i]);
+        updates.push({'realm': realm, 'key': objKey, 'props': objProps, 'name': names[i], 'value': inputField.value});
+    }
     
-    result = doAjaxCall(url, "GET", "");
+    result = sendUpdates(updates);
 
     // Handle errors in the Ajax call
     if (result == 'OK') {
-        var readonlyField = document.getElementById("custom_field_value_"+name);
-        readonlyField.innerHTML = value;
+        for (var i = 0; i < updates.length; i++) {
+            var readonlyField = document.getElementById("custom_field_value_"+updates[i].name);
+            readonlyField.innerHTML = updates[i].value;
 
-        displayNode('custom_field_value_'+name, true);
-        displayNode('custom_field_'+name, false);
-        displayNode('update_button_'+name, false);
+            displayNode('custom_field_value_'+updates[i].name, true);
+            displayNode('custom_field_'+updates[i].name, false);
+            displayNode('update_button_'+updates[i].name, false);
+        }
     } else {
         (function($) {
             $(function() {
@@ -1053,6 +1162,17 @@ function sendUpdate(realm, name) {
     }
 }
 
+/**
+ * Sends many property updates, possibly of many objects, in a single
+ * request. Each update is an object with the 'realm', 'key', 'name',
+ * 'value' and optional 'props' of the property to set.
+ */
+function sendUpdates(updates) {
+    var params = "updates=" + encodeURIComponent(JSON.stringify(updates));
+    
+    return doAjaxCall(baseLocation+"/propertyupdate", "POST", params);
+}
+
 function getLocale() {
 	if ( navigator ) {
 		if ( navigator.language ) {
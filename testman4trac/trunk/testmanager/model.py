@@ -31,6 +31,7 @@ from trac.db import Table, Column, Index
 from trac.env import IEnvironmentSetupParticipant
 from trac.perm import PermissionError
 from trac.resource import Resource, ResourceNotFound
+from trac.ticket.api import ITicketChangeListener
 from trac.util.datefmt import utc, utcmax
 from trac.util.text import CRLF
 from trac.wiki.api import WikiSystem
@@ -47,6 +48,32 @@ except ImportError:
     from trac.util.translation import _, N_
     tag_ = _
 
+
+def record_deletion(db, realm, id, planid=''):
+    """
+    Records the deletion of a test object, so that the change feed
+    can report it after the object is gone.
+    """
+    cursor = db.cursor()
+    
+    # Only the latest deletion is kept. Deleting the wiki page of a 
+    # test catalog or test case deletes the object again, through the
+    # wiki change listener.
+    cursor.execute("DELETE FROM testdeletion WHERE realm = %s AND id = %s AND planid = %s", (realm, id, planid))
+    cursor.execute("INSERT INTO testdeletion (realm, id, planid, time) VALUES (%s, %s, %s, %s)", 
+        (realm, id, planid, to_any_timestamp(datetime.now(utc))))
+
+def record_testcases_in_plan_deletion(db, column, value):
+    """
+    Records the deletion of all the test cases in plan with the 
+    specified test case or plan ID, to be called before they are 
+    deleted.
+    """
+    cursor = db.cursor()
+    cursor.execute("INSERT INTO testdeletion (realm, id, planid, time) SELECT 'testcaseinplan', id, planid, %%s FROM testcaseinplan WHERE %s = %%s" % column, 
+        (to_any_timestamp(datetime.now(utc)), value))
+
+
 class AbstractTestDescription(AbstractWikiPageWrapper):
     """
     A test description object based on a Wiki page.
@@ -114,6 +141,14 @@ class AbstractTestDescription(AbstractWikiPageWrapper):
         
         return True
 
+    def get_search_results(self, req, terms, filters):
+        """
+        Searches the test search index, rather than the whole wiki.
+        """
+        from testmanager.search import TestSearchIndex
+        for result in TestSearchIndex(self.env).get_search_results(req, self.realm, terms):
+            yield result
+
     
 class TestCatalog(AbstractTestDescription):
     """
@@ -326,6 +361,8 @@ class TestCatalog(AbstractTestDescription):
         for tp in self.list_testplans(db):
             tp.delete(db=db)
 
+        record_deletion(db, self.realm, self['id'])
+
         AbstractTestDescription.post_delete(self, db)
 
     def create_instance(self, key):
@@ -340,12 +377,20 @@ class TestCase(AbstractTestDescription):
     def __init__(self, env, id=None, page_name=None, title=None, description=None, exec_order=0, db=None):
     
         self.exec_order = exec_order
+
+        # The enclosing catalog, when already known to the caller, so 
+        # that inserting many test cases does not fetch it every time
+        self.enclosing_catalog = None
+        
         AbstractTestDescription.__init__(self, env, 'testcase', id, page_name, title, description, db)
         
     def get_enclosing_catalog(self):
         """
         Returns the catalog containing this test case.
         """
+        if self.enclosing_catalog is not None:
+            return self.enclosing_catalog
+            
         page_name = self.values['page_name']
         cat_id = page_name.rpartition('TT')[2].rpartition('_')[0]
         cat_page = page_name.rpartition('_TC')[0]
@@ -400,6 +445,12 @@ class TestCase(AbstractTestDescription):
             cursor.execute("UPDATE wiki SET name = %s WHERE name = %s", 
                 (new_page_name, self['page_name']))
 
+            # Keep the test pages index in sync, since no wiki listener
+            # is notified of this rename
+            model_provider = TestManagerModelProvider(self.env)
+            model_provider.remove_from_test_page_index(self['page_name'], db)
+            model_provider.update_test_page_index(new_page_name, db)
+
             # Invalidate Trac 0.12 page name cache
             try:
                 del WikiSystem(self.env).pages
@@ -436,8 +487,7 @@ class TestCase(AbstractTestDescription):
             db = self.env.get_read_db()
         
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM ticket WHERE id in " +
-            "(SELECT ticket FROM ticket_custom WHERE name='testcaseid' AND value=%s)",
+        cursor.execute("SELECT ticket FROM testcaseticket WHERE testcase = %s ORDER BY ticket",
             (self.values['page_name'],))
             
         for row in cursor:
@@ -453,8 +503,9 @@ class TestCase(AbstractTestDescription):
         """
         AbstractTestDescription.pre_insert(self, db)
 
+        tcat = self.get_enclosing_catalog()
+
         if self['exec_order'] is None or self['exec_order'] == -1:
-            tcat = self.get_enclosing_catalog()
             last_order = tcat.get_last_order(db)
 
             self.env.log.debug("last_order: %s" % last_order)
@@ -463,7 +514,6 @@ class TestCase(AbstractTestDescription):
 
         # Inserts the test case into the enclosing catalog, 
         # in the right position.
-        tcat = self.get_enclosing_catalog()
         tcat.insert_testcase_into_order(self, self['exec_order'], db)
             
         return True
@@ -478,17 +528,23 @@ class TestCase(AbstractTestDescription):
         cursor = db.cursor()
         
         # Delete test cases in plan
+        record_testcases_in_plan_deletion(db, 'id', self['id'])
         cursor.execute('DELETE FROM testcaseinplan WHERE id = %s', (self['id'],))
 
 		# TODO Delete from testcaseinplan_custom and testcaseinplan_change
 
         # Delete test case status history
+        from testmanager.stats import DailyStatsRollup
+        DailyStatsRollup(self.env).history_removed(db, tc_id=self['id'])
+        
         cursor.execute('DELETE FROM testcasehistory WHERE id = %s', (self['id'],))
 
         if self['exec_order'] is not None and self['exec_order'] != -1:
             tcat = self.get_enclosing_catalog()
             tcat.remove_testcase_from_order(self)
 
+        record_deletion(db, self.realm, self['id'])
+
         AbstractTestDescription.post_delete(self, db)
         
         
@@ -551,9 +607,21 @@ class TestCaseInPlan(AbstractVariableFieldsObject):
 
         @self.env.with_transaction(db)
         def do_set_status(db):
+            ts = datetime.now(utc)
+            
+            old_status = None
+            for old_ts, old_author, old_status in self.list_history(db):
+                break
+            
+            from testmanager.stats import DailyStatsRollup
+            DailyStatsRollup(self.env).status_changed(self.values['planid'], old_status, status, ts, db)
+            
             cursor = db.cursor()
             sql = 'INSERT INTO testcasehistory (id, planid, time, author, status) VALUES (%s, %s, %s, %s, %s)'
-            cursor.execute(sql, (self.values['id'], self.values['planid'], to_any_timestamp(datetime.now(utc)), author, status))
+            cursor.execute(sql, (self.values['id'], self.values['planid'], to_any_timestamp(ts), author, status))
+
+            # The data models showing the status are invalidated by the
+            # change listeners, once the object is saved or inserted
 
     def list_history(self, db=None):
         """
@@ -582,10 +650,7 @@ class TestCaseInPlan(AbstractVariableFieldsObject):
             db = self.env.get_read_db()
 
         cursor = db.cursor()
-        cursor.execute("SELECT id FROM ticket WHERE id in " +
-            "(SELECT ticket FROM ticket_custom WHERE name='testcaseid' AND value=%s) " +
-            "AND id in " +
-            "(SELECT ticket FROM ticket_custom WHERE name='planid' AND value=%s) ",
+        cursor.execute("SELECT ticket FROM testcaseticket WHERE testcase = %s AND planid = %s ORDER BY ticket",
             (self.values['page_name'], self.values['planid']))
             
         for row in cursor:
@@ -605,6 +670,9 @@ class TestCaseInPlan(AbstractVariableFieldsObject):
         
         self.env.log.debug('<<< update_version')
         
+    def post_delete(self, db):
+        record_deletion(db, self.realm, self['id'], self['planid'])
+
     def delete_history(self, db=None):
         """
         Deletes all entries in the testcasehistory related to this test case in plan
@@ -613,12 +681,20 @@ class TestCaseInPlan(AbstractVariableFieldsObject):
 
         @self.env.with_transaction(db)
         def do_delete_history(db):
+            from testmanager.stats import DailyStatsRollup
+            DailyStatsRollup(self.env).history_removed(db, tc_id=self['id'], planid=self['planid'])
+
             cursor = db.cursor()
             
             # Delete test case status history
             cursor.execute('DELETE FROM testcasehistory WHERE id = %s and planid = %s', (self['id'], self['planid']))
 
         self.env.log.debug('<<< delete_history')
+
+    def get_search_results(self, req, terms, filters):
+        from testmanager.search import TestSearchIndex
+        for result in TestSearchIndex(self.env).get_search_results(req, self.realm, terms):
+            yield result
         
     
 class TestPlan(AbstractVariableFieldsObject):
@@ -736,6 +812,7 @@ class TestPlan(AbstractVariableFieldsObject):
         cursor = db.cursor()
         
         # Delete test cases in plan
+        record_testcases_in_plan_deletion(db, 'planid', self['id'])
         cursor.execute('DELETE FROM testcaseinplan WHERE planid = %s', (self['id'],))
 
 		# TODO Delete from testcaseinplan_custom and testcaseinplan_change
@@ -743,6 +820,8 @@ class TestPlan(AbstractVariableFieldsObject):
         # Delete test case status history
         cursor.execute('DELETE FROM testcasehistory WHERE planid = %s', (self['id'],))
 
+        record_deletion(db, self.realm, self['id'])
+
     def get_related_tickets(self, db=None):
         pass
 
@@ -767,6 +846,229 @@ class TestPlan(AbstractVariableFieldsObject):
             
         self.env.log.debug('<<< get_selected_testcases')      
 
+    def get_search_results(self, req, terms, filters):
+        from testmanager.search import TestSearchIndex
+        for result in TestSearchIndex(self.env).get_search_results(req, self.realm, terms):
+            yield result
+
+
+class PrefetchedValues(dict):
+    """
+    The field values of a test object loaded by the BulkLoader.
+    As with the test objects, missing fields have a None value.
+    """
+    def __missing__(self, key):
+        return None
+
+
+class BulkLoader(object):
+    """
+    Loads the data of many test objects at once, with a constant number
+    of queries, instead of fetching each object separately.
+    
+    Objects can be selected either by the page name prefix of the 
+    catalog subtree containing them, or by a list of IDs.
+    """
+
+    # Realm table, custom table key columns 
+    CUSTOM_REALMS = {
+        'testcatalog': ('testcatalog', ('id',)),
+        'testcase': ('testcase', ('id',)),
+        'testcaseinplan': ('testcaseinplan', ('id', 'planid')),
+        'testplan': ('testplan', ('id',))
+        }
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, env, db=None):
+        self.env = env
+        self.db = db
+
+    def load_custom_values(self, realm, page_prefix=None, ids=None, planid=None):
+        """
+        Returns the custom field values of the objects of the specified
+        realm, as a dictionary {id: PrefetchedValues}.
+        
+        :page_prefix: only load objects whose page name starts with 
+                      the prefix.
+        :ids: only load the objects with these IDs.
+        :planid: for realm 'testcaseinplan', the test plan.
+        """
+        table, key_names = self.CUSTOM_REALMS[realm]
+        
+        sql = "SELECT c.id, c.name, c.value FROM %s_custom c" % table
+        args = []
+        where = []
+        
+        if page_prefix is not None:
+            sql += " INNER JOIN %s o ON o.id = c.id" % table
+            where.append("o.page_name LIKE %s ESCAPE '|'")
+            args.append(db_escape_like(page_prefix) + '%')
+            
+            if 'planid' in key_names:
+                where.append("o.planid = c.planid")
+            
+        if 'planid' in key_names and planid is not None:
+            where.append("c.planid = %s")
+            args.append(planid)
+
+        result = {}
+        for chunk_where, chunk_args in self._chunk_ids('c.id', ids):
+            cursor = self._get_db().cursor()
+            cursor.execute(sql + self._get_where_clause(where + chunk_where), to_list((args, chunk_args)))
+        
+            for obj_id, name, value in cursor:
+                if obj_id not in result:
+                    result[obj_id] = PrefetchedValues({'id': obj_id})
+                    if planid is not None:
+                        result[obj_id]['planid'] = planid
+                    
+                result[obj_id][name] = value
+
+        return result
+
+    def load_test_cases_in_plan(self, keys):
+        """
+        Returns the specified test cases in plans, with their custom
+        field values, as a dictionary {(id, planid): TestCaseInPlan}.
+        The test cases not yet in their plans are not returned.
+        
+        :keys: a list of (test case ID, test plan ID).
+        """
+        template = TestCaseInPlan(self.env)
+        std_fields = [f['name'] for f in template.fields if not f.get('custom')]
+        has_custom = len([f for f in template.fields if f.get('custom')]) > 0
+
+        ids_by_plan = {}
+        for tc_id, planid in keys:
+            ids_by_plan.setdefault(planid, set()).add(tc_id)
+            
+        result = {}
+        for planid, ids in ids_by_plan.iteritems():
+            custom_values = {}
+            if has_custom:
+                custom_values = self.load_custom_values('testcaseinplan', ids=ids, planid=planid)
+            
+            for chunk_where, chunk_args in self._chunk_ids('id', ids):
+                cursor = self._get_db().cursor()
+                cursor.execute("SELECT " + ','.join(std_fields) + " FROM testcaseinplan" + self._get_where_clause(["planid = %s"] + chunk_where), 
+                    to_list((planid, chunk_args)))
+                
+                for row in cursor.fetchall():
+                    values = dict(zip(std_fields, row))
+                    values.update(custom_values.get(values['id'], {}))
+                    
+                    tcip = TestCaseInPlan(self.env)
+                    tcip.set_loaded_values(values, db=self._get_db())
+                    result[(values['id'], planid)] = tcip
+            
+        return result
+
+    def load_page_texts(self, page_prefix=None, page_names=None):
+        """
+        Returns the text of the latest version of the test catalog and
+        test case pages, as a dictionary {page name: text}, using the
+        test pages index to locate the latest versions.
+        """
+        sql = "SELECT w.name, w.text FROM wiki w INNER JOIN testpageindex p ON p.name = w.name AND p.version = w.version"
+        args = []
+        where = []
+
+        if page_prefix is not None:
+            where.append("p.name LIKE %s ESCAPE '|'")
+            args.append(db_escape_like(page_prefix) + '%')
+
+        result = {}
+        for chunk_where, chunk_args in self._chunk_ids('p.name', page_names):
+            cursor = self._get_db().cursor()
+            cursor.execute(sql + self._get_where_clause(where + chunk_where), to_list((args, chunk_args)))
+            
+            for name, text in cursor:
+                result[name] = text
+            
+        return result
+
+    def load_page_versions(self, page_prefix=None, page_names=None):
+        """
+        Returns the latest version of the test catalog and test case 
+        pages, and its time, as a dictionary {page name: (version, 
+        time)}, reading only the test pages index.
+        """
+        sql = "SELECT name, version, time FROM testpageindex"
+        args = []
+        where = []
+
+        if page_prefix is not None:
+            where.append("name LIKE %s ESCAPE '|'")
+            args.append(db_escape_like(page_prefix) + '%')
+
+        result = {}
+        for chunk_where, chunk_args in self._chunk_ids('name', page_names):
+            cursor = self._get_db().cursor()
+            cursor.execute(sql + self._get_where_clause(where + chunk_where), to_list((args, chunk_args)))
+            
+            for name, version, ts in cursor:
+                result[name] = (version, ts)
+            
+        return result
+
+    def load_related_tickets(self, planid=None, page_prefix=None, page_names=None):
+        """
+        Returns the IDs of the tickets opened against the test cases,
+        as a dictionary {page name: [ticket IDs]}, using the related 
+        tickets index.
+        
+        :planid: only load the tickets opened in this test plan.
+        """
+        sql = "SELECT testcase, ticket FROM testcaseticket"
+        args = []
+        where = []
+
+        if page_prefix is not None:
+            where.append("testcase LIKE %s ESCAPE '|'")
+            args.append(db_escape_like(page_prefix) + '%')
+
+        if planid is not None:
+            where.append("planid = %s")
+            args.append(planid)
+
+        result = {}
+        for chunk_where, chunk_args in self._chunk_ids('testcase', page_names):
+            cursor = self._get_db().cursor()
+            cursor.execute(sql + self._get_where_clause(where + chunk_where) + " ORDER BY ticket", to_list((args, chunk_args)))
+            
+            for name, ticket_id in cursor:
+                result.setdefault(name, []).append(ticket_id)
+            
+        return result
+
+    def _get_db(self):
+        if self.db is None:
+            self.db = self.env.get_read_db()
+
+        return self.db
+
+    def _get_where_clause(self, where):
+        if len(where) == 0:
+            return ''
+
+        return " WHERE " + " AND ".join(where)
+
+    def _chunk_ids(self, column, ids):
+        """
+        Yields the additional (where conditions, arguments) to select
+        the specified IDs, split in chunks to keep the number of query
+        parameters bounded.
+        """
+        if ids is None:
+            yield [], []
+            return
+
+        ids = list(ids)
+        for i in range(0, len(ids), self.CHUNK_SIZE):
+            chunk = ids[i:i+self.CHUNK_SIZE]
+            yield [column + " IN (" + ','.join(['%s'] * len(chunk)) + ")"], chunk
+
         
 class TestManagerModelProvider(Component):
     """
@@ -785,7 +1087,7 @@ class TestManagerModelProvider(Component):
     Currently, only 'text' type of custom fields are supported.
     """
 
-    implements(IConcreteClassProvider, IEnvironmentSetupParticipant)
+    implements(IConcreteClassProvider, IEnvironmentSetupParticipant, ITicketChangeListener)
 
     SCHEMA = {
                 'testmanager_templates':  
@@ -814,7 +1116,7 @@ class TestManagerModelProvider(Component):
                               Column('page_name')],
                      'has_custom': True,
                      'has_change': True,
-                     'version': 1},
+                     'version': 2},
                 'testcase':  
                     {'table':
                         Table('testcase', key = ('id'))[
@@ -823,7 +1125,7 @@ class TestManagerModelProvider(Component):
                               Column('exec_order', type='int')],
                      'has_custom': True,
                      'has_change': True,
-                     'version': 2},
+                     'version': 3},
                 'testcaseinplan':  
                     {'table':
                         Table('testcaseinplan', key = ('id', 'planid'))[
@@ -834,7 +1136,7 @@ class TestManagerModelProvider(Component):
                               Column('status')],
                      'has_custom': True,
                      'has_change': True,
-                     'version': 2},
+                     'version': 3},
                 'testcasehistory':  
                     {'table':
                         Table('testcasehistory', key = ('id', 'planid', 'time'))[
@@ -843,10 +1145,11 @@ class TestManagerModelProvider(Component):
                               Column('time', type=get_timestamp_db_type()),
                               Column('author'),
                               Column('status'),
-                              Index(['id', 'planid', 'time'])],
+                              Index(['id', 'planid', 'time']),
+                              Index(['time'])],
                      'has_custom': False,
                      'has_change': False,
-                     'version': 1},
+                     'version': 2},
                 'testplan':
                     {'table':
                         Table('testplan', key = ('id'))[
@@ -862,9 +1165,97 @@ class TestManagerModelProvider(Component):
                               Index(['catid'])],
                      'has_custom': True,
                      'has_change': True,
-                     'version': 2}
+                     'version': 3},
+                'testpageindex':
+                    {'table':
+                        Table('testpageindex', key = ('name'))[
+                              Column('name'),
+                              Column('version', type='int'),
+                              Column('title'),
+                              Column('parent'),
+                              Column('kind'),
+                              Column('author'),
+                              Column('time', type=get_timestamp_db_type()),
+                              Index(['parent']),
+                              Index(['kind'])],
+                     'has_custom': False,
+                     'has_change': False,
+                     'version': 1},
+                'teststatsdaily':
+                    {'table':
+                        Table('teststatsdaily', key = ('day', 'planid'))[
+                              Column('day'),
+                              Column('planid'),
+                              Column('green', type='int'),
+                              Column('yellow', type='int'),
+                              Column('red', type='int'),
+                              Column('green_changes', type='int'),
+                              Column('red_changes', type='int'),
+                              Column('new_tcs', type='int'),
+                              Column('new_tickets', type='int'),
+                              Column('closed_tickets', type='int'),
+                              Index(['planid'])],
+                     'has_custom': False,
+                     'has_change': False,
+                     'version': 1},
+                'testsearchindex':
+                    {'table':
+                        Table('testsearchindex', key = ('realm', 'id', 'planid'))[
+                              Column('realm'),
+                              Column('id'),
+                              Column('planid'),
+                              Column('docid', type='int'),
+                              Column('page_name'),
+                              Column('title'),
+                              Column('body'),
+                              Column('author'),
+                              Column('time', type=get_timestamp_db_type()),
+                              Index(['docid'])],
+                     'has_custom': False,
+                     'has_change': False,
+                     'version': 1},
+                'testsearchterm':
+                    {'table':
+                        Table('testsearchterm', key = ('term', 'realm', 'id', 'planid'))[
+                              Column('term'),
+                              Column('realm'),
+                              Column('id'),
+                              Column('planid'),
+                              Index(['realm', 'id'])],
+                     'has_custom': False,
+                     'has_change': False,
+                     'version': 1},
+                'testcaseticket':
+                    {'table':
+                        Table('testcaseticket', key = ('ticket'))[
+                              Column('ticket', type='int'),
+                              Column('testcase'),
+                              Column('planid'),
+                              Index(['testcase', 'planid']),
+                              Index(['planid'])],
+                     'has_custom': False,
+                     'has_change': False,
+                     'version': 1},
+                'testdeletion':
+                    {'table':
+                        Table('testdeletion', key = ('realm', 'id', 'planid', 'time'))[
+                              Column('realm'),
+                              Column('id'),
+                              Column('planid'),
+                              Column('time', type=get_timestamp_db_type()),
+                              Index(['time'])],
+                     'has_custom': False,
+                     'has_change': False,
+                     'version': 1}
             }
 
+    # The order in which the tables are created. Tables which are 
+    # populated from other ones when created come after them.
+    SCHEMA_ORDER = ('testmanager_templates', 'testconfig', 'testcatalog', 'testcase', 
+                    'testcaseinplan', 'testcasehistory', 'testplan', 'testpageindex', 
+                    'teststatsdaily', 'testsearchindex', 'testsearchterm', 'testcaseticket', 
+                    'testdeletion')
+
     FIELDS = {
                 'testcatalog': [
                     {'name': 'id', 'type': 'text', 'label': N_('ID')},
@@ -971,8 +1362,227 @@ class TestManagerModelProvider(Component):
         if 'TEST_VIEW' not in req.perm:
             raise PermissionError('TEST_VIEW', realm)
             
-        if operation == 'set' and 'TEST_MODIFY' not in req.perm:
-            raise PermissionError('TEST_MODIFY', realm)
+        if operation == 'set':
+            # Test cases in plan are changed while executing the tests
+            if realm == 'testcaseinplan':
+                if 'TEST_EXECUTE' not in req.perm:
+                    raise PermissionError('TEST_EXECUTE', realm)
+                    
+            elif 'TEST_MODIFY' not in req.perm:
+                raise PermissionError('TEST_MODIFY', realm)
+
+
+    # Test pages index methods
+    #
+    # The 'testpageindex' table shadows the latest version of every
+    # test catalog and test case wiki page, so that the catalog trees
+    # can be built without scanning the whole wiki table and loading
+    # the page bodies.
+
+    def is_test_page(self, page_name):
+        """Returns whether the specified wiki page is a test catalog or test case page."""
+
+        return page_name == 'TC' or page_name.startswith('TC_')
+
+    def get_test_page_kind(self, page_name):
+        """
+        Returns the kind of test page: 'root', 'testcatalog' or 'testcase'.
+        """
+        if page_name == 'TC':
+            return 'root'
+
+        if page_name.rpartition('_')[2].startswith('TC'):
+            return 'testcase'
+
+        return 'testcatalog'
+
+    def update_test_page_index(self, page_name, db=None):
+        """
+        Refreshes the index entry for the specified wiki page, reading
+        its latest version from the wiki table.
+        Removes the entry if the page does not exist anymore.
+        """
+        if not self.is_test_page(page_name):
+            return
+
+        @self.env.with_transaction(db)
+        def do_update_test_page_index(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT version, text, author, time FROM wiki
+                    WHERE name = %s ORDER BY version DESC
+                """, (page_name,))
+            row = cursor.fetchone()
+
+            cursor.execute("DELETE FROM testpageindex WHERE name = %s", (page_name,))
+
+            if row is not None:
+                version, text, author, ts = row
+                self._insert_test_page_index_entry(cursor, page_name, version, text, author, ts)
+
+    def remove_from_test_page_index(self, page_name, db=None):
+        """Removes the index entry for the specified wiki page."""
+
+        if not self.is_test_page(page_name):
+            return
+
+        @self.env.with_transaction(db)
+        def do_remove_from_test_page_index(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM testpageindex WHERE name = %s", (page_name,))
+
+    def rebuild_test_page_index(self, db=None):
+        """
+        Rebuilds the whole test pages index from the wiki table.
+        Returns the number of indexed pages.
+        """
+        result = {'count': 0}
+
+        @self.env.with_transaction(db)
+        def do_rebuild_test_page_index(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM testpageindex")
+
+            cursor.execute("""
+                SELECT w1.name, w1.version, w1.text, w1.author, w1.time
+                    FROM wiki w1,
+                        (SELECT name, max(version) AS ver FROM wiki
+                            WHERE name = %s OR name LIKE %s
+                            GROUP BY name) w2
+                    WHERE w1.version = w2.ver AND w1.name = w2.name
+                """, ('TC', 'TC_%'))
+            rows = cursor.fetchall()
+
+            for name, version, text, author, ts in rows:
+                if not self.is_test_page(name):
+                    continue
+
+                self._insert_test_page_index_entry(cursor, name, version, text, author, ts)
+                result['count'] += 1
+
+        self.env.log.info("Test pages index rebuilt: %s pages indexed." % result['count'])
+
+        return result['count']
+
+    def list_indexed_subpages(self, prefix, db=None):
+        """
+        Returns an iterator over (name, title, kind) of all the indexed
+        test pages whose name starts with the specified prefix,
+        sorted by name.
+        """
+        if not db:
+            db = self.env.get_read_db()
+
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT name, title, kind FROM testpageindex
+                WHERE name LIKE %s ORDER BY name
+            """, (prefix+'%',))
+
+        for name, title, kind in cursor:
+            # '_' is a wildcard in LIKE, so double check the prefix
+            if name.startswith(prefix):
+                yield name, title, kind
+
+    def _insert_test_page_index_entry(self, cursor, page_name, version, text, author, ts):
+        parent = ''
+        if page_name != 'TC':
+            parent = page_name.rpartition('_')[0]
+
+        cursor.execute("""
+            INSERT INTO testpageindex (name, version, title, parent, kind, author, time)
+                VALUES (%s,%s,%s,%s,%s,%s,%s)
+            """, (page_name, version, get_page_title(text), parent,
+                self.get_test_page_kind(page_name), author, ts))
+
+
+    # Related tickets index methods
+    #
+    # The 'testcaseticket' table maps every ticket opened against a 
+    # test case or a test plan, as per its 'testcaseid' and 'planid' 
+    # custom fields, so that the tickets of many test cases can be 
+    # looked up at once, without searching 'ticket_custom' by value.
+
+    def update_test_ticket_index(self, ticket_id, testcase, planid, db=None):
+        """
+        Refreshes the index entry for the specified ticket.
+        Removes the entry if the ticket is not related to any test case
+        or test plan anymore.
+        """
+        @self.env.with_transaction(db)
+        def do_update_test_ticket_index(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM testcaseticket WHERE ticket = %s", (ticket_id,))
+
+            if testcase or planid:
+                cursor.execute("INSERT INTO testcaseticket (ticket, testcase, planid) VALUES (%s,%s,%s)",
+                    (ticket_id, testcase or '', planid or ''))
+
+    def rebuild_test_ticket_index(self, db=None):
+        """
+        Rebuilds the whole related tickets index from the ticket custom
+        fields.
+        Returns the number of indexed tickets.
+        """
+        result = {'count': 0}
+
+        @self.env.with_transaction(db)
+        def do_rebuild_test_ticket_index(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM testcaseticket")
+
+            cursor.execute("""
+                SELECT c.ticket, c.name, c.value FROM ticket_custom c
+                    INNER JOIN ticket t ON t.id = c.ticket
+                    WHERE c.name IN ('testcaseid', 'planid') AND c.value <> ''
+                """)
+
+            tickets = {}
+            for ticket_id, name, value in cursor:
+                tickets.setdefault(ticket_id, {'testcaseid': '', 'planid': ''})[name] = value
+
+            cursor.executemany("INSERT INTO testcaseticket (ticket, testcase, planid) VALUES (%s,%s,%s)",
+                [(ticket_id, values['testcaseid'], values['planid']) for ticket_id, values in tickets.iteritems()])
+
+            result['count'] = len(tickets)
+
+        self.env.log.info("Related tickets index rebuilt: %s tickets indexed." % result['count'])
+
+        return result['count']
+
+    def _invalidate_ticket_data_models(self, testcase, planid):
+        """
+        Invalidates the cached data models, and so the views, showing 
+        the tickets count of the specified test case page, or of the 
+        specified test plan if the ticket is not related to a test case.
+        """
+        page_name = testcase
+        if not page_name and planid:
+            cursor = self.env.get_read_db().cursor()
+            cursor.execute("SELECT page_name FROM testplan WHERE id = %s", (planid,))
+            row = cursor.fetchone()
+            page_name = row and row[0]
+
+        if page_name:
+            from testmanager.api import TestManagerSystem
+            TestManagerSystem(self.env).invalidate_test_catalog_data_models(page_name)
+
+    # ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        self.update_test_ticket_index(ticket.id, ticket.values.get('testcaseid'), ticket.values.get('planid'))
+        self._invalidate_ticket_data_models(ticket.values.get('testcaseid'), ticket.values.get('planid'))
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if 'testcaseid' in old_values or 'planid' in old_values:
+            self.update_test_ticket_index(ticket.id, ticket.values.get('testcaseid'), ticket.values.get('planid'))
+            
+            self._invalidate_ticket_data_models(old_values.get('testcaseid', ticket.values.get('testcaseid')), 
+                old_values.get('planid', ticket.values.get('planid')))
+            self._invalidate_ticket_data_models(ticket.values.get('testcaseid'), ticket.values.get('planid'))
+
+    def ticket_deleted(self, ticket):
+        self.update_test_ticket_index(ticket.id, None, None)
+        self._invalidate_ticket_data_models(ticket.values.get('testcaseid'), ticket.values.get('planid'))
 
 
     # IEnvironmentSetupParticipant methods
@@ -997,14 +1607,38 @@ class TestManagerModelProvider(Component):
         # Create or update db
         @self.env.with_transaction(db)
         def do_upgrade_environment(db):
-            for realm in self.SCHEMA:
+            created = []
+            
+            for realm in self.SCHEMA_ORDER:
                 realm_schema = self.SCHEMA[realm]
 
                 if need_db_create_for_realm(self.env, realm, realm_schema, db):
                     create_db_for_realm(self.env, realm, realm_schema, db)
+                    created.append(realm)
 
                 elif need_db_upgrade_for_realm(self.env, realm, realm_schema, db):
                     upgrade_db_for_realm(self.env, 'testmanager.upgrades', realm, realm_schema, db)
+
+            # Populate the new tables only once all the tables they are
+            # built from exist
+            if 'testpageindex' in created:
+                # Index the already existing test pages
+                self.rebuild_test_page_index(db)
+
+            if 'teststatsdaily' in created:
+                # Roll up the already existing history
+                from testmanager.stats import DailyStatsRollup
+                DailyStatsRollup(self.env).rebuild(db)
+
+            if 'testsearchindex' in created or 'testsearchterm' in created:
+                # Index the already existing test objects, after the 
+                # test pages index they are read from
+                from testmanager.search import TestSearchIndex
+                TestSearchIndex(self.env).rebuild(db)
+
+            if 'testcaseticket' in created:
+                # Index the already existing tickets
+                self.rebuild_test_ticket_index(db)
                     
             # Create default values for configuration properties and initialize counters
             db_insert_or_ignore(self.env, 'testconfig', 'NEXT_CATALOG_ID', '0', db)
@@ -26,11 +26,12 @@ from datetime import datetime
 from trac.core import *
 from trac.util import get_reporter_id
     
-from tracgenericclass.model import GenericClassModelProvider
-from tracgenericclass.util import formatExceptionInfo
+from tracgenericclass.model import GenericClassModelProvider, UnitOfWork
+from tracgenericclass.util import db_escape_like, formatExceptionInfo
 
 from testmanager.api import TestManagerSystem
-from testmanager.model import TestCatalog, TestCase, TestCaseInPlan, TestPlan
+from testmanager.model import TestCatalog, TestCase, TestCaseInPlan, TestPlan, BulkLoader
+from testmanager.util import get_page_title, get_page_description
 
 try:
     # Check that tracrpc plugin is available. Otherwise, an ImportError exception will be raised.
@@ -61,6 +62,12 @@ try:
             yield ('TEST_VIEW', ((list, str, str),), self.getTestPlan)
             yield ('TEST_VIEW', ((list, str),), self.listSubCatalogs)
             yield ('TEST_VIEW', ((list, str),), self.listTestPlans)
+            yield ('TEST_MODIFY', ((list, str, list),), self.createTestCases)
+            yield (None, ((list, list),), self.modifyTestObjects)
+            yield ('TEST_EXECUTE', ((list, list),), self.setTestCaseStatuses)
+            yield ('TEST_VIEW', ((list, list),(list, list, str)), self.getTestCases)
+            yield ('TEST_VIEW', ((dict, str),(dict, str, str),(dict, str, str, bool),(dict, str, str, bool, list),(dict, str, str, bool, list, str),(dict, str, str, bool, list, str, int)), self.listTestCasesPaged)
+            yield ('TEST_VIEW', ((dict,),(dict, str),(dict, str, list),(dict, str, list, int)), self.getChanges)
 
         def createTestCatalog(self, req, parent_catalog_id, title, description):
             """ Creates a new test catalog, in the parent catalog specified, 
@@ -260,6 +267,326 @@ try:
 
             return True
                 
+        def createTestCases(self, req, catalog_id, testcases):
+            """ Creates many new test cases in the catalog specified, in
+            a single transaction.
+            Each input test case is in the form, all strings:
+                (title, description)
+            Returns the list of the generated object IDs, in the same 
+            order as the input, or '-1' for the test cases which could 
+            not be created. """
+            
+            result = ['-1'] * len(testcases)
+            try:
+                if catalog_id is None or catalog_id == '':
+                    self.env.log.error("Cannot create a test case on the root catalog container.")
+                    return result
+                
+                # Check catalog really exists, and get its page_name
+                tcat = TestCatalog(self.env, catalog_id)
+                if not tcat.exists:
+                    self.env.log.error("Input test catalog with ID %s not found." % catalog_id)
+                    return result
+                
+                author = get_reporter_id(req, 'author')
+
+                # Reserve all the IDs and positions in the catalog at once
+                ids = self.testmanagersys.get_next_ids('testcase', len(testcases))
+                last_order = tcat.get_last_order()
+
+                uow = UnitOfWork(self.env)
+                for i, (title, description) in enumerate(testcases):
+                    new_tc = TestCase(self.env, title=title, description=description)
+                    new_tc.set_loaded_values({'id': ids[i], 'page_name': tcat['page_name'] + '_TC' + ids[i], 'exec_order': last_order + 1 + i}, exists=False)
+                    new_tc.enclosing_catalog = tcat
+                    new_tc.author = author
+                    new_tc.remote_addr = req.remote_addr
+                    uow.register_new(new_tc)
+
+                # This also creates the Wiki pages
+                uow.flush(author)
+                result = ids
+                
+            except:
+                self.env.log.error("Error adding %s test cases in catalog with ID %s!" % (len(testcases), catalog_id))
+                self.env.log.error(formatExceptionInfo())
+                
+                # The whole transaction has been rolled back
+                result = ['-1'] * len(testcases)
+            
+            return result
+
+        def modifyTestObjects(self, req, objects):
+            """ Modifies many test objects in a single transaction.
+            Each input object is in the form:
+                (objtype, id, attributes)
+            where attributes is a dictionary of the properties to change,
+            as in modifyTestObject.
+            Returns a list of booleans, in the same order as the input,
+            telling whether each object has been modified. """
+
+            result = [False] * len(objects)
+            try:
+                author = get_reporter_id(req, 'author')
+
+                uow = UnitOfWork(self.env)
+                for i, (objtype, id, attributes) in enumerate(objects):
+                    obj = self._get_test_object(req, objtype, id)
+                    if obj is None:
+                        continue
+
+                    for k, v in attributes.iteritems():
+                        if k == 'title':
+                            obj.title = v
+                        elif k == 'description':
+                            obj.description = v
+                        else:
+                            obj[k] = v
+                        
+                    obj.author = author
+                    obj.remote_addr = req.remote_addr
+                    uow.register_dirty(obj)
+                    result[i] = True
+
+                uow.flush(author, "Changed through RPC.")
+
+            except:
+                self.env.log.error("Error modifying %s test objects." % len(objects))
+                self.env.log.error(formatExceptionInfo())
+                return [False] * len(objects)
+            
+            return result
+
+        def setTestCaseStatuses(self, req, statuses):
+            """ Sets the status of many test cases, in a single 
+            transaction.
+            Each input status is in the form, all strings:
+                (testcase_id, plan_id, status)
+            Returns a list of booleans, in the same order as the input,
+            telling whether each status has been set. """
+            
+            result = [False] * len(statuses)
+            try:
+                author = get_reporter_id(req, 'author')
+                
+                # Look up the page names of all the test cases at once
+                tc_pages = self._get_testcase_page_names([s[0] for s in statuses])
+
+                found = []
+                for i, (testcase_id, plan_id, status) in enumerate(statuses):
+                    if testcase_id not in tc_pages:
+                        self.env.log.error("Input test case with ID %s not found." % testcase_id)
+                        continue
+                        
+                    found.append(i)
+
+                self.testmanagersys.set_testcase_statuses(
+                    [(statuses[i][0], statuses[i][1], tc_pages[statuses[i][0]], statuses[i][2]) for i in found], 
+                    author, req.remote_addr)
+
+                for i in found:
+                    result[i] = True
+
+            except:
+                self.env.log.error("Error setting the status of %s test cases!" % len(statuses))
+                self.env.log.error(formatExceptionInfo())
+                return [False] * len(statuses)
+
+            return result
+
+        def getTestCases(self, req, testcase_ids, plan_id=''):
+            """ Returns the properties of many test cases, reading them
+            with a constant number of queries.
+            If plan_id is provided, also the status of the test cases in
+            the plan will be returned.
+            Each result is in the same form as in getTestCase, and in 
+            the same order as the input IDs. An empty result is returned
+            for the test cases not found. """
+
+            result = []
+            try:
+                tc_pages = self._get_testcase_page_names(testcase_ids)
+                texts = BulkLoader(self.env).load_page_texts(page_names=tc_pages.values())
+                
+                if plan_id is not None and plan_id != '':
+                    default_status = self.testmanagersys.get_default_tc_status()
+                    tc_statuses = dict(self._get_testcaseinplan_statuses(plan_id, tc_pages.keys()))
+                
+                for testcase_id in testcase_ids:
+                    if testcase_id not in tc_pages:
+                        self.env.log.error("Input test case with ID %s not found." % testcase_id)
+                        result.append(())
+                        continue
+                    
+                    page_name = tc_pages[testcase_id]
+                    text = texts.get(page_name, '')
+                    
+                    if plan_id is None or plan_id == '':
+                        result.append((page_name, get_page_title(text), get_page_description(text)))
+                    else:
+                        result.append((page_name, get_page_title(text), get_page_description(text), 
+                            tc_statuses.get(testcase_id, default_status)))
+
+            except:
+                self.env.log.error("Error getting %s test cases!" % len(testcase_ids))
+                self.env.log.error(formatExceptionInfo())
+                
+            return result
+
+        LIST_PAGE_SIZE = 500
+        LIST_MAX_PAGE_SIZE = 5000
+
+        def listTestCasesPaged(self, req, catalog_id, plan_id='', deep=False, fields=[], cursor='', limit=LIST_PAGE_SIZE):
+            """ Returns a page of the test cases in the specified catalog,
+            ordered by wiki page name.
+            If deep is True, also the test cases in all the sub-catalogs
+            are returned.
+            The fields argument is the list of the properties to return 
+            for each test case, in addition to 'id' and 'page_name'. 
+            Supported fields are 'title', 'description', 'exec_order',
+            any custom field and, if plan_id is provided, 'status'. 
+            Descriptions are only read if requested.
+            To get the following pages, pass back the returned cursor.
+            The result is in the form:
+                {'testcases': [{'id': ..., 'page_name': ..., ...}, ...],
+                 'cursor': next page cursor, or '' after the last page} """
+
+            result = {'testcases': [], 'cursor': ''}
+            try:
+                # Check catalog really exists
+                tcat = TestCatalog(self.env, catalog_id)
+                if not tcat.exists:
+                    self.env.log.error("Input test catalog with ID %s not found." % catalog_id)
+                    return result
+
+                limit = max(1, min(int(limit), self.LIST_MAX_PAGE_SIZE))
+                
+                if deep:
+                    page_filters = [db_escape_like(tcat['page_name'] + '_') + '%', '%' + db_escape_like('_TC') + '%']
+                else:
+                    page_filters = [db_escape_like(tcat['page_name'] + '_TC') + '%']
+                
+                db = self.env.get_read_db()
+                cursor_ = db.cursor()
+                cursor_.execute("SELECT id, page_name, exec_order FROM testcase WHERE " + 
+                    " AND ".join(["page_name LIKE %s ESCAPE '|'"] * len(page_filters)) +
+                    " AND page_name > %s ORDER BY page_name LIMIT %s", 
+                    page_filters + [cursor, limit + 1])
+                rows = cursor_.fetchall()
+                
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    result['cursor'] = rows[-1][1]
+
+                ids = [row[0] for row in rows]
+                loader = BulkLoader(self.env, db)
+                
+                texts = {}
+                if 'title' in fields or 'description' in fields:
+                    texts = loader.load_page_texts(page_names=[row[1] for row in rows])
+
+                custom_names = [f['name'] for f in GenericClassModelProvider(self.env).get_custom_fields('testcase') if f['name'] in fields]
+                custom_values = {}
+                if len(custom_names) > 0:
+                    custom_values = loader.load_custom_values('testcase', ids=ids)
+
+                has_plan = plan_id is not None and plan_id != ''
+                if has_plan:
+                    default_status = self.testmanagersys.get_default_tc_status()
+                    tc_statuses = dict(self._get_testcaseinplan_statuses(plan_id, ids))
+                
+                for id, page_name, exec_order in rows:
+                    tc = {'id': id, 'page_name': page_name}
+                    
+                    if 'title' in fields:
+                        tc['title'] = get_page_title(texts.get(page_name, ''))
+                    if 'description' in fields:
+                        tc['description'] = get_page_description(texts.get(page_name, ''))
+                    if 'exec_order' in fields:
+                        tc['exec_order'] = exec_order
+                    if 'status' in fields and has_plan:
+                        tc['status'] = tc_statuses.get(id, default_status)
+                        
+                    for name in custom_names:
+                        tc[name] = custom_values.get(id, {}).get(name) or ''
+                        
+                    result['testcases'].append(tc)
+                
+            except:
+                self.env.log.error("Error listing the test cases in the catalog with ID %s!" % catalog_id)
+                self.env.log.error(formatExceptionInfo())
+                
+            return result
+
+        def getChanges(self, req, cursor='', realms=[], limit=LIST_PAGE_SIZE):
+            """ Returns a page of the changes to the test objects made 
+            after the specified cursor, ordered by time.
+            Pass an empty cursor to start from the beginning, then the 
+            returned cursor to get the following changes. Optionally,
+            only the changes to the specified realms are returned.
+            Deleted objects are reported as changes to the 'deleted' 
+            field.
+            The result is in the form:
+                {'changes': [{'realm': ..., 'key': {...}, 'time': ...,
+                              'author': ..., 'field': ..., 
+                              'oldvalue': ..., 'newvalue': ...}, ...],
+                 'cursor': cursor to get the following changes} """
+
+            limit = max(1, min(int(limit), self.LIST_MAX_PAGE_SIZE))
+            
+            changes, next_cursor = self.testmanagersys.list_changes(cursor, realms, limit)
+            
+            return {'changes': changes, 'cursor': next_cursor}
+
+        def _get_test_object(self, req, objtype, id, db=None):
+            """ Returns the existing test object of the specified type 
+            identified by the given id, checking the user permissions,
+            or None if not found. """
+
+            obj = None
+            if objtype == 'testcatalog':
+                req.perm.require('TEST_MODIFY')
+                obj = TestCatalog(self.env, id, db=db)
+            elif objtype == 'testcase':
+                req.perm.require('TEST_MODIFY')
+                obj = TestCase(self.env, id, db=db)
+            elif objtype == 'testplan':
+                req.perm.require('TEST_PLAN_ADMIN')
+                obj = TestPlan(self.env, id, db=db)
+
+            if obj is None or not obj.exists:
+                self.env.log.error("Input test object of type %s with ID %s not found." % (objtype, id))
+                return None
+                
+            return obj
+
+        def _get_testcase_page_names(self, testcase_ids):
+            """ Returns the page names of the specified test cases, as 
+            a dictionary {id: page_name}. """
+
+            return dict(self._select_by_ids("SELECT id, page_name FROM testcase WHERE %s", (), testcase_ids))
+
+        def _get_testcaseinplan_statuses(self, plan_id, testcase_ids):
+            """ Returns an iterator over the (id, status) of the 
+            specified test cases which are in the test plan. """
+
+            return self._select_by_ids("SELECT id, status FROM testcaseinplan WHERE planid=%%s AND %s", (plan_id,), testcase_ids)
+
+        def _select_by_ids(self, sql, args, ids):
+            """ Runs the query for the specified IDs, in chunks to keep 
+            the number of query parameters bounded. 
+            The query must contain a '%s' placeholder for the IDs 
+            condition. """
+
+            ids = list(set(ids))
+            db = self.env.get_read_db()
+            for i in range(0, len(ids), BulkLoader.CHUNK_SIZE):
+                chunk = ids[i:i+BulkLoader.CHUNK_SIZE]
+                cursor = db.cursor()
+                cursor.execute(sql % ("id IN (" + ','.join(['%s'] * len(chunk)) + ")"), list(args) + chunk)
+                for row in cursor:
+                    yield row
+
         def getTestCatalog(self, req, catalog_id):
             """ Returns the catalog properties.
             The result is in the form, all strings:
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010-2012 Roberto Longobardi
+# 
+# This file is part of the Test Manager plugin for Trac.
+# 
+# The Test Manager plugin for Trac is free software: you can 
+# redistribute it and/or modify it under the terms of the GNU 
+# General Public License as published by the Free Software Foundation, 
+# either version 3 of the License, or (at your option) any later 
+# version.
+# 
+# The Test Manager plugin for Trac is distributed in the hope that it 
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied 
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with the Test Manager plugin for Trac. See the file LICENSE.txt. 
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import re
+
+from datetime import datetime
+
+from trac.core import *
+from trac.search.api import shorten_result
+from trac.util.datefmt import utc
+from trac.wiki.api import IWikiChangeListener
+
+from tracgenericclass.api import IGenericObjectBatchChangeListener
+from tracgenericclass.model import GenericClassModelProvider
+from tracgenericclass.util import *
+
+from testmanager.model import TestCatalog, TestCase, BulkLoader, TestManagerModelProvider
+from testmanager.util import *
+
+try:
+    from testmanager.api import _, tag_, N_
+except ImportError:
+	from trac.util.translation import _, N_
+	tag_ = _
+
+
+class TestSearchIndex(Component):
+    """
+    Maintains a full text search index over the test catalogs, test 
+    cases, test plans and test cases in plans, so that searching does 
+    not need to scan the whole wiki.
+    
+    The 'testsearchindex' table holds one document per object, with its
+    title and a body made of its description, its text custom fields 
+    and, for the test cases in plans, their status.
+    
+    Documents are searched through an SQLite FTS5 table when available,
+    or otherwise through the 'testsearchterm' inverted index of the
+    words they contain. Search terms match words by prefix.
+    
+    The index is updated as the objects change, and can be rebuilt from 
+    scratch with the 'testmanager search rebuild' trac-admin command.
+    """
+
+    implements(IGenericObjectBatchChangeListener, IWikiChangeListener)
+    
+    REALMS = ('testcatalog', 'testcase', 'testplan', 'testcaseinplan')
+    
+    CHUNK_SIZE = 500
+    
+    words_re = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, *args, **kwargs):
+        Component.__init__(self, *args, **kwargs)
+
+        self._fts = None
+
+    # IGenericObjectBatchChangeListener methods
+    def objects_changed(self, changes):
+        @self.env.with_transaction()
+        def do_update_index(db):
+            for change in changes:
+                obj = change.g_object
+                
+                if change.action == 'deleted':
+                    if change.realm == 'testcaseinplan':
+                        self._remove_documents(db, change.realm, obj['id'], obj['planid'])
+                    else:
+                        self._remove_documents(db, change.realm, obj['id'])
+                    
+                    # Test cases in plan are deleted along with their
+                    # test case or plan, without notification
+                    if change.realm == 'testcase':
+                        self._remove_documents(db, 'testcaseinplan', obj['id'])
+                    elif change.realm == 'testplan':
+                        self._remove_documents(db, 'testcaseinplan', planid=obj['id'])
+                        
+                elif change.realm in self.REALMS:
+                    self._index_object(db, change.realm, obj, change.author)
+
+    # IWikiChangeListener methods
+    def wiki_page_added(self, page):
+        pass
+
+    def wiki_page_changed(self, page, version, t, comment, author, ipnr):
+        self._index_test_page(page.name)
+
+    def wiki_page_deleted(self, page):
+        pass
+
+    def wiki_page_version_deleted(self, page):
+        self._index_test_page(page.name)
+
+    def wiki_page_renamed(self, page, old_name): 
+        pass
+
+    def _index_test_page(self, page_name):
+        """
+        Reindexes a test catalog or test case after its wiki page has 
+        been edited directly.
+        """
+        provider = TestManagerModelProvider(self.env)
+        if not provider.is_test_page(page_name):
+            return
+            
+        kind = provider.get_test_page_kind(page_name)
+        
+        if kind == 'testcatalog':
+            obj = TestCatalog(self.env, page_name.rpartition('_TT')[2])
+        elif kind == 'testcase':
+            obj = TestCase(self.env, page_name.rpartition('_TC')[2])
+        else:
+            return
+
+        if obj.exists and obj['page_name'] == page_name:
+            @self.env.with_transaction()
+            def do_index_test_page(db):
+                self._index_object(db, kind, obj)
+
+    # Search
+    def get_search_results(self, req, realm, terms):
+        """
+        Returns the Trac search results for the objects of the specified
+        realm containing all of the specified terms, and whose wiki 
+        page the user can view.
+        """
+        if 'TEST_VIEW' not in req.perm:
+            return
+            
+        words = []
+        for term in terms:
+            words.extend(self._get_words(term))
+
+        if len(words) == 0:
+            return
+            
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        
+        if self._has_fts(db):
+            cursor.execute("""
+                SELECT i.id, i.planid, i.page_name, i.title, i.body, i.author, i.time 
+                    FROM testsearchfts f INNER JOIN testsearchindex i ON i.docid = f.rowid
+                    WHERE testsearchfts MATCH %s AND i.realm = %s
+                """, (' '.join(['"%s"*' % w.replace('"', '""') for w in words]), realm))
+            rows = cursor.fetchall()
+        
+        else:
+            keys = None
+            for word in words:
+                cursor.execute("""
+                    SELECT DISTINCT id, planid FROM testsearchterm 
+                        WHERE realm = %s AND term LIKE %s ESCAPE '|'
+                    """, (realm, db_escape_like(word) + '%'))
+                
+                matching = set(cursor.fetchall())
+                if keys is None:
+                    keys = matching
+                else:
+                    keys &= matching
+                    
+                if len(keys) == 0:
+                    return
+
+            rows = []
+            ids = list(set([id for id, planid in keys]))
+            for i in range(0, len(ids), self.CHUNK_SIZE):
+                chunk = ids[i:i+self.CHUNK_SIZE]
+                cursor.execute("""
+                    SELECT id, planid, page_name, title, body, author, time FROM testsearchindex 
+                        WHERE realm = %s AND id IN (""" + ','.join(['%s'] * len(chunk)) + ")", 
+                    to_list((realm, chunk)))
+                rows.extend([row for row in cursor if (row[0], row[1]) in keys])
+
+        for id, planid, page_name, title, body, author, ts in rows:
+            # As the wiki search does, for fine-grained permissions
+            if 'WIKI_VIEW' not in req.perm('wiki', page_name):
+                continue
+                
+            if realm == 'testplan':
+                href = req.href.wiki(page_name, planid=id)
+            elif realm == 'testcaseinplan':
+                href = req.href.wiki(page_name, planid=planid)
+            else:
+                href = req.href.wiki(page_name)
+
+            yield (href, title, from_any_timestamp(ts), author, shorten_result(body, terms))
+
+    def get_match_condition(self, db, realm, column, term):
+        """
+        Returns an SQL condition, along with its arguments, matching the
+        rows whose specified ID column is the ID of an object of the 
+        realm containing words starting with those in the term, or None
+        if the term contains no words.
+        """
+        words = self._get_words(term)
+        if len(words) == 0:
+            return None
+            
+        if self._has_fts(db):
+            return ("""%s IN (SELECT i.id FROM testsearchfts f INNER JOIN testsearchindex i ON i.docid = f.rowid 
+                    WHERE testsearchfts MATCH %%s AND i.realm = %%s)""" % column,
+                [' '.join(['"%s"*' % w.replace('"', '""') for w in words]), realm])
+
+        # A range rather than a LIKE, so that the prefix is looked up 
+        # in the terms index
+        conditions = []
+        args = []
+        for word in words:
+            conditions.append("%s IN (SELECT id FROM testsearchterm WHERE term >= %%s AND term < %%s AND realm = %%s)" % column)
+            args.extend([word, word + u'\uffff', realm])
+            
+        return ' AND '.join(conditions), args
+
+    # Index maintenance
+    def rebuild(self, db=None):
+        """
+        Rebuilds the whole index from the test objects. Returns the 
+        number of documents indexed.
+        """
+        result = {'count': 0}
+        
+        @self.env.with_transaction(db)
+        def do_rebuild(db):
+            cursor = db.cursor()
+            
+            cursor.execute("DELETE FROM testsearchindex")
+            cursor.execute("DELETE FROM testsearchterm")
+            
+            self._fts = None
+            if self._is_sqlite():
+                try:
+                    cursor.execute("DROP TABLE IF EXISTS testsearchfts")
+                    cursor.execute("CREATE VIRTUAL TABLE testsearchfts USING fts5(title, body, tokenize = 'unicode61 remove_diacritics 0')")
+                except:
+                    self.env.log.info("SQLite FTS5 not available, using the search terms table.")
+                    self._fts = False
+
+            loader = BulkLoader(self.env, db)
+            texts = loader.load_page_texts(page_prefix='TC_')
+            
+            pages = {}
+            cursor.execute("SELECT name, title, author, time FROM testpageindex")
+            for name, title, author, ts in cursor.fetchall():
+                pages[name] = (title, author, ts)
+
+            for realm in ('testcatalog', 'testcase'):
+                custom_values = loader.load_custom_values(realm)
+                
+                cursor.execute("SELECT id, page_name FROM %s" % realm)
+                for id, page_name in cursor.fetchall():
+                    title, author, ts = pages.get(page_name, ('', '', None))
+                    body = [get_page_description(texts.get(page_name, ''))]
+                    body.extend(self._get_custom_texts(realm, custom_values.get(id, {})))
+                    
+                    self._add_document(db, realm, id, '', page_name, title, body, author, ts)
+                    result['count'] += 1
+
+            custom_values = loader.load_custom_values('testplan')
+            
+            cursor.execute("SELECT id, page_name, name, author, time FROM testplan")
+            for id, page_name, name, author, ts in cursor.fetchall():
+                body = self._get_custom_texts('testplan', custom_values.get(id, {}))
+                
+                self._add_document(db, 'testplan', id, '', page_name, name, body, author, ts)
+                result['count'] += 1
+
+            # The custom values of the test cases in plan are per plan
+            custom_values = {}
+            cursor.execute("SELECT id, planid, name, value FROM testcaseinplan_custom")
+            for id, planid, name, value in cursor:
+                custom_values.setdefault((id, planid), {})[name] = value
+
+            history = {}
+            cursor.execute("SELECT id, planid, MAX(time) FROM testcasehistory GROUP BY id, planid")
+            for id, planid, ts in cursor:
+                history[(id, planid)] = ts
+            
+            cursor.execute("SELECT id, planid, page_name, status FROM testcaseinplan")
+            for id, planid, page_name, status in cursor.fetchall():
+                title, author, ts = pages.get(page_name, ('', '', None))
+                body = [status or '']
+                body.extend(self._get_custom_texts('testcaseinplan', custom_values.get((id, planid), {})))
+
+                self._add_document(db, 'testcaseinplan', id, planid, page_name, title, body, '', history.get((id, planid)))
+                result['count'] += 1
+
+        return result['count']
+
+    def _index_object(self, db, realm, obj, author=None):
+        if realm == 'testcaseinplan':
+            self._remove_documents(db, realm, obj['id'], obj['planid'])
+        else:
+            self._remove_documents(db, realm, obj['id'])
+
+        body = self._get_custom_texts(realm, obj.values)
+        ts = to_any_timestamp(datetime.now(utc))
+        
+        if realm in ('testcatalog', 'testcase'):
+            body.insert(0, obj.description or '')
+            self._add_document(db, realm, obj['id'], '', obj['page_name'], obj.title or '', body, 
+                getattr(obj, 'author', None) or author or '', ts)
+            
+        elif realm == 'testplan':
+            self._add_document(db, realm, obj['id'], '', obj['page_name'], obj['name'] or '', body, 
+                obj['author'] or '', to_any_timestamp(obj['time']))
+                
+        elif realm == 'testcaseinplan':
+            cursor = db.cursor()
+            cursor.execute("SELECT title FROM testpageindex WHERE name = %s", (obj['page_name'],))
+            row = cursor.fetchone()
+            
+            body.insert(0, obj['status'] or '')
+            self._add_document(db, realm, obj['id'], obj['planid'], obj['page_name'], row and row[0] or '', body, 
+                author or '', ts)
+
+    def _add_document(self, db, realm, id, planid, page_name, title, body, author, ts):
+        title = title or ''
+        body = '\n'.join([text for text in body if text])
+
+        cursor = db.cursor()
+        
+        docid = None
+        if self._has_fts(db):
+            cursor.execute("INSERT INTO testsearchfts (title, body) VALUES (%s, %s)", (title, body))
+            cursor.execute("SELECT last_insert_rowid()")
+            docid = cursor.fetchone()[0]
+        else:
+            words = set(self._get_words(title) + self._get_words(body))
+            cursor.executemany("INSERT INTO testsearchterm (term, realm, id, planid) VALUES (%s, %s, %s, %s)",
+                [(word, realm, id, planid) for word in words])
+        
+        cursor.execute("""
+            INSERT INTO testsearchindex (realm, id, planid, docid, page_name, title, body, author, time) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (realm, id, planid, docid, page_name, title, body, author, ts))
+
+    def _remove_documents(self, db, realm, id=None, planid=None):
+        where = "realm = %s"
+        args = [realm]
+        
+        if id is not None:
+            where += " AND id = %s"
+            args.append(id)
+            
+        if planid is not None:
+            where += " AND planid = %s"
+            args.append(planid)
+            
+        cursor = db.cursor()
+
+        if self._has_fts(db):
+            cursor.execute("DELETE FROM testsearchfts WHERE rowid IN (SELECT docid FROM testsearchindex WHERE " + where + ")", args)
+        else:
+            cursor.execute("DELETE FROM testsearchterm WHERE " + where, args)
+
+        cursor.execute("DELETE FROM testsearchindex WHERE " + where, args)
+
+    def _get_custom_texts(self, realm, values):
+        return [values.get(f['name']) or '' for f in GenericClassModelProvider(self.env).get_custom_fields_for_realm(realm) 
+            if f['type'] in ('text', 'textarea')]
+
+    def _get_words(self, text):
+        return [word.lower() for word in self.words_re.findall(text or '')]
+
+    def _is_sqlite(self):
+        return self.config.get('trac', 'database', '').startswith('sqlite:')
+
+    def _has_fts(self, db):
+        """Returns whether the FTS5 table is being used."""
+        if self._fts is None:
+            self._fts = False
+            
+            if self._is_sqlite():
+                cursor = db.cursor()
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'testsearchfts'")
+                self._fts = cursor.fetchone() is not None
+
+        return self._fts
+
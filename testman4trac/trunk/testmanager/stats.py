@@ -24,9 +24,14 @@
 # by Prentice Wongvibulisn
 #
 
+import csv
+import json
 import re
+import threading
+import uuid
 
 from datetime import date, datetime, time, timedelta
+from StringIO import StringIO
 from time import strptime
 
 from genshi.builder import tag
@@ -52,14 +57,23 @@ except ImportError:
 compatibility = True
 
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from trac.util.datefmt import utc
 from trac.web import IRequestHandler
 from trac.web.chrome import Chrome, INavigationContributor, ITemplateProvider, add_script_data
 from trac.perm import IPermissionRequestor
+from trac.ticket.api import ITicketChangeListener
+from trac.wiki.api import IWikiChangeListener
 
+from tracgenericclass.api import IGenericObjectChangeListener
 from tracgenericclass.util import *
 
 from testmanager.api import TestManagerSystem
-from testmanager.model import TestPlan
+from testmanager.model import TestPlan, TestManagerModelProvider
 from testmanager.util import *
 
 
@@ -80,6 +94,15 @@ class TestStatsPlugin(Component):
     default_days_back = TESTMANAGER_DEFAULT_DAYS_BACK
     default_interval = TESTMANAGER_DEFAULT_INTERVAL
 
+    def __init__(self, *args, **kwargs):
+        Component.__init__(self, *args, **kwargs)
+        
+        # Cache of the computed statistics, with hit/miss counters
+        self._cache = LRUCache(self.config.getint('testmanager', 'stats.cache_size', 100))
+        self._cache_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+
     # ==[ INavigationContributor methods ]==
 
     def get_active_navigation_item(self, req):
@@ -125,87 +148,592 @@ class TestStatsPlugin(Component):
         return count
 
 
-    def _get_num_tcs_by_status(self, from_date, at_date, status, testplan, req):
+    def _get_pie_chart_values(self, beginning, today, catpath, testplan, testplan_contains_all, tc_statuses, req):
         '''
-        Returns an integer of the number of test cases that had the
-        specified status between from_date to at_date.
+        Returns the number of successful, failed and to be tested test
+        cases.
         '''
+        # All the statuses are counted at once, whatever the number 
+        # of outcomes configured
+        status_counts = self._get_num_tcs_by_all_statuses(beginning, today, testplan, req)
+    
+        num_successful = 0
+        for tc_outcome in tc_statuses['green']:
+            num_successful += status_counts.get(tc_outcome, 0)
+
+        num_failed = 0
+        for tc_outcome in tc_statuses['red']:
+            num_failed += status_counts.get(tc_outcome, 0)
+
+        num_to_be_tested = 0
+        if testplan_contains_all:
+            num_to_be_tested = self._get_num_testcases(beginning, today, catpath, req) - num_successful - num_failed
+        else:
+            for tc_outcome in tc_statuses['yellow']:
+                num_to_be_tested += status_counts.get(tc_outcome, 0)
+
+        return num_successful, num_failed, num_to_be_tested
+
+    def _get_chart_values(self, chart, beginning, points, catpath, testplan, testplan_contains_all, tc_statuses):
+        '''
+        Returns the values of the 'testcase' or 'ticket' chart for each
+        of the specified points.
+        '''
+        # All the points are computed in a single pass over the history
+        if chart == 'ticket':
+            if self.config.get('testmanager', 'stats.daily_rollup', '') == 'True':
+                return self._get_ticket_chart_values_from_dailies(beginning, points, testplan)
+            
+            return self._get_ticket_chart_values(beginning, points, testplan)
+        else:
+            # Handling custom test case outcomes here
+            return self._get_testcase_chart_values(points, catpath, testplan, testplan_contains_all, tc_statuses)
+
+    def _get_points(self, from_date, at_date, graph_res):
+        '''
+        Returns the list of contiguous (from date, to date) points of a
+        chart, every graph_res days.
+        '''
+        # Calculate 0th point 
+        last_date = from_date - timedelta(graph_res)
+
+        # Calculate remaining points
+        points = []
+        for cur_date in daterange(from_date, at_date, graph_res):
+            points.append((last_date, cur_date))
+            last_date = cur_date
+
+        return points
+
+    # ==[ Statistics API ]==
+
+    API_METRICS = {
+        'testcase': ('new_tcs', 'successful', 'failed', 'all_tcs', 'all_successful', 'all_untested', 'all_failed'),
+        'ticket': ('tot_tickets', 'active_tickets', 'closed_tickets')
+        }
+
+    def _process_api_request(self, req):
+        '''
+        Returns the chart statistics in JSON or CSV format, for external
+        tools. Parameters:
         
-        db = self.env.get_read_db()
-        cursor = db.cursor()
+          plan:       test plan IDs, each one giving a series. Can be 
+                      repeated or comma separated.
+          catalog:    catalog page names, each one giving a series of
+                      statistics over all the test plans.
+          from, to:   the date range, in the user's date format. 
+                      Defaults to the last default_days_back days.
+          resolution: the number of days of each point.
+          metrics:    comma separated metric names, defaults to all.
+          format:     'json' (default) or 'csv'.
+          
+        Without plans and catalogs, a single series covers the whole
+        environment. Rows are streamed as they are computed.
+        '''
+        req.perm.require('TEST_STATS_VIEW')
+        
+        tc_statuses = TestManagerSystem(self.env).get_tc_statuses_by_color()
 
-        if testplan == None or testplan == '':
-            sql = "SELECT COUNT(*) FROM testcasehistory th1, (SELECT id, planid, max(time) as maxtime FROM testcasehistory WHERE time > %s AND time <= %s GROUP BY planid, id) th2 WHERE th1.time = th2.maxtime AND th1.id = th2.id AND th1.planid = th2.planid AND th1.status = '%s'" % (to_any_timestamp(from_date), to_any_timestamp(at_date), status)
+        if 'testmanager' in self.config:
+            self.default_days_back = self.config.getint('testmanager', 'default_days_back', TESTMANAGER_DEFAULT_DAYS_BACK)
+            self.default_interval = self.config.getint('testmanager', 'default_interval', TESTMANAGER_DEFAULT_INTERVAL)
+
+        format = req.args.get('format', 'json')
+        if format not in ('json', 'csv'):
+            raise TracError(_("Unsupported format: %(format)s", format=format))
+        
+        all_metrics = self.API_METRICS['testcase'] + self.API_METRICS['ticket']
+        metrics = self._get_list_arg(req, 'metrics') or list(all_metrics)
+        for metric in metrics:
+            if metric not in all_metrics:
+                raise TracError(_("Unknown metric: %(metric)s", metric=metric))
+
+        graph_res = req.args.get('resolution', str(self.default_interval))
+        if not graph_res.isdigit() or int(graph_res) == 0:
+            raise TracError(_("The resolution must be a positive integer number of days."))
+        graph_res = int(graph_res)
+
+        if req.args.get('to'):
+            to_date = parse_date(req.args.get('to'), req.tz)
         else:
-            #sql = "SELECT COUNT(*) FROM testcasehistory th1, (SELECT id, planid, max(time) as maxtime FROM testcasehistory WHERE planid = '%s' AND time > %s AND time <= %s GROUP BY planid, id) th2 WHERE th1.time = th2.maxtime AND th1.id = th2.id AND th1.planid = th2.planid AND th1.status = '%s'" % (testplan, to_any_timestamp(from_date), to_any_timestamp(at_date), status)
-            sql = "SELECT COUNT(*) FROM testcasehistory th1, (SELECT id, planid, max(time) as maxtime FROM testcasehistory WHERE planid = '%s' AND time > %s AND time <= %s GROUP BY planid, id) th2 WHERE th1.time = th2.maxtime AND th1.id = th2.id AND th1.planid = th2.planid AND th1.status = '%s'" % (testplan, to_any_timestamp(from_date), to_any_timestamp(at_date), status)
+            to_date = datetime.now(req.tz)
 
-        cursor.execute(sql)
+        if req.args.get('from'):
+            from_date = parse_date(req.args.get('from'), req.tz)
+        else:
+            from_date = to_date - timedelta(self.default_days_back)
 
-        row = cursor.fetchone()
+        # The last point includes the end date
+        points = self._get_points(from_date, to_date + timedelta(1), graph_res)
         
-        count = row[0]
+        # Series are (name, test plan, catalog path, contains all)
+        series = []
+        for planid in self._get_list_arg(req, 'plan'):
+            tp = TestPlan(self.env, planid)
+            if not tp.exists:
+                raise TracError(_("Test plan %(planid)s not found.", planid=planid))
+            series.append(('plan:' + planid, planid, tp['page_name'], tp['contains_all']))
+        
+        for catpath in self._get_list_arg(req, 'catalog'):
+            series.append(('catalog:' + catpath, None, catpath, True))
+            
+        if len(series) == 0:
+            series.append(('all', None, None, True))
 
-        return count
+        if format == 'json':
+            req.send_header("Content-Type", "application/json")
+        else:
+            req.send_header("Content-Type", "text/csv;charset=utf-8")
+            req.send_header("Content-Disposition", "attachment;filename=Test_stats.csv")
 
+        for chunk in self._generate_api_rows(req, format, series, points, graph_res, metrics, tc_statuses):
+            if isinstance(chunk, unicode): 
+                chunk = chunk.encode('utf-8') 
+
+            req.write(chunk)
+
+    def _generate_api_rows(self, req, format, series, points, graph_res, metrics, tc_statuses):
+        # Same tickets stats start as the charts, two years back
+        today = datetime.today()
+        today = today.replace(tzinfo = req.tz)+timedelta(2)
+        beginning = today - timedelta(720)
+
+        charts = [chart for chart in ('testcase', 'ticket') if len([m for m in metrics if m in self.API_METRICS[chart]]) > 0]
+
+        if format == 'json':
+            yield '{"metrics": %s, "rows": [' % json.dumps(metrics)
+        else:
+            yield self._get_csv_row(['series', 'from', 'to'] + metrics)
+
+        first = True
+        for name, testplan, catpath, testplan_contains_all in series:
+            values = [{} for point in points]
+            
+            for chart in charts:
+                chart_values = self._get_cached_stats(
+                    (chart, testplan, catpath, points[0][1].date().isoformat() if points else None, 
+                        points[-1][1].date().isoformat() if points else None, graph_res, unicode(req.tz)),
+                    lambda: self._get_chart_values(chart, beginning, points, catpath, testplan, testplan_contains_all, tc_statuses),
+                    chart, testplan)
 
-    def _get_num_tickets_total(self, from_date, at_date, testplan, req):
+                for point_values, chart_point_values in zip(values, chart_values):
+                    point_values.update(chart_point_values)
+
+            for (last_date, cur_date), point_values in zip(points, values):
+                row = [name, last_date.date().isoformat(), cur_date.date().isoformat()] + [point_values[m] for m in metrics]
+
+                if format == 'json':
+                    yield ('', ',')[not first] + '\n' + json.dumps(dict(zip(['series', 'from', 'to'] + metrics, row)))
+                else:
+                    yield self._get_csv_row(row)
+
+                first = False
+
+        if format == 'json':
+            yield '\n]}'
+
+    def _get_csv_row(self, values):
+        out = StringIO()
+        csv.writer(out).writerow([unicode(v).encode('utf-8') for v in values])
+        
+        return out.getvalue()
+        
+    def _get_list_arg(self, req, name):
+        '''
+        Returns the values of a request argument which can be repeated
+        and contain comma separated values.
         '''
-        Returns an integer of the number of tickets opened against the specified test plan, 
-        and that had the specified status between from_date and at_date.
+        arg = req.args.get(name, [])
+        if not isinstance(arg, list):
+            arg = [arg]
+
+        result = []
+        for value in arg:
+            result.extend([v.strip() for v in value.split(',') if v.strip() != ''])
+
+        return result
+
+    # ==[ Statistics cache ]==
+
+    def get_cache_stats(self):
+        '''
+        Returns the statistics cache counters, for monitoring.
         '''
+        return {'hits': self._cache_hits, 
+                'misses': self._cache_misses, 
+                'size': len(self._cache),
+                'max_size': self._cache.max_size}
+
+    def _get_cached_stats(self, key, compute, chart, testplan):
+        '''
+        Returns the statistics with the specified key from the cache,
+        if they have not expired and nothing changed since they were 
+        computed, otherwise computes and caches them.
         
-        if testplan == None or testplan == '':
-            testplan_filter = ''
-        else:
-            testplan_filter = "INNER JOIN ticket_custom AS tcus ON t.id = tcus.ticket AND tcus.name = 'planid' AND tcus.value = '%s'" % testplan
+        Only changes to the 'testcase' or 'ticket' data of the specified
+        test plan, or of any plan if none is specified, make the cached
+        statistics stale.
+        '''
+        ttl = self.config.getint('testmanager', 'stats.cache_ttl', 60)
+        if ttl <= 0:
+            return compute()
+        
+        generation = DailyStatsRollup(self.env).get_generation(chart, testplan)
+        now = datetime.now(utc)
+        
+        entry = self._cache.get(key)
+        if entry is not None and entry[0] > now and entry[1] == generation:
+            self._count_cache_access(True)
+            return entry[2]
+
+        self._count_cache_access(False)
+        
+        value = compute()
+        self._cache.set(key, (now + timedelta(seconds=ttl), generation, value))
+        
+        return value
 
+    def _count_cache_access(self, hit):
+        self._cache_lock.acquire()
+        try:
+            if hit:
+                self._cache_hits += 1
+            else:
+                self._cache_misses += 1
+        finally:
+            self._cache_lock.release()
 
+    def _get_num_tcs_by_all_statuses(self, from_date, at_date, testplan, req):
+        '''
+        Returns a dictionary {status: number of test cases} with the 
+        latest status the test cases had between from_date and at_date, 
+        computed with a single query.
+        '''
+        
         db = self.env.get_read_db()
         cursor = db.cursor()
 
-        #self.env.log.debug("select COUNT(*) FROM ticket AS t %s WHERE time > %s and time <= %s" % 
-        #    (testplan_filter, to_any_timestamp(from_date), to_any_timestamp(at_date)))
+        sql = "SELECT th1.status, COUNT(*) FROM testcasehistory th1, (SELECT id, planid, max(time) as maxtime FROM testcasehistory WHERE time > %s AND time <= %s"
+        args = [to_any_timestamp(from_date), to_any_timestamp(at_date)]
         
-        cursor.execute("select COUNT(*) FROM ticket AS t %s WHERE time > %s and time <= %s" 
-            % (testplan_filter, to_any_timestamp(from_date), to_any_timestamp(at_date)))
+        if testplan is not None and testplan != '':
+            sql += " AND planid = %s"
+            args.append(testplan)
+            
+        sql += " GROUP BY planid, id) th2 WHERE th1.time = th2.maxtime AND th1.id = th2.id AND th1.planid = th2.planid GROUP BY th1.status"
 
-        row = cursor.fetchone()
-        count = row[0]
+        cursor.execute(sql, args)
 
-        return count
+        counts = {}
+        for status, count in cursor:
+            counts[status] = count
+
+        return counts
+
+    def _get_testcase_chart_values(self, points, catpath, testplan, testplan_contains_all, tc_statuses):
+        '''
+        Returns the values of the test case chart for each of the 
+        specified (from date, to date) points, reading the test case
+        creations and the status history only once.
+        
+        The points must be contiguous, i.e. each one starting where the
+        previous ends. Totals ("all_") are counted from the end of the
+        first point.
+        '''
+        if len(points) == 0:
+            return []
+            
+        start = to_any_timestamp(points[0][0])
+        bounds = [to_any_timestamp(cur_date) for last_date, cur_date in points]
+        
+        status_colors = {}
+        for color in tc_statuses:
+            for tc_outcome in tc_statuses[color]:
+                status_colors[tc_outcome] = color
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+
+        if catpath == None or catpath == '':
+            path_filter = "TC_%_TC%"
+        else:
+            path_filter = catpath + "%_TC%" 
+
+        cursor.execute("SELECT time FROM wiki WHERE name LIKE %s AND version = 1 AND time <= %s ORDER BY time", 
+            (path_filter, bounds[-1]))
+        created = sweep_counts([row[0] for row in cursor], [start] + bounds)
+        
+        sql = "SELECT time, planid, id, status FROM testcasehistory WHERE time > %s AND time <= %s"
+        args = [start, bounds[-1]]
+        if testplan is not None and testplan != '':
+            sql += " AND planid = %s"
+            args.append(testplan)
+        sql += " ORDER BY time"
+        
+        cursor.execute(sql, args)
+        history = cursor.fetchall()
+
+        counts = None
+        if numpy is not None and self.config.get('testmanager', 'stats.use_numpy', 'True') == 'True':
+            try:
+                counts = self._sweep_status_history_numpy(history, bounds, status_colors)
+            except:
+                self.env.log.error("Error computing the statistics with NumPy, falling back to the plain computation")
+                self.env.log.error(formatExceptionInfo())
+
+        if counts is None:
+            counts = self._sweep_status_history(history, bounds, status_colors)
+
+        result = []
+        for i, (point_counts, all_counts) in enumerate(counts):
+            if testplan_contains_all:
+                num_all = created[i+1]
+                num_all_untested = num_all - all_counts['green'] - all_counts['red']
+            else:
+                num_all_untested = all_counts['yellow']
+                num_all = num_all_untested + all_counts['green'] + all_counts['red']
+
+            result.append({'new_tcs': created[i+1] - created[i],
+                           'successful': point_counts['green'],
+                           'failed': point_counts['red'],
+                           'all_tcs': num_all,
+                           'all_successful': all_counts['green'],
+                           'all_untested': num_all_untested,
+                           'all_failed': all_counts['red']})
+
+        return result
+
+    def _sweep_status_history(self, history, bounds, status_colors):
+        '''
+        Returns, for each bound, the number of test cases in plan per 
+        status color:
+          - with their latest status in the point ending at the bound
+          - with their latest status since the first bound
+        as a list of (point counts, total counts) dictionaries.
+        The history must be ordered by time.
+        '''
+        result = []
+        idx = 0
         
-    def _get_num_tickets_by_status(self, from_date, at_date, status, testplan, req):
+        # Latest status color of each test case in plan since the end
+        # of the first point, and how many test cases have each color
+        latest_colors = {}
+        all_counts = {'green': 0, 'yellow': 0, 'red': 0}
+
+        for bound in bounds:
+            # Latest status of each test case in plan within this point
+            point_statuses = {}
+            
+            while idx < len(history) and history[idx][0] <= bound:
+                ts, planid, tc_id, status = history[idx]
+                idx += 1
+                
+                point_statuses[(planid, tc_id)] = status
+
+                if ts > bounds[0]:
+                    old_color = latest_colors.get((planid, tc_id))
+                    if old_color is not None:
+                        all_counts[old_color] -= 1
+
+                    new_color = status_colors.get(status)
+                    latest_colors[(planid, tc_id)] = new_color
+                    if new_color is not None:
+                        all_counts[new_color] += 1
+
+            point_counts = {'green': 0, 'yellow': 0, 'red': 0}
+            for status in point_statuses.itervalues():
+                color = status_colors.get(status)
+                if color is not None:
+                    point_counts[color] += 1
+
+            result.append((point_counts, dict(all_counts)))
+
+        return result
+
+    def _sweep_status_history_numpy(self, history, bounds, status_colors):
         '''
-        Returns an integer of the number of tickets opened against the specified test plan, 
-        and that had the specified status between from_date and at_date.
+        Same as _sweep_status_history(), but vectorized with NumPy, 
+        computing all the points at once.
         '''
+        colors = ('green', 'yellow', 'red')
+        num_bounds = len(bounds)
+        
+        if len(history) == 0:
+            return [(dict.fromkeys(colors, 0), dict.fromkeys(colors, 0)) for bound in bounds]
+            
+        # Test cases in plan and colors as small integers, the colors
+        # being 1-based so that 0 means an unknown status
+        keys = {}
+        color_codes = dict([(status, colors.index(status_colors[status]) + 1) for status in status_colors])
+        
+        times = numpy.array([row[0] for row in history], dtype=numpy.int64)
+        tcs = numpy.array([keys.setdefault((row[1], row[2]), len(keys)) for row in history], dtype=numpy.int64)
+        codes = numpy.array([color_codes.get(row[3], 0) for row in history], dtype=numpy.int64)
+        
+        # The point of each entry, i.e. the first bound not before it
+        points = numpy.searchsorted(numpy.array(bounds, dtype=numpy.int64), times, side='left')
+        
+        # Latest entry of each test case in plan within each point: the
+        # first occurrence of each (point, test case) in reverse order
+        point_tcs = points * len(keys) + tcs
+        unique, rev_index = numpy.unique(point_tcs[::-1], return_index=True)
+        latest = len(history) - 1 - rev_index
+        
+        point_counts = numpy.bincount(points[latest] * 4 + codes[latest], minlength=num_bounds * 4).reshape(num_bounds, 4)
+        
+        # Since the first bound, each entry adds its color at its point,
+        # and removes it at the point of the next entry of the same test
+        # case in plan, if any
+        since = numpy.nonzero(times > bounds[0])[0]
+        order = since[numpy.lexsort((since, tcs[since]))]
+        
+        deltas = numpy.bincount(points[order] * 4 + codes[order], minlength=num_bounds * 4)
+        
+        has_next = tcs[order][1:] == tcs[order][:-1]
+        removed = points[order][1:][has_next] * 4 + codes[order][:-1][has_next]
+        deltas -= numpy.bincount(removed, minlength=num_bounds * 4)
         
+        all_counts = numpy.cumsum(deltas.reshape(num_bounds, 4), axis=0)
+
+        result = []
+        for i in range(num_bounds):
+            result.append((dict([(c, int(point_counts[i][j + 1])) for j, c in enumerate(colors)]),
+                           dict([(c, int(all_counts[i][j + 1])) for j, c in enumerate(colors)])))
+
+        return result
+
+    def _get_ticket_chart_values(self, beginning, points, testplan):
+        '''
+        Returns the values of the ticket chart for each of the specified
+        (from date, to date) points, counting the tickets opened against
+        the specified test plan, and closed, since the beginning.
+        The tickets and their changes are read only once.
+        '''
+        if len(points) == 0:
+            return []
+            
+        start = to_any_timestamp(beginning)
+        bounds = [to_any_timestamp(cur_date) for last_date, cur_date in points]
+
+        created, closed = self._list_ticket_times(testplan, [(start, bounds[-1])])
+
+        return self._get_ticket_chart_rows(sweep_counts(created, bounds), sweep_counts(closed, bounds))
+
+    def _get_ticket_chart_values_from_dailies(self, beginning, points, testplan):
+        '''
+        Same as _get_ticket_chart_values(), but reading the tickets and
+        their changes only on the days containing the beginning or the
+        end of a point, and the daily rollup for all the other days.
+        
+        As no point starts or ends within the other days, their whole
+        counts fall in a single point, whatever the time zone of the 
+        points, and the values are the same as from the tickets.
+        '''
+        if len(points) == 0:
+            return []
+            
+        rollup = DailyStatsRollup(self.env)
+
+        start = to_any_timestamp(beginning)
+        bounds = [to_any_timestamp(cur_date) for last_date, cur_date in points]
+
+        # The days read from the tickets, as (after, up to) ranges
+        edge_days = set([rollup.get_day(ts) for ts in [start] + bounds])
+        ranges = [(rollup.get_day_start(day) - 1, rollup.get_day_start(day, 1) - 1) for day in sorted(edge_days)]
+        
+        created, closed = self._list_ticket_times(testplan, ranges)
+        created = [(ts, 1) for ts in created if ts > start]
+        closed = [(ts, 1) for ts in closed if ts > start]
+
+        for day, values in rollup.list_days(rollup.get_day(bounds[-1]), testplan or None):
+            day_start = rollup.get_day_start(day)
+            if day not in edge_days and day_start > start:
+                created.append((day_start, values['new_tickets'] or 0))
+                closed.append((day_start, values['closed_tickets'] or 0))
+                
+        return self._get_ticket_chart_rows(sweep_sums(sorted(created), bounds), sweep_sums(sorted(closed), bounds))
+
+    def _list_ticket_times(self, testplan, ranges):
+        '''
+        Returns the sorted lists of the times when the tickets opened 
+        against the specified test plan were created, and were closed,
+        within the specified (after, up to) timestamp ranges.
+        '''
         if testplan == None or testplan == '':
-            testplan_filter = ''
+            ticket_filter = ''
+            change_filter = ''
+            args = []
         else:
-            testplan_filter = "INNER JOIN ticket_custom AS tcus ON tch.ticket = tcus.ticket AND tcus.name = 'planid' AND tcus.value = '%s'" % testplan
+            ticket_filter = "INNER JOIN testcaseticket AS tct ON t.id = tct.ticket AND tct.planid = %s"
+            change_filter = "INNER JOIN testcaseticket AS tct ON tch.ticket = tct.ticket AND tct.planid = %s"
+            args = [testplan]
 
         db = self.env.get_read_db()
         cursor = db.cursor()
 
-        #self.env.log.debug("select COUNT(*) FROM ticket_change AS tch %s WHERE tch.field = 'status' AND tch.newvalue = '%s' AND tch.time > %s AND tch.time <= %s"
-        #    % (testplan_filter, status, to_any_timestamp(from_date), to_any_timestamp(at_date)))
+        created = []
+        closed = []
+        for i in range(0, len(ranges), 100):
+            chunk = ranges[i:i+100]
+            condition = '(' + ' OR '.join(['(%(column)s > %%s AND %(column)s <= %%s)'] * len(chunk)) + ')'
+            chunk_args = args + [ts for r in chunk for ts in r]
+            
+            cursor.execute("SELECT t.time FROM ticket AS t " + ticket_filter + " WHERE " + condition % {'column': 't.time'}, 
+                chunk_args)
+            created.extend([row[0] for row in cursor])
 
-        cursor.execute("select COUNT(*) FROM ticket_change AS tch %s WHERE tch.field = 'status' AND tch.newvalue = '%s' AND tch.time > %s AND tch.time <= %s"
-            % (testplan_filter, status, to_any_timestamp(from_date), to_any_timestamp(at_date)))
+            cursor.execute("SELECT tch.time FROM ticket_change AS tch " + change_filter + " WHERE tch.field = 'status' AND tch.newvalue = 'closed' AND " + condition % {'column': 'tch.time'},
+                chunk_args)
+            closed.extend([row[0] for row in cursor])
 
-        row = cursor.fetchone()
-        count = row[0]
+        return sorted(created), sorted(closed)
 
-        return count
+    def _get_ticket_chart_rows(self, totals, closed):
+        result = []
+        for num_total, num_closed in zip(totals, closed):
+            result.append({'active_tickets': num_total - num_closed,
+                           'closed_tickets': num_closed,
+                           'tot_tickets': num_total})
+
+        return result
+
+    def check_daily_rollup(self, days=30):
+        '''
+        Computes the ticket chart of the last days, for the whole 
+        environment and for each test plan, both from the tickets and
+        from the daily rollup, and returns the differences as a list of
+        (plan ID, date, metric, value from the tickets, value from the 
+        rollup).
+        '''
+        at_date = datetime.now(utc)
+        beginning = at_date - timedelta(days)
+        points = self._get_points(beginning + timedelta(1), at_date + timedelta(1), 1)
         
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT id FROM testplan")
+        
+        result = []
+        for planid in [''] + [row[0] for row in cursor.fetchall()]:
+            expected = self._get_ticket_chart_values(beginning, points, planid)
+            actual = self._get_ticket_chart_values_from_dailies(beginning, points, planid)
+            
+            for (last_date, cur_date), exp_values, act_values in zip(points, expected, actual):
+                for metric in sorted(exp_values):
+                    if exp_values[metric] != act_values[metric]:
+                        result.append((planid, cur_date, metric, exp_values[metric], act_values[metric]))
+
+        return result
+
     # ==[ IRequestHandler methods ]==
 
     def match_request(self, req):
         return re.match(r'/teststats(?:_trac)?(?:/.*)?$', req.path_info)
 
     def process_request(self, req):
+        if req.path_info.startswith('/teststats/api'):
+            return self._process_api_request(req)
+            
         testmanagersystem = TestManagerSystem(self.env)
         tc_statuses = testmanagersystem.get_tc_statuses_by_color()
 
@@ -233,21 +761,19 @@ class TestStatsPlugin(Component):
         # Stats start from two years back
         beginning = today - timedelta(720)        
 
-        if (not req_content == None) and (req_content == "piechartdata"):
-            num_successful = 0
-            for tc_outcome in tc_statuses['green']:
-                num_successful += self._get_num_tcs_by_status(beginning, today, tc_outcome, testplan, req)
-
-            num_failed = 0
-            for tc_outcome in tc_statuses['red']:
-                num_failed += self._get_num_tcs_by_status(beginning, today, tc_outcome, testplan, req)
+        if (not req_content == None) and (req_content == "cachestats"):
+            jsdstr = json.dumps(self.get_cache_stats())
+            
+            req.send_header("Content-Type", "application/json")
+            req.send_header("Content-Length", len(jsdstr))
+            req.write(jsdstr)
+            return
 
-            num_to_be_tested = 0
-            if testplan_contains_all:
-                num_to_be_tested = self._get_num_testcases(beginning, today, catpath, req) - num_successful - num_failed
-            else:
-                for tc_outcome in tc_statuses['yellow']:
-                    num_to_be_tested += self._get_num_tcs_by_status(beginning, today, tc_outcome, testplan, req)
+        if (not req_content == None) and (req_content == "piechartdata"):
+            num_successful, num_failed, num_to_be_tested = self._get_cached_stats(
+                ('piechartdata', testplan, catpath, today.date().isoformat()),
+                lambda: self._get_pie_chart_values(beginning, today, catpath, testplan, testplan_contains_all, tc_statuses, req),
+                'testcase', testplan)
 
             jsdstr = """
             [
@@ -308,71 +834,25 @@ class TestStatsPlugin(Component):
             
         count = []
 
-        # Calculate 0th point 
-        last_date = from_date - timedelta(graph_res)
+        points = self._get_points(from_date, at_date, graph_res)
 
-        # Calculate remaining points
-        for cur_date in daterange(from_date, at_date, graph_res):
+        chart = ('testcase', 'ticket')[req_content == "ticketchartdata"]
+        values = self._get_cached_stats(
+            (chart, testplan, catpath, from_date.date().isoformat(), at_date.date().isoformat(), graph_res, unicode(req.tz)),
+            lambda: self._get_chart_values(chart, beginning, points, catpath, testplan, testplan_contains_all, tc_statuses),
+            chart, testplan)
+            
+        for (last_date, cur_date), point_values in zip(points, values):
             datestr = format_date(cur_date) 
             if graph_res != 1:
                 datestr = "%s thru %s" % (format_date(last_date), datestr) 
-            
-            if (not req_content == None) and (req_content == "ticketchartdata"):
-                num_total = self._get_num_tickets_total(beginning, cur_date, testplan, req)
-                num_closed = self._get_num_tickets_by_status(beginning, cur_date, 'closed', testplan, req)
-                num_active = num_total - num_closed
-                
-                count.append( {'from_date': format_date(last_date),
-                             'to_date': datestr,
-                             'date'  : datestr,
-                             'active_tickets'    : num_active,
-                             'closed_tickets': num_closed,
-                             'tot_tickets' : num_total} )
-                
-            else:
-                # Handling custom test case outcomes here
-                num_new = self._get_num_testcases(last_date, cur_date, catpath, req)
-                
-                num_successful = 0
-                for tc_outcome in tc_statuses['green']:
-                    num_successful += self._get_num_tcs_by_status(last_date, cur_date, tc_outcome, testplan, req)
 
-                num_failed = 0
-                for tc_outcome in tc_statuses['red']:
-                    num_failed += self._get_num_tcs_by_status(last_date, cur_date, tc_outcome, testplan, req)
-                
-                num_all_successful = 0
-                for tc_outcome in tc_statuses['green']:
-                    num_all_successful += self._get_num_tcs_by_status(from_date, cur_date, tc_outcome, testplan, req)
-
-                num_all_failed = 0
-                for tc_outcome in tc_statuses['red']:
-                    num_all_failed += self._get_num_tcs_by_status(from_date, cur_date, tc_outcome, testplan, req)
-
-                num_all = 0
-                num_all_untested = 0
-                if testplan_contains_all:
-                    num_all = self._get_num_testcases(None, cur_date, catpath, req)
-                    num_all_untested = num_all - num_all_successful - num_all_failed
-                else:
-                    for tc_outcome in tc_statuses['yellow']:
-                        num_all_untested += self._get_num_tcs_by_status(from_date, cur_date, tc_outcome, testplan, req)
-                    num_all = num_all_untested + num_all_successful + num_all_failed
-
-
-                count.append( {'from_date': format_date(last_date),
-                             'to_date': datestr,
-                             'date'  : datestr,
-                             'new_tcs'    : num_new,
-                             'successful': num_successful,
-                             'failed': num_failed,
-                             'all_tcs'    : num_all,
-                             'all_successful': num_all_successful,
-                             'all_untested': num_all_untested,
-                             'all_failed': num_all_failed })
-                             
-                             
-            last_date = cur_date
+            point = {'from_date': format_date(last_date),
+                     'to_date': datestr,
+                     'date'  : datestr}
+            point.update(point_values)
+            
+            count.append(point)
 
         # if chartdata is requested, raw text is returned rather than data object
         # for templating
@@ -500,6 +980,401 @@ class TestStatsPlugin(Component):
         #return [('testmanager', resource_filename(__name__, 'htdocs'))]
         return [('testmanager', resource_filename('testmanager', 'htdocs'))]
 
+class DailyStatsRollup(Component):
+    """
+    Maintains the 'teststatsdaily' table, a daily rollup of the data
+    shown by the test statistics charts, so that charts over long 
+    periods do not need to read the whole history.
+    
+    Each row holds, for one day and one test plan, the changes of that
+    day:
+      green, yellow, red:         the net change in the number of test
+                                  cases in the plan whose latest status
+                                  has that color. Summing them up to a 
+                                  day gives the status counts on that 
+                                  day.
+      green_changes, red_changes: the number of status changes to a
+                                  successful or failed outcome.
+      new_tcs:                    the number of test cases created in 
+                                  the plan's catalog.
+      new_tickets, closed_tickets: the number of tickets opened against
+                                  the plan, and closed.
+                                  
+    The rows with an empty plan ID hold the test cases and tickets 
+    created and closed in the whole environment.
+    
+    The table is updated as statuses, test cases and tickets change, 
+    and can be rebuilt from scratch with the 
+    'testmanager stats rebuild' trac-admin command. Deleted tickets 
+    and test case pages, as well as changes to the test outcomes 
+    configuration, are only accounted for by a rebuild.
+    """
+
+    implements(IWikiChangeListener, ITicketChangeListener, IGenericObjectChangeListener)
+
+    COLUMNS = ('green', 'yellow', 'red', 'green_changes', 'red_changes', 'new_tcs', 'new_tickets', 'closed_tickets')
+    
+    GENERATION = 'STATS_GENERATION'
+    
+    # IWikiChangeListener methods
+    def wiki_page_added(self, page):
+        if TestManagerModelProvider(self.env).get_test_page_kind(page.name) == 'testcase':
+            @self.env.with_transaction()
+            def do_count_testcase(db):
+                day = self.get_day(page.time)
+                
+                self._add_to_day(day, '', {'new_tcs': 1}, db)
+                planids = list(self._list_plans_containing(page.name, db))
+                for planid in planids:
+                    self._add_to_day(day, planid, {'new_tcs': 1}, db)
+
+                self._set_changed('testcase', planids, db)
+
+    def wiki_page_changed(self, page, version, t, comment, author, ipnr):
+        pass
+
+    def wiki_page_deleted(self, page):
+        if TestManagerModelProvider(self.env).is_test_page(page.name):
+            self._set_changed('testcase')
+
+    def wiki_page_version_deleted(self, page):
+        pass
+
+    def wiki_page_renamed(self, page, old_name): 
+        pass
+
+    # ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        @self.env.with_transaction()
+        def do_count_ticket(db):
+            day = self.get_day(ticket.time_created)
+            
+            self._add_to_day(day, '', {'new_tickets': 1}, db)
+            if ticket.values.get('planid'):
+                self._add_to_day(day, ticket.values['planid'], {'new_tickets': 1}, db)
+
+            self._set_changed('ticket', [ticket.values.get('planid')], db)
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if 'planid' in old_values:
+            self._move_ticket(ticket, old_values['planid'], ticket.values.get('planid'))
+            
+        if 'status' in old_values and ticket['status'] == 'closed':
+            @self.env.with_transaction()
+            def do_count_closed_ticket(db):
+                day = self.get_day(ticket.time_changed)
+                
+                self._add_to_day(day, '', {'closed_tickets': 1}, db)
+                if ticket.values.get('planid'):
+                    self._add_to_day(day, ticket.values['planid'], {'closed_tickets': 1}, db)
+
+                self._set_changed('ticket', [ticket.values.get('planid')], db)
+
+        elif 'status' in old_values:
+            self._set_changed('ticket', [ticket.values.get('planid')])
+
+    def ticket_deleted(self, ticket):
+        self._set_changed('ticket', [ticket.values.get('planid')])
+
+    # IGenericObjectChangeListener methods
+    def object_created(self, g_object):
+        if g_object.realm == 'testplan':
+            # Count the test cases already in the plan's catalog
+            @self.env.with_transaction()
+            def do_count_plan_testcases(db):
+                model_provider = TestManagerModelProvider(self.env)
+                
+                cursor = db.cursor()
+                cursor.execute("SELECT name, time FROM wiki WHERE version = 1 AND name LIKE %s ESCAPE '|'", 
+                    (db_escape_like(g_object['page_name'] + '_') + '%',))
+                    
+                for name, ts in cursor.fetchall():
+                    if model_provider.get_test_page_kind(name) == 'testcase':
+                        self._add_to_day(self.get_day(ts), g_object['id'], {'new_tcs': 1}, db)
+
+                self._set_changed('testcase', [g_object['id']], db)
+
+    def object_changed(self, g_object, comment, author, old_values):
+        pass
+
+    def object_deleted(self, g_object):
+        if g_object.realm == 'testplan':
+            @self.env.with_transaction()
+            def do_remove_plan(db):
+                self.history_removed(db, planid=g_object['id'])
+
+    # Test case status changes
+    def status_changed(self, planid, old_status, new_status, ts, db):
+        """
+        Accounts for a new status of a test case in a plan, to be 
+        called before the new status is written into the history.
+        """
+        self.statuses_changed([(planid, old_status, new_status, ts)], db)
+
+    def statuses_changed(self, changes, db):
+        """
+        Accounts for the new statuses of many test cases in plans, given
+        as a list of (planid, old status, new status, timestamp), 
+        writing each affected day only once.
+        """
+        days = []
+        deltas_by_day = {}
+        for planid, old_status, new_status, ts in changes:
+            key = (self.get_day(ts), planid)
+            if key not in deltas_by_day:
+                days.append(key)
+                deltas_by_day[key] = {}
+                
+            self._add_status_change(deltas_by_day[key], old_status, new_status)
+
+        for day, planid in days:
+            self._add_to_day(day, planid, deltas_by_day[(day, planid)], db)
+            
+        self._set_changed('testcase', [planid for day, planid in days], db)
+
+    def history_removed(self, db, tc_id=None, planid=None):
+        """
+        Removes the contribution of the status history of a test case 
+        in a plan, of a test case in all the plans or of a whole plan, 
+        to be called before the history is deleted.
+        """
+        if tc_id is None:
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM teststatsdaily WHERE planid = %s", (planid,))
+            self._set_changed('testcase', [planid], db)
+            return
+        
+        sql = "SELECT time, planid, id, status FROM testcasehistory WHERE id = %s"
+        args = [tc_id]
+        if planid is not None:
+            sql += " AND planid = %s"
+            args.append(planid)
+        sql += " ORDER BY planid, time"
+            
+        cursor = db.cursor()
+        cursor.execute(sql, args)
+        
+        planids = []
+        for (day, planid), deltas in self._get_history_deltas(cursor.fetchall()).iteritems():
+            self._add_to_day(day, planid, dict([(c, -deltas[c]) for c in deltas]), db)
+            planids.append(planid)
+
+        self._set_changed('testcase', planids, db)
+
+    def rebuild(self, db=None):
+        """
+        Rebuilds the whole table from the test case history, the wiki
+        pages and the tickets. Returns the number of rows written.
+        """
+        result = {'count': 0}
+        
+        @self.env.with_transaction(db)
+        def do_rebuild(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM teststatsdaily")
+
+            cursor.execute("SELECT time, planid, id, status FROM testcasehistory ORDER BY planid, id, time")
+            rows = self._get_history_deltas(cursor.fetchall())
+
+            def add(day, planid, column):
+                if (day, planid) not in rows:
+                    rows[(day, planid)] = {}
+                rows[(day, planid)][column] = rows[(day, planid)].get(column, 0) + 1
+            
+            cursor.execute("SELECT id, page_name FROM testplan")
+            plans = cursor.fetchall()
+            
+            model_provider = TestManagerModelProvider(self.env)
+            cursor.execute("SELECT name, time FROM wiki WHERE version = 1 AND name LIKE %s", ('TC_%',))
+            for name, ts in cursor.fetchall():
+                if model_provider.get_test_page_kind(name) == 'testcase':
+                    day = self.get_day(ts)
+                    add(day, '', 'new_tcs')
+                    for planid, page_name in plans:
+                        if name.startswith(page_name + '_'):
+                            add(day, planid, 'new_tcs')
+
+            cursor.execute("SELECT t.time, c.value FROM ticket t LEFT OUTER JOIN ticket_custom c ON c.ticket = t.id AND c.name = 'planid'")
+            for ts, planid in cursor.fetchall():
+                day = self.get_day(ts)
+                add(day, '', 'new_tickets')
+                if planid:
+                    add(day, planid, 'new_tickets')
+
+            cursor.execute("SELECT tch.time, c.value FROM ticket_change tch LEFT OUTER JOIN ticket_custom c ON c.ticket = tch.ticket AND c.name = 'planid' WHERE tch.field = 'status' AND tch.newvalue = 'closed'")
+            for ts, planid in cursor.fetchall():
+                day = self.get_day(ts)
+                add(day, '', 'closed_tickets')
+                if planid:
+                    add(day, planid, 'closed_tickets')
+
+            for (day, planid), deltas in rows.iteritems():
+                self._insert_day(day, planid, deltas, db)
+
+            self._set_changed('testcase', db=db)
+            self._set_changed('ticket', db=db)
+
+            result['count'] = len(rows)
+                
+        return result['count']
+
+    def get_generation(self, chart, planid=None):
+        """
+        Returns a stamp which changes whenever the data the 'testcase' or
+        'ticket' statistics of the specified test plan, or of the whole 
+        environment, are computed from changes.
+        
+        Changes to a test plan do not affect the stamps of the other 
+        plans, and test case changes do not affect the ticket stamps.
+        """
+        propname = self.GENERATION + ':' + chart
+        
+        return (db_get_config_property(self.env, 'testconfig', propname), 
+                db_get_config_property(self.env, 'testconfig', propname + ':' + (planid or '')))
+
+    def _set_changed(self, chart, planids=None, db=None):
+        """
+        Changes the stamps of the 'testcase' or 'ticket' statistics of 
+        the specified test plans and of the whole environment, or of all
+        the plans if none is specified.
+        """
+        propname = self.GENERATION + ':' + chart
+        
+        if planids is None:
+            db_set_config_property(self.env, 'testconfig', propname, uuid.uuid4().hex, db)
+            return
+        
+        # The environment stats add up those of all the plans
+        for planid in set([p for p in planids if p] + ['']):
+            db_set_config_property(self.env, 'testconfig', propname + ':' + planid, uuid.uuid4().hex, db)
+        
+    def list_days(self, to_day, planid=None):
+        """
+        Returns a list of (day, {column: value}) for all the days up 
+        to the specified one, ordered by day, for the specified test plan
+        or for the whole environment.
+        """
+        sums = ', '.join(['SUM(%s)' % c for c in self.COLUMNS if c not in ('new_tcs', 'new_tickets', 'closed_tickets')])
+        
+        if planid is None:
+            # Status columns come from the test plans, the others from 
+            # the environment rows
+            sql = "SELECT day, %s, %s FROM teststatsdaily WHERE day <= %%s GROUP BY day ORDER BY day" % (sums, 
+                ', '.join(["SUM(CASE WHEN planid = '' THEN %s ELSE 0 END)" % c for c in ('new_tcs', 'new_tickets', 'closed_tickets')]))
+            args = (to_day,)
+        else:
+            sql = "SELECT day, %s, SUM(new_tcs), SUM(new_tickets), SUM(closed_tickets) FROM teststatsdaily WHERE day <= %%s AND planid = %%s GROUP BY day ORDER BY day" % sums
+            args = (to_day, planid)
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute(sql, args)
+        
+        return [(row[0], dict(zip(self.COLUMNS, row[1:]))) for row in cursor]
+        
+    def _get_history_deltas(self, history):
+        """
+        Returns the {(day, planid): {column: delta}} contributed by the
+        specified (time, planid, id, status) history entries, which 
+        must be ordered by test case in plan and time.
+        """
+        result = {}
+        
+        prev_key = None
+        prev_status = None
+        for ts, planid, tc_id, status in history:
+            if (planid, tc_id) != prev_key:
+                prev_key = (planid, tc_id)
+                prev_status = None
+
+            day_key = (self.get_day(ts), planid)
+            if day_key not in result:
+                result[day_key] = {}
+
+            self._add_status_change(result[day_key], prev_status, status)
+            prev_status = status
+            
+        return result
+        
+    def _add_status_change(self, deltas, old_status, new_status):
+        outcomes = TestManagerSystem(self.env).outcomes_by_name
+
+        if old_status is not None and old_status.lower() in outcomes:
+            old_color = outcomes[old_status.lower()][0]
+            deltas[old_color] = deltas.get(old_color, 0) - 1
+            
+        if new_status is not None and new_status.lower() in outcomes:
+            new_color = outcomes[new_status.lower()][0]
+            deltas[new_color] = deltas.get(new_color, 0) + 1
+
+            if new_color in ('green', 'red'):
+                deltas[new_color+'_changes'] = deltas.get(new_color+'_changes', 0) + 1
+        
+    def _add_to_day(self, day, planid, deltas, db):
+        deltas = dict([(c, deltas[c]) for c in deltas if deltas[c] != 0])
+        if len(deltas) == 0:
+            return
+            
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM teststatsdaily WHERE day = %s AND planid = %s", (day, planid))
+        
+        if cursor.fetchone()[0] == 0:
+            self._insert_day(day, planid, deltas, db)
+        else:
+            columns = sorted(deltas)
+            cursor.execute("UPDATE teststatsdaily SET " + ', '.join(['%s = %s + %%s' % (c, c) for c in columns]) + " WHERE day = %s AND planid = %s", 
+                [deltas[c] for c in columns] + [day, planid])
+
+    def _insert_day(self, day, planid, deltas, db):
+        cursor = db.cursor()
+        cursor.execute("INSERT INTO teststatsdaily (day, planid, " + ', '.join(self.COLUMNS) + ") VALUES (%s, %s, " + ', '.join(['%s'] * len(self.COLUMNS)) + ")", 
+            [day, planid] + [deltas.get(c, 0) for c in self.COLUMNS])
+
+    def _move_ticket(self, ticket, old_planid, new_planid):
+        """
+        Moves the counts of a ticket, and of its previous closures, from
+        the old test plan to the new one.
+        """
+        @self.env.with_transaction()
+        def do_move_ticket(db):
+            days = [self.get_day(ticket.time_created)]
+            
+            cursor = db.cursor()
+            cursor.execute("SELECT time FROM ticket_change WHERE ticket = %s AND field = 'status' AND newvalue = 'closed' AND time < %s", 
+                (ticket.id, to_any_timestamp(ticket.time_changed)))
+            closed_days = [self.get_day(row[0]) for row in cursor.fetchall()]
+
+            for planid, sign in ((old_planid, -1), (new_planid, 1)):
+                if planid:
+                    self._add_to_day(days[0], planid, {'new_tickets': sign}, db)
+                    for day in closed_days:
+                        self._add_to_day(day, planid, {'closed_tickets': sign}, db)
+
+            self._set_changed('ticket', [old_planid, new_planid], db)
+
+    def _list_plans_containing(self, page_name, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT id, page_name FROM testplan")
+        
+        for planid, plan_page_name in cursor.fetchall():
+            if page_name.startswith(plan_page_name + '_'):
+                yield planid
+        
+    def get_day(self, ts):
+        """Returns the UTC day of a timestamp or datetime, as 'YYYY-MM-DD'."""
+        if not isinstance(ts, datetime):
+            ts = from_any_timestamp(ts)
+
+        return ts.astimezone(utc).date().isoformat()
+
+    def get_day_start(self, day, days_after=0):
+        """
+        Returns the timestamp of the beginning of a UTC day, or of the 
+        specified number of days after it.
+        """
+        return to_any_timestamp(datetime(*strptime(day, '%Y-%m-%d')[:3], tzinfo=utc) + timedelta(days_after))
+        
+        
 def daterange(begin, end, delta = timedelta(1)):
      """Stolen from: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/574441
 
@@ -533,6 +1408,38 @@ def daterange(begin, end, delta = timedelta(1)):
           begin += delta
 
 
+def sweep_counts(times, bounds):
+    """
+    Given a sorted list of times and a sorted list of bounds, returns
+    for each bound the number of times lower than or equal to it.
+    """
+    counts = []
+    idx = 0
+    for bound in bounds:
+        while idx < len(times) and times[idx] <= bound:
+            idx += 1
+        counts.append(idx)
+
+    return counts
+
+
+def sweep_sums(entries, bounds):
+    """
+    Same as sweep_counts(), but for a sorted list of (time, count) 
+    entries, summing up the counts.
+    """
+    sums = []
+    idx = 0
+    total = 0
+    for bound in bounds:
+        while idx < len(entries) and entries[idx][0] <= bound:
+            total += entries[idx][1]
+            idx += 1
+        sums.append(total)
+
+    return sums
+
+
 def compatible_user_time(req, parse_date, grab_at_date, hint='date'):
     return parse_date(grab_at_date, req.tz)+timedelta(2)
 
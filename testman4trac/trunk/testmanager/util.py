@@ -21,6 +21,10 @@
 #
 
 import re
+import threading
+
+from collections import OrderedDict
+
 from trac.core import *
 from trac.util.text import CRLF
 
@@ -63,4 +67,63 @@ html_escape_table = {
 def html_escape(text):
     """Produce entities within text."""
     return "".join(html_escape_table.get(c,c) for c in text)
+
+
+class LRUCache(object):
+    """
+    A thread-safe dictionary holding at most max_size entries, which 
+    discards the least recently used entries first.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            if key not in self._entries:
+                return default
+
+            # Move the entry to the most recently used end
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                del self._entries[key]
+            elif len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+            
+            self._entries[key] = value
+        finally:
+            self._lock.release()
+
+    def remove_matching(self, predicate):
+        """Removes all the entries whose key satisfies the predicate."""
+        self._lock.acquire()
+        try:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
     
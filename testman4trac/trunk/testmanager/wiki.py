@@ -20,19 +20,26 @@
 # If not, see <http://www.gnu.org/licenses/>.
 #
 
+import hashlib
+import json
+
 from operator import itemgetter
 from StringIO import StringIO
 
 from trac.core import *
 from trac.mimeview.api import Context
+from trac.perm import PermissionSystem
 from trac.resource import Resource
 from trac.util import format_datetime, format_date
-from trac.web.api import ITemplateStreamFilter
+from trac.util.datefmt import http_date
+from trac.util.text import unicode_urlencode
+from trac.web.api import IRequestFilter, IRequestHandler, ITemplateStreamFilter
 from trac.web.chrome import add_stylesheet, add_script, ITemplateProvider
 from trac.wiki.api import WikiSystem, IWikiChangeListener
 from trac.wiki.formatter import Formatter
 from trac.wiki.model import WikiPage
 from trac.wiki.parser import WikiParser
+from trac.wiki.web_ui import WikiModule
 
 from genshi import HTML
 from genshi.builder import tag
@@ -44,7 +51,7 @@ from tracgenericclass.util import *
 from testmanager.util import *
 from testmanager.admin import get_all_table_columns_for_object
 from testmanager.api import TestManagerSystem
-from testmanager.model import TestCatalog, TestCase, TestCaseInPlan, TestPlan, TestManagerModelProvider
+from testmanager.model import TestCatalog, TestCase, TestCaseInPlan, TestPlan, TestManagerModelProvider, BulkLoader, PrefetchedValues
 
 try:
     from testmanager.api import _, tag_, N_
@@ -55,11 +62,14 @@ except ImportError:
 class WikiTestManagerInterface(Component):
     """Implement generic template provider."""
     
-    implements(ITemplateStreamFilter, IWikiChangeListener)
+    implements(ITemplateStreamFilter, IWikiChangeListener, IRequestHandler, IRequestFilter)
     
     _config_properties = {}
     sortby = 'custom'
     open_new_window = False
+    lazy_load_tree = False
+    table_page_size = 0
+    conditional_responses = True
     
     def __init__(self, *args, **kwargs):
         """
@@ -69,6 +79,9 @@ class WikiTestManagerInterface(Component):
         
           testplan.sortby = {modification_time|name|custom}    (default is custom)
           testcase.open_new_window = {True|False}              (default is False)
+          tree.lazy_load = {True|False}                        (default is False)
+          tree_table.page_size = <number of test cases>        (default is 0, no paging)
+          http.conditional_responses = {True|False}            (default is True)
         """
         
         Component.__init__(self, *args, **kwargs)
@@ -80,19 +93,26 @@ class WikiTestManagerInterface(Component):
         if 'testmanager' in self.config:
             self.sortby = self.config.get('testmanager', 'testplan.sortby', 'custom')
             self.open_new_window = self.config.get('testmanager', 'testcase.open_new_window', '') == 'True'
+            self.lazy_load_tree = self.config.get('testmanager', 'tree.lazy_load', '') == 'True'
+            self.table_page_size = self.config.getint('testmanager', 'tree_table.page_size', 0)
+            self.conditional_responses = self.config.get('testmanager', 'http.conditional_responses', 'True') == 'True'
                         
     # IWikiChangeListener methods
     def wiki_page_added(self, page):
         """Called whenever a new Wiki page is added."""
-        #page_on_db = WikiPage(self.env, page.name)
-        pass
+        TestManagerModelProvider(self.env).update_test_page_index(page.name)
+        self._invalidate_data_models(page.name)
 
     def wiki_page_changed(self, page, version, t, comment, author, ipnr):
         """Called when a page has been modified."""
-        pass
+        TestManagerModelProvider(self.env).update_test_page_index(page.name)
+        self._invalidate_data_models(page.name)
 
     def wiki_page_deleted(self, page):
         """Called when a page has been deleted."""
+        TestManagerModelProvider(self.env).remove_from_test_page_index(page.name)
+        self._invalidate_data_models(page.name)
+
         if page.name.find('_TC') >= 0:
             # Delete test case
             tc_id = page.name.rpartition('_TC')[2]
@@ -117,14 +137,163 @@ class WikiTestManagerInterface(Component):
         """Called when a version of a page has been deleted."""
         
         # TODO Maybe should look into all test plans with "snapshot" test case versions and handle this deletion in some way?
-        pass
+
+        # The latest version may have changed
+        TestManagerModelProvider(self.env).update_test_page_index(page.name)
+        self._invalidate_data_models(page.name)
 
     def wiki_page_renamed(self, page, old_name): 
         """Called when a page has been renamed.""" 
         
         if page.name.find('TC_') == 0:
             raise TracError(_("You cannot rename Test Catalog, Test Case or Test Plan wiki pages this way. If you wish to modify the TITLE of the object, just Edit the page and change the text between '==' and '=='. If you wish to move the object elsewhere, instead, use the 'move' Test Manager functions."))
+
+        model_provider = TestManagerModelProvider(self.env)
+        model_provider.remove_from_test_page_index(old_name)
+        model_provider.update_test_page_index(page.name)
+        self._invalidate_data_models(old_name)
+        self._invalidate_data_models(page.name)
+
+    def _invalidate_data_models(self, page_name):
+        """
+        Invalidates the cached catalog trees containing the specified 
+        page and the cached renderings of its description.
+        """
+        if TestManagerModelProvider(self.env).is_test_page(page_name):
+            testmanagersystem = TestManagerSystem(self.env)
+            testmanagersystem.invalidate_test_catalog_data_models(page_name)
+            testmanagersystem.invalidate_rendered_descriptions(page_name)
+        
+    # IRequestHandler methods
+    def match_request(self, req):
+        return (req.path_info.startswith('/testtreefragment') or req.path_info.startswith('/testtreefilter')) and 'TEST_VIEW' in req.perm
+
+    def process_request(self, req):
+        """
+        Handles Ajax requests for the children of a catalog, when the
+        tree is loaded lazily.
+        """
+        req.perm.require('TEST_VIEW')
+        
+        if req.path_info.startswith('/testtreefilter'):
+            return self._process_tree_filter_request(req)
+
+        self._parse_config_options()
+
+        page_name = req.args.get('page', 'TC')
+        planid = req.args.get('planid', '-1')
+        node_id = req.args.get('node', 'b')
+        
+        # Whether to return the whole subtree at once, as for "Expand all"
+        load_all = req.args.get('all', '') == 'true'
+
+        result = 'ERROR'
+
+        try:
+            include_status = (planid != '-1')
+            if load_all:
+                components = TestManagerSystem(self.env).get_test_catalog_data_model(page_name, include_status, planid, self.sortby)
+            else:
+                components = TestManagerSystem(self.env).get_test_catalog_level_data_model(page_name, include_status, planid, self.sortby)
+                
+            result = self._render_subtree_level(planid, components, node_id, load_all)
+        except:
+            self.env.log.error(formatExceptionInfo())
+
+        if isinstance(result, unicode): 
+            result = result.encode('utf-8') 
+
+        req.send_header("Content-Type", "text/html;charset=utf-8")
+        req.send_header("Content-Length", len(result))
+        req.write(result)
+        return
+
+    def _process_tree_filter_request(self, req):
+        """
+        Handles Ajax requests for filtering a lazily loaded tree.
+        
+        Returns the test catalogs and test cases matching the filter, 
+        with the path of the catalogs leading to each of them, so that
+        only those catalogs need to be loaded:
+        
+          {"count": 2, 
+           "matches": [{"id": "TC_TT1_TT2_TC3", "path": ["TC_TT1", "TC_TT1_TT2"]}, ...]}
+        """
+        page_name = req.args.get('page', 'TC')
+        planid = req.args.get('planid', '-1')
+        filter_terms = req.args.get('filter', '').lower().split()
+
+        result = 'ERROR'
+
+        try:
+            include_status = (planid != '-1')
+            matches = [{'id': name, 'path': path} for name, path in 
+                TestManagerSystem(self.env).filter_test_catalog_tree(page_name, include_status, planid, filter_terms)]
+            result = json.dumps({'count': len(matches), 'matches': matches})
+        except:
+            self.env.log.error(formatExceptionInfo())
+
+        req.send_header("Content-Type", "application/json")
+        req.send_header("Content-Length", len(result))
+        req.write(result)
+        return
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        """
+        Answers with "304 Not Modified" the repeated requests for a 
+        catalog or test plan page that has not changed since.
+        """
+        if req.method == 'GET' and isinstance(handler, WikiModule):
+            page_name = req.args.get('page', '')
+            
+            if (page_name == 'TC' or (page_name.startswith('TC_') and page_name.find('_TC') < 0)) and \
+                    req.args.get('action', 'view') == 'view' and not req.args.get('version'):
+
+                self._parse_config_options()
+
+                if self.conditional_responses and 'TEST_VIEW' in req.perm:
+                    self._check_view_modified(req, page_name, req.args.get('planid', '-1'))
+                
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    def _check_view_modified(self, req, page_name, planid):
+        """
+        Sends the ETag and Last-Modified headers for a catalog or test 
+        plan view, and ends the request with a 304 response if the 
+        client already has the current version of the view.
+        """
+        # Messages pending from a previous request must be shown
+        for key in req.session.keys():
+            if key.startswith('chrome.notices.') or key.startswith('chrome.warnings.'):
+                return
+
+        if not planid or planid == '-1':
+            planid = None
+            
+        testmanagersystem = TestManagerSystem(self.env)
         
+        generation = testmanagersystem.get_data_model_generation(page_name)
+        last_change = testmanagersystem.get_test_catalog_last_change(page_name, planid)
+        
+        if generation is None or last_change is None:
+            return
+
+        # Everything else the view depends on
+        state = [generation, planid,
+            sorted(self.config.options('testmanager')),
+            sorted(PermissionSystem(self.env).get_user_permissions(req.authname)),
+            unicode(getattr(req, 'locale', None)), unicode(req.tz)]
+
+        req.send_header('Last-Modified', http_date(last_change))
+        
+        # Raises RequestDone after sending a 304 response if the ETag 
+        # matches the one sent by the client
+        req.check_modified(last_change, hashlib.md5(repr(state)).hexdigest())
+
     # ITemplateStreamFilter methods
     def filter_stream(self, req, method, filename, stream, data):
         self._parse_config_options()
@@ -188,8 +357,10 @@ class WikiTestManagerInterface(Component):
         table_columns = None
         table_columns_map = None
         custom_ctx = None
+        paging = None
         if mode == 'tree_table':
             table_columns, table_columns_map, custom_ctx = get_all_table_columns_for_object(self.env, 'testcatalog', self.env.config)
+            paging = self._get_table_paging(req)
         
         tmmodelprovider = GenericClassModelProvider(self.env)
         test_catalog = TestCatalog(self.env, cat_id, page_name)
@@ -235,7 +406,7 @@ class WikiTestManagerInterface(Component):
             buttonLabel = _("Add a Sub-Catalog")
 
         insert2 = tag.div()(
-                    HTML(self._build_catalog_tree(formatter.context, page_name, mode, fulldetails, table_columns, table_columns_map, custom_ctx)),
+                    HTML(self._build_catalog_tree(formatter.context, page_name, mode, fulldetails, table_columns, table_columns_map, custom_ctx, paging)),
                     tag.div(class_='testCaseList')(
                         tag.br(), tag.br()
                     ))
@@ -346,8 +517,10 @@ class WikiTestManagerInterface(Component):
         table_columns = None
         table_columns_map = None
         custom_ctx = None
+        paging = None
         if mode == 'tree_table':
             table_columns, table_columns_map, custom_ctx = get_all_table_columns_for_object(self.env, 'testplan', self.env.config)
+            paging = self._get_table_paging(req)
             
         tmmodelprovider = GenericClassModelProvider(self.env)
         tp = TestPlan(self.env, planid)
@@ -365,7 +538,7 @@ class WikiTestManagerInterface(Component):
                     )
 
         insert2 = tag.div()(
-                    HTML(self._build_testplan_tree(formatter.context, str(planid), page_name, mode, self.sortby, table_columns, table_columns_map, custom_ctx)),
+                    HTML(self._build_testplan_tree(formatter.context, str(planid), page_name, mode, self.sortby, table_columns, table_columns_map, custom_ctx, paging)),
                     tag.div(class_='testCaseList')(
                     tag.br(),
                     self._get_custom_fields_markup(tp, tmmodelprovider.get_custom_fields_for_realm('testplan')),
@@ -1091,7 +1264,7 @@ class WikiTestManagerInterface(Component):
 
         return text    
                 
-    def _build_catalog_tree(self, context, curpage, mode='tree', fulldetails=False, table_columns=None, table_columns_map=None, custom_ctx=None):
+    def _build_catalog_tree(self, context, curpage, mode='tree', fulldetails=False, table_columns=None, table_columns_map=None, custom_ctx=None, paging=None):
         # Determine current catalog name
         cat_name = 'TC'
         if curpage.find('_TC') >= 0:
@@ -1104,8 +1277,15 @@ class WikiTestManagerInterface(Component):
             mode = 'tree'
             fulldetails = False
 
+        if mode == 'tree_table' and paging is not None:
+            return self._render_paged_table(context, None, curpage, paging, 'testCatalogRunBook', table_columns, table_columns_map, custom_ctx, fulldetails)
+
         # Create the catalog subtree model
-        components = TestManagerSystem(self.env).get_test_catalog_data_model(curpage)
+        if mode == 'tree' and self.lazy_load_tree:
+            # Only the first level, the rest is loaded on expand
+            components = TestManagerSystem(self.env).get_test_catalog_level_data_model(curpage)
+        else:
+            components = TestManagerSystem(self.env).get_test_catalog_data_model(curpage)
 
         # Generate the markup
         ind = {'count': 0, 'totals': None}
@@ -1114,9 +1294,15 @@ class WikiTestManagerInterface(Component):
         if mode == 'tree':
             text +='<div style="padding: 0px 0px 10px 10px">'+_("Filter:")+' <input id="tcFilter" title="'+_("Type the test to search for, even more than one word. You can also filter on the test case status (untested, successful, failed).")+'" type="text" size="40" onkeyup="starthighlight(\'ticketContainer\', this.value)"/>&nbsp;&nbsp;<span id="ticketContainer_searchResultsNumberId" style="font-weight: bold;"></span></div>'
             text +='<div style="font-size: 0.8em;padding-left: 10px"><a style="margin-right: 10px" onclick="toggleAll(\'ticketContainer\', true)" href="javascript:void(0)">'+_("Expand all")+'</a><a onclick="toggleAll(\'ticketContainer\', false)" href="javascript:void(0)">'+_("Collapse all")+'</a></div>'
-            text +='<div id="ticketContainer">'
-
-            text += self._render_subtree('-1', components, ind, 0)
+            if self.lazy_load_tree:
+                # Not all the nodes are in the page, so the filter is evaluated by the server
+                text +='<div id="ticketContainer" lazypage="'+curpage+'" lazyplanid="-1">'
+                text +='<ul style="list-style: none;">'
+                text += self._render_subtree_level('-1', components, 'b')
+                text +='</ul>'
+            else:
+                text +='<div id="ticketContainer">'
+                text += self._render_subtree('-1', components, ind, 0)
             
             text +='</div>'
             
@@ -1134,19 +1320,23 @@ class WikiTestManagerInterface(Component):
                 if col['totals'] is not None:
                     totals[col['name']] = {'operation': col['totals'], 'count': 0, 'sum': 0, 'average': 0}
 
-            ind['totals'] = totals
+            # Custom field totals are computed by the database, the 
+            # others while rendering the rows
+            custom_names = self._compute_custom_totals(totals, curpage, None, custom_ctx)
+            ind['totals'] = dict([(name, totals[name]) for name in totals if name not in custom_names])
             text += '</tr></thead><tbody>';
             
+            ind['prefetched'] = self._prefetch_table_data(context, None, table_columns_map, custom_ctx, fulldetails, page_prefix=curpage+'_')
             text += self._render_subtree_as_table(context, None, components, ind, 0, table_columns, table_columns_map, custom_ctx, fulldetails)
             
-            text += self._render_totals(table_columns, ind['totals'])
+            text += self._render_totals(table_columns, totals)
             
             text += '</tbody></table>'
             text += '</fieldset></form>'
         
         return text
     
-    def _build_testplan_tree(self, context, planid, curpage, mode='tree', sortby='custom', table_columns=None, table_columns_map=None, custom_ctx=None):
+    def _build_testplan_tree(self, context, planid, curpage, mode='tree', sortby='custom', table_columns=None, table_columns_map=None, custom_ctx=None, paging=None):
         testmanagersystem = TestManagerSystem(self.env)
         default_status = testmanagersystem.get_default_tc_status()
         
@@ -1157,8 +1347,15 @@ class WikiTestManagerInterface(Component):
         elif not curpage == 'TC':
             cat_name = curpage.rpartition('_')[2]
 
+        if mode == 'tree_table' and paging is not None:
+            return self._render_paged_table(context, planid, curpage, paging, 'testPlan', table_columns, table_columns_map, custom_ctx)
+
         # Create the catalog subtree model
-        components = TestManagerSystem(self.env).get_test_catalog_data_model(curpage, True, planid, sortby)
+        if mode == 'tree' and self.lazy_load_tree:
+            # Only the first level, the rest is loaded on expand
+            components = TestManagerSystem(self.env).get_test_catalog_level_data_model(curpage, True, planid, sortby)
+        else:
+            components = TestManagerSystem(self.env).get_test_catalog_data_model(curpage, True, planid, sortby)
 
         # Generate the markup
         ind = {'count': 0, 'totals': None}
@@ -1167,8 +1364,16 @@ class WikiTestManagerInterface(Component):
         if mode == 'tree':
             text +='<div style="padding: 0px 0px 10px 10px">'+_("Filter:")+' <input id="tcFilter" title="'+_("Type the test to search for, even more than one word. You can also filter on the test case status (untested, successful, failed).")+'" type="text" size="40" onkeyup="starthighlight(\'ticketContainer\', this.value)"/>&nbsp;&nbsp;<span id="ticketContainer_searchResultsNumberId" style="font-weight: bold;"></span></div>'
             text +='<div style="font-size: 0.8em;padding-left: 10px"><a style="margin-right: 10px" onclick="toggleAll(\'ticketContainer\', true)" href="javascript:void(0)">'+_("Expand all")+'</a><a onclick="toggleAll(\'ticketContainer\', false)" href="javascript:void(0)">'+_("Collapse all")+'</a></div>'
-            text +='<div id="ticketContainer">'
-            text += self._render_subtree(planid, components, ind, 0)
+            if self.lazy_load_tree:
+                # Not all the nodes are in the page, so the filter is evaluated by the server
+                text +='<div id="ticketContainer" lazypage="'+curpage+'" lazyplanid="'+planid+'">'
+                text +='<ul style="list-style: none;">'
+                text += self._render_subtree_level(planid, components, 'b')
+                text +='</ul>'
+            else:
+                text +='<div id="ticketContainer">'
+                text += self._render_subtree(planid, components, ind, 0)
+
             text +='</div>'
 
         elif mode == 'tree_table':
@@ -1185,13 +1390,17 @@ class WikiTestManagerInterface(Component):
                 if col['totals'] is not None:
                     totals[col['name']] = {'operation': col['totals'], 'count': 0, 'sum': 0, 'average': 0}
 
-            ind['totals'] = totals
+            # Custom field totals are computed by the database, the 
+            # others while rendering the rows
+            custom_names = self._compute_custom_totals(totals, curpage, planid, custom_ctx)
+            ind['totals'] = dict([(name, totals[name]) for name in totals if name not in custom_names])
                     
             text += '</tr></thead><tbody>';
             
+            ind['prefetched'] = self._prefetch_table_data(context, planid, table_columns_map, custom_ctx, page_prefix=curpage+'_')
             text += self._render_subtree_as_table(context, planid, components, ind, 0, table_columns, table_columns_map, custom_ctx)
 
-            text += self._render_totals(table_columns, ind['totals'])
+            text += self._render_totals(table_columns, totals)
             
             text += '</tbody></table>'
             text += '</fieldset></form>'
@@ -1337,6 +1546,66 @@ class WikiTestManagerInterface(Component):
             text+='</ul>'        
         return text
 
+    # Render a single level of the subtree, for lazy loading. 
+    # Sub-catalogs are rendered collapsed and empty, and their children 
+    # are requested to the server when they are expanded.
+    # With recursive set, the whole subtree in the data model is 
+    # rendered instead, with the sub-catalogs marked as already loaded.
+    def _render_subtree_level(self, planid, component, node_id, recursive=False):
+        data = component['childrenC']
+        text = u''
+        
+        sortedList = sorted(data, key=self._test_sorting(data))
+        
+        count = 0
+        for x in sortedList:
+            count += 1
+            comp = data[x]
+
+            if recursive:
+                has_children = (len(comp['childrenC']) + len(comp['childrenT'])) > 0
+            else:
+                has_children = comp['tot'] > 0 or comp['has_children']
+
+            toggle_icon = '../chrome/testmanager/images/plus.png'
+            toggable = 'toggable'
+            if not has_children:
+                toggable = 'nope'
+                toggle_icon = '../chrome/testmanager/images/empty.png'
+                
+            index = node_id+'_'+str(count)
+
+            has_status = True
+            if planid is not None and not planid == '-1':
+                plan_param = '?planid='+planid
+                color = [comp['color'], 'yellow'][comp['color'] == 'none']
+                statusIcon='../chrome/testmanager/images/%s.png' % color
+            else:
+                has_status = False
+                plan_param = ''
+
+            text+='<li style="font-weight: normal">'
+            text += '<span name="'+toggable+'" style="cursor: pointer" id="'+index+'" lazypage="'+comp['id']+'" lazyplanid="'+str(planid)+'"'
+            if recursive:
+                text += ' lazyloaded="true"'
+            text += '><span onclick="toggle(\''+index+'\')"><img class="iconElement" src="'+toggle_icon+'" /></span>'
+
+            # Include color icon for the aggregated status of all sub catalogs/test cases
+            if has_status:
+                text += '<img class="aggregatedStatusIconElement" style="cursor: default;" src="'+statusIcon+'"></img>'
+
+            text += '<span id="l_'+index+'" onmouseover="underlineLink(\'l_'+index+'\')" onmouseout="removeUnderlineLink(\'l_'+index+'\')" onclick="window.location=\''+comp['id']+plan_param+'\'" title="'+_("Open")+'">'+comp['title']+'</span></span><span style="color: gray;">&nbsp;('+str(comp['tot'])+')</span>'
+
+            text +='<ul id="'+index+'_list" style="display:none;list-style: none;">'
+            if recursive:
+                text += self._render_subtree_level(planid, comp, index, True)
+            text +='</ul>'
+            text+='</li>'
+
+        text += self._render_testcases(planid, component['childrenT'])
+
+        return text
+
     def _render_testcases(self, planid, data): 
         
         testmanagersystem = TestManagerSystem(self.env)
@@ -1449,7 +1718,7 @@ class WikiTestManagerInterface(Component):
                 tcat = None
                 if custom_ctx['testcatalog'][0]:
                     tcat_id = comp['id'].rpartition('TT')[2]
-                    tcat = TestCatalog(self.env, tcat_id)
+                    tcat = self._get_prefetched_values(ind, 'testcatalog', tcat_id, {'page_name': comp['id']})
                     text += self._get_custom_fields_columns(tcat, table_columns, table_columns_map, custom_ctx['testcatalog'][1])
 
                 text += '</tr>'
@@ -1476,6 +1745,11 @@ class WikiTestManagerInterface(Component):
 
         tc_target = ("", " target='_blank'")[self.open_new_window]
         
+        if 'prefetched' not in ind:
+            ind['prefetched'] = self._prefetch_table_data(context, planid, table_columns_map, custom_ctx, fulldetails, 
+                tc_ids=[tick['tc_id'] for tick in data.itervalues()], page_names=[tick['id'] for tick in data.itervalues()])
+
+
         text=u''
         #sortedList = sorted(data, key=self._test_sorting(data))
         sortedList = sorted(data)
@@ -1504,7 +1778,7 @@ class WikiTestManagerInterface(Component):
 
             tc = None
             if fulldetails or custom_ctx['testcase'][0] or table_columns_map['description']['visible'] == 'True':
-                tc = TestCase(self.env, tick['tc_id'])
+                tc = self._get_prefetched_values(ind, 'testcase', tick['tc_id'], {'page_name': tick['id'], 'exec_order': tick['exec_order']})
 
             text += '<tr name="testcase">'
 
@@ -1533,7 +1807,7 @@ class WikiTestManagerInterface(Component):
                 text += '<td>'+tick['tc_id']+'</td>'
 
             # Custom testcase columns
-            if tc and tc.exists and custom_ctx['testcase'][0]:
+            if tc and custom_ctx['testcase'][0]:
                 text += self._get_custom_fields_columns(tc, table_columns, table_columns_map, custom_ctx['testcase'][1])
 
             self._update_totals(ind['totals'], tc)
@@ -1546,23 +1820,26 @@ class WikiTestManagerInterface(Component):
                     text += '<td>'+html_escape(tick['author'])+'</td>'
                 if table_columns_map['time']['visible'] == 'True':
                     text += '<td>'+format_datetime(tick['ts'])+'</td>'
+                if table_columns_map['tickets']['visible'] == 'True':
+                    text += '<td>'+str(len(ind['prefetched']['tickets'].get(tick['id'], [])))+'</td>'
                 
                 # Custom testcaseinplan columns
                 tcip = None
                 if custom_ctx['testcaseinplan'][0]:
-                    tcip = TestCaseInPlan(self.env, tick['tc_id'], planid)
+                    tcip = self._get_prefetched_values(ind, 'testcaseinplan', tick['tc_id'], {'planid': planid, 'page_name': tick['id'], 'status': status})
                     text += self._get_custom_fields_columns(tcip, table_columns, table_columns_map, custom_ctx['testcaseinplan'][1])
 
                 self._update_totals(ind['totals'], tcip)
                     
             #if fulldetails:
             if table_columns_map['description']['visible'] == 'True':
-                wikidom = WikiParser(self.env).parse(tc.description)
-                out = StringIO()
-                f = Formatter(self.env, context)
-                f.reset(wikidom)
-                f.format(wikidom, out, False)
-                description = out.getvalue()
+                page_text = ind['prefetched']['texts'].get(tick['id'])
+                if page_text is not None:
+                    page_text = get_page_description(page_text)
+                    
+                version, changetime = ind['prefetched']['versions'].get(tick['id'], (None, None))
+                description = testmanagersystem.render_description(context, tick['id'], 
+                    version, page_text, changetime=changetime)
 
                 text += '<td>'+description+'</td>'
 
@@ -1570,6 +1847,189 @@ class WikiTestManagerInterface(Component):
             
         return text
 
+    def _get_table_paging(self, req):
+        """
+        Returns the paging parameters for the tree_table view, or None
+        if the table must be rendered as a whole.
+        """
+        try:
+            page_size = int(req.args.get('page_size', self.table_page_size))
+            offset = max(0, int(req.args.get('offset', 0)))
+        except ValueError:
+            page_size = self.table_page_size
+            offset = 0
+
+        if page_size <= 0:
+            return None
+
+        filter_str = req.args.get('filter', '')
+
+        return {'page_size': page_size, 'offset': offset, 
+            'sort': req.args.get('sort', 'custom'), 
+            'filter': filter_str, 'filter_terms': filter_str.lower().split()}
+
+    # Render a page of the test cases in the catalog or plan as a flat
+    # table, with filtering, sorting and paging performed on the server.
+    def _render_paged_table(self, context, planid, curpage, paging, form_id, table_columns=None, table_columns_map=None, custom_ctx=None, fulldetails=False):
+        testmanagersystem = TestManagerSystem(self.env)
+        include_status = planid is not None
+        
+        rows, total = testmanagersystem.list_test_catalog_table_rows(curpage, include_status, planid, 
+            paging['sort'], paging['filter_terms'], paging['offset'], paging['page_size'])
+
+        url_args = {'mode': 'tree_table', 'fulldetails': str(fulldetails), 
+            'page_size': paging['page_size'], 'sort': paging['sort'], 'filter': paging['filter']}
+        if include_status:
+            url_args['planid'] = planid
+
+        def page_url(**kwargs):
+            args = dict(url_args)
+            args.update(kwargs)
+            return '?' + unicode_urlencode(args).replace('&', '&amp;')
+
+        text = u'<form method="get" action="" style="padding: 0px 0px 10px 10px">'+_("Filter:")+' <input id="tcFilter" name="filter" title="'+_("Type the test to search for, even more than one word. You can also filter on the test case status (untested, successful, failed).")+'" type="text" size="40" value="'+html_escape(paging['filter'])+'"/>'
+        for name in ('mode', 'fulldetails', 'page_size', 'sort', 'planid'):
+            if name in url_args:
+                text += '<input type="hidden" name="'+name+'" value="'+html_escape(unicode(url_args[name]))+'"/>'
+        text += '&nbsp;&nbsp;<span style="font-weight: bold;">'+_("Results: ")+str(total)+'</span></form>'
+
+        text += '<form id="'+form_id+'" class="printableform"><fieldset id="'+form_id+'Fields" class="expanded">'
+        text += '<table id="testcaseList" class="listing"><thead><tr>'
+
+        sortable_columns = {'title': 'title'}
+        if include_status:
+            sortable_columns.update({'status': 'status', 'time': 'time'})
+
+        # Prepare a container for calculating and keeping the totals
+        totals = {}
+        for col in table_columns:
+            if col['visible'] == 'True':
+                if col['name'] in sortable_columns:
+                    text += '<th><a href="'+page_url(sort=sortable_columns[col['name']], offset=0)+'">'+col['label']+'</a></th>'
+                else:
+                    text += '<th>'+col['label']+'</th>'
+            
+            if col['totals'] is not None:
+                totals[col['name']] = {'operation': col['totals'], 'count': 0, 'sum': 0, 'average': 0}
+
+        text += '</tr></thead><tbody>'
+
+        data = {}
+        for i, tick in enumerate(rows):
+            data['%08d' % i] = tick
+
+        ind = {'count': 0, 'totals': {}}
+        ind['prefetched'] = self._prefetch_table_data(context, planid, table_columns_map, custom_ctx, fulldetails, 
+            tc_ids=[tick['tc_id'] for tick in rows], page_names=[tick['id'] for tick in rows])
+        text += self._render_testcases_as_table(context, planid, data, ind, 0, table_columns, table_columns_map, custom_ctx, fulldetails)
+
+        self._compute_paged_table_totals(totals, total, curpage, planid, paging, custom_ctx)
+        text += self._render_totals(table_columns, totals)
+        
+        text += '</tbody></table>'
+
+        # Navigation
+        offset = paging['offset']
+        page_size = paging['page_size']
+        text += '<div style="padding: 5px 0px 0px 10px">'
+        if offset > 0:
+            text += '<a href="'+page_url(offset=max(0, offset - page_size))+'">&larr; '+_("Previous")+'</a>&nbsp;&nbsp;'
+        if total > 0:
+            text += str(offset + 1)+' - '+str(min(offset + page_size, total))+' / '+str(total)
+        if offset + page_size < total:
+            text += '&nbsp;&nbsp;<a href="'+page_url(offset=offset + page_size)+'">'+_("Next")+' &rarr;</a>'
+        text += '</div>'
+        
+        text += '</fieldset></form>'
+
+        return text
+
+    def _compute_paged_table_totals(self, totals, total, curpage, planid, paging, custom_ctx):
+        """
+        Computes the column totals over all the test cases matching the
+        filter, not only over the ones in the current page.
+        """
+        custom_names = self._compute_custom_totals(totals, curpage, planid, custom_ctx, paging['filter_terms'], False)
+
+        # Standard columns are never empty
+        for col in totals:
+            if col not in custom_names and totals[col]['operation'] == 'count':
+                totals[col]['count'] = total
+
+    def _compute_custom_totals(self, totals, curpage, planid, custom_ctx, filter_terms=None, include_catalogs=True):
+        """
+        Computes the totals of the custom field columns in the database,
+        aggregating on the distinct field values. 
+        Returns the names of the columns computed.
+        """
+        testmanagersystem = TestManagerSystem(self.env)
+        include_status = planid is not None
+
+        realms = ['testcase']
+        if include_catalogs:
+            realms.append('testcatalog')
+        if include_status:
+            realms.append('testcaseinplan')
+
+        custom_names = []
+        for realm in realms:
+            if not custom_ctx[realm][0]:
+                continue
+
+            names = [f['name'] for f in custom_ctx[realm][1] if f['name'] in totals]
+            custom_names.extend(names)
+
+            for name, value, count in testmanagersystem.list_test_catalog_table_custom_value_counts(realm, names, curpage, include_status, planid, filter_terms):
+                self._update_totals_with_value_count(totals[name], value, count)
+
+        return custom_names
+
+    def _prefetch_table_data(self, context, planid, table_columns_map, custom_ctx, fulldetails=False, page_prefix=None, tc_ids=None, page_names=None):
+        """
+        Loads in advance all the custom field values and page texts 
+        needed to render a table, either for a whole catalog subtree
+        (page_prefix) or for a set of test cases (tc_ids and page_names).
+        """
+        loader = BulkLoader(self.env)
+        
+        prefetched = {'testcatalog': {}, 'testcase': {}, 'testcaseinplan': {}, 'versions': {}, 'texts': {}, 'tickets': {}}
+        
+        if custom_ctx['testcatalog'][0] and page_prefix is not None:
+            prefetched['testcatalog'] = loader.load_custom_values('testcatalog', page_prefix)
+            
+        if custom_ctx['testcase'][0]:
+            prefetched['testcase'] = loader.load_custom_values('testcase', page_prefix, tc_ids)
+            
+        if planid is not None and custom_ctx['testcaseinplan'][0]:
+            prefetched['testcaseinplan'] = loader.load_custom_values('testcaseinplan', page_prefix, tc_ids, planid)
+
+        if planid is not None and table_columns_map['tickets']['visible'] == 'True':
+            prefetched['tickets'] = loader.load_related_tickets(planid, page_prefix, page_names)
+
+        if table_columns_map['description']['visible'] == 'True':
+            # Only the texts of the descriptions not rendered yet are needed
+            testmanagersystem = TestManagerSystem(self.env)
+            prefetched['versions'] = loader.load_page_versions(page_prefix, page_names)
+            
+            missing = [name for name, (version, changetime) in prefetched['versions'].iteritems() 
+                if not testmanagersystem.is_description_cached(context, name, version, changetime)]
+                
+            if len(missing) > 0:
+                prefetched['texts'] = loader.load_page_texts(page_names=missing)
+
+        return prefetched
+
+    def _get_prefetched_values(self, ind, realm, obj_id, std_values):
+        """
+        Returns the values of a test object, made of the specified
+        standard values and the prefetched custom values.
+        """
+        values = PrefetchedValues(std_values)
+        values['id'] = obj_id
+        values.update(ind['prefetched'][realm].get(obj_id, {}))
+
+        return values
+        
     def _render_totals(self, table_columns, totals):
         text = u''
     
@@ -1802,7 +2262,6 @@ class WikiTestManagerInterface(Component):
         return text
 
     def _update_totals(self, totals, obj):
-        self.env.log.debug(">>> _update_totals: %s %s", totals, obj)
         if obj is not None:
             for col in totals:
                 col_totals = totals[col]
@@ -1827,8 +2286,6 @@ class WikiTestManagerInterface(Component):
                     val = self._get_field_value(col, obj)
                     if val != 0:
                         col_totals['count'] += 1
-
-        self.env.log.debug("<<< _update_totals: %s", totals)
                         
     def _get_custom_fields_columns(self, obj, table_columns, table_columns_map, fields):
         result = u''
@@ -1845,18 +2302,38 @@ class WikiTestManagerInterface(Component):
 
         return result
 
+    def _update_totals_with_value_count(self, col_totals, value, count):
+        """
+        Updates the totals of a column as if _update_totals() was called
+        on the specified number of objects with the same value.
+        """
+        val = self._get_numeric_value(value)
+        
+        operation = col_totals['operation']
+        if operation == 'sum':
+            col_totals['sum'] += val * count
+
+        elif operation == 'average':
+            if val != 0:
+                prev_count = col_totals['count']
+                col_totals['average'] = (val * count + col_totals['average'] * prev_count) / (prev_count + count)
+                col_totals['count'] += count
+
+        elif operation == 'count':
+            if val != 0:
+                col_totals['count'] += count
+
     def _get_field_value(self, col_name, obj):
+        return self._get_numeric_value(obj[col_name])
+
+    def _get_numeric_value(self, value):
         result = 0
-        self.env.log.debug(">>> _get_field_value %s %s", col_name, obj)
-        if obj[col_name] is not None and obj[col_name] != '':
+        if value is not None and value != '':
             try:
-                self.env.log.debug("    _get_field_value - value: %s", obj[col_name])
                 # Try to parse the value as a number
-                result = float(obj[col_name])
+                result = float(value)
             except:
                 # Just count as 1 (non-empty value)
                 result = 1
 
-        self.env.log.debug("<<< _get_field_value: %s", result)
-                
         return result
@@ -20,8 +20,11 @@
 # If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
+import Queue
 import re
 import sys
+import threading
 import time
 import traceback
 
@@ -44,6 +47,8 @@ class IGenericObjectChangeListener(Interface):
     """
     Extension point interface for components that require notification
     when objects are created, modified, or deleted.
+    
+    The realm of the object is available as `g_object.realm`.
     """
 
     def object_created(g_object):
@@ -60,6 +65,42 @@ class IGenericObjectChangeListener(Interface):
         """Called when an object is deleted."""
 
 
+class IGenericObjectBatchChangeListener(Interface):
+    """
+    Extension point interface for components that require notification
+    of the object changes in batches.
+    
+    Inside a GenericClassSystem.with_deferred_listeners() unit of work,
+    all of the changes are delivered at once after the commit. 
+    Otherwise, each change is delivered alone, as it happens.
+    
+    Listeners named in the [tracgenericclass] background_listeners 
+    option are called on a background worker thread, instead of in
+    the request thread.
+    """
+
+    def objects_changed(changes):
+        """Called with a list of GenericObjectChange, in the order
+        they happened.
+        """
+
+
+class GenericObjectChange(object):
+    """
+    The creation, modification or deletion of an object.
+    
+    `action` is one of 'created', 'changed' or 'deleted'. The 
+    `comment`, `author` and `old_values` are only set for changes.
+    """
+    def __init__(self, action, g_object, comment=None, author=None, old_values=None):
+        self.action = action
+        self.realm = g_object.realm
+        self.g_object = g_object
+        self.comment = comment
+        self.author = author
+        self.old_values = old_values
+
+
 class GenericClassSystem(Component):
     """
     Generic Class system for Trac.
@@ -68,21 +109,136 @@ class GenericClassSystem(Component):
     implements(IRequestHandler, ITemplateProvider, ISearchSource)
 
     change_listeners = ExtensionPoint(IGenericObjectChangeListener)
+    batch_change_listeners = ExtensionPoint(IGenericObjectBatchChangeListener)
+
+    def __init__(self, *args, **kwargs):
+        Component.__init__(self, *args, **kwargs)
+
+        # Thread local stack of the change queues of the open units 
+        # of work
+        self._deferred = threading.local()
+
+        self._worker_queue = None
+        self._worker_lock = threading.Lock()
 
         
     # Change listeners management
 
     def object_created(self, testobject):
-        for c in self.change_listeners:
-            c.object_created(testobject)
+        self._dispatch(GenericObjectChange('created', testobject))
 
-    def object_changed(self, testobject, comment, author):
-        for c in self.change_listeners:
-            c.object_changed(testobject, comment, author, testobject._old)
+    def object_changed(self, testobject, comment, author, old_values=None):
+        if old_values is None:
+            old_values = testobject._old
+            
+        self._dispatch(GenericObjectChange('changed', testobject, comment, author, old_values))
 
     def object_deleted(self, testobject):
-        for c in self.change_listeners:
-            c.object_deleted(testobject)
+        self._dispatch(GenericObjectChange('deleted', testobject))
+
+    def with_deferred_listeners(self, db=None):
+        """
+        Decorator running the decorated function in a transaction, as 
+        `with_transaction()` does, as a unit of work: the changes to
+        the objects are queued and the listeners are called only after
+        the transaction has been committed, with all the changes at 
+        once for the batch listeners.
+        
+        If the transaction is rolled back, the listeners are not 
+        called at all.
+        Units of work can be nested, the changes being delivered at the
+        end of the outermost one. When running inside an enclosing 
+        transaction, as with a `db` argument, the changes are delivered
+        when the function returns, before the enclosing commit.
+        """
+        def wrap(fn):
+            stack = self._get_deferred_stack()
+            stack.append([])
+            try:
+                @self.env.with_transaction(db)
+                def do_with_deferred_listeners(db):
+                    fn(db)
+            except:
+                stack.pop()
+                raise
+                
+            changes = stack.pop()
+            if len(stack) > 0:
+                stack[-1].extend(changes)
+            else:
+                self._deliver(changes)
+                
+        return wrap
+
+    def _get_deferred_stack(self):
+        if not hasattr(self._deferred, 'stack'):
+            self._deferred.stack = []
+            
+        return self._deferred.stack
+        
+    def _dispatch(self, change):
+        stack = self._get_deferred_stack()
+        if len(stack) > 0:
+            stack[-1].append(change)
+        else:
+            self._deliver([change])
+
+    def _deliver(self, changes):
+        if len(changes) == 0:
+            return
+            
+        # The changes are already committed, so a failing listener 
+        # must neither stop the other ones nor fail the caller
+        for change in changes:
+            for c in self.change_listeners:
+                try:
+                    if change.action == 'created':
+                        c.object_created(change.g_object)
+                    elif change.action == 'changed':
+                        c.object_changed(change.g_object, change.comment, change.author, change.old_values)
+                    else:
+                        c.object_deleted(change.g_object)
+                except:
+                    self.env.log.error("Error delivering the %s object change to %s" % (change.action, c.__class__.__name__))
+                    self.env.log.error(formatExceptionInfo())
+
+        background_listeners = self.config.getlist('tracgenericclass', 'background_listeners', [])
+        for c in self.batch_change_listeners:
+            if c.__class__.__name__ in background_listeners:
+                self._get_worker_queue().put((c, changes))
+            else:
+                try:
+                    c.objects_changed(changes)
+                except:
+                    self.env.log.error("Error delivering %s object changes to %s" % (len(changes), c.__class__.__name__))
+                    self.env.log.error(formatExceptionInfo())
+
+    def _get_worker_queue(self):
+        """
+        Returns the queue of the background worker delivering the 
+        changes to the background listeners, starting it if needed.
+        """
+        self._worker_lock.acquire()
+        try:
+            if self._worker_queue is None:
+                self._worker_queue = Queue.Queue()
+                
+                worker = threading.Thread(target=self._run_worker, name='tracgenericclass listeners')
+                worker.setDaemon(True)
+                worker.start()
+        finally:
+            self._worker_lock.release()
+            
+        return self._worker_queue
+        
+    def _run_worker(self):
+        while True:
+            listener, changes = self._worker_queue.get()
+            try:
+                listener.objects_changed(changes)
+            except:
+                self.env.log.error("Error delivering %s object changes to %s" % (len(changes), listener.__class__.__name__))
+                self.env.log.error(formatExceptionInfo())
 
        
     # IRequestHandler methods
@@ -93,51 +249,23 @@ class GenericClassSystem(Component):
     def process_request(self, req):
         """
         Handles Ajax requests to change an object's property.
+        
+        Many properties, possibly of many objects, can be changed at 
+        once by passing an 'updates' argument, with a JSON list of 
+        objects with the same 'realm', 'key', 'name', 'value' and 
+        optional 'props' fields as the single property request.
         """
-        author = get_reporter_id(req, 'author')
-
         if req.path_info.startswith('/propertyupdate'):
-            realm = req.args.get('realm')
-            key_str = req.args.get('key')
-            name = req.args.get('name')
-            value = req.args.get('value')
-            
             result = 'ERROR'
             
-            key = get_dictionary_from_string(key_str)
-
             try:
-                self.env.log.debug("Setting property %s to %s, in %s with key %s" % (name, value, realm, key))
-                
-                gclass_modelprovider = GenericClassModelProvider(self.env)
-
-                gclass_modelprovider.check_permission(req, realm, key_str, name, value)
-
-                obj = gclass_modelprovider.get_object(realm, key)
-                
-                # Set the required property
-                obj[name] = value
-                
-                obj.author = author
-                obj.remote_addr = req.remote_addr
-                if obj is not None and obj.exists:
-                    comment = "Property changed"
-                    obj.save_changes(author, comment)
-
-                    # Call listeners
-                    self.object_changed(obj, comment, author)
-                    
+                updates_str = req.args.get('updates')
+                if updates_str is not None and not updates_str == '':
+                    updates = json.loads(updates_str)
                 else:
-                    self.env.log.debug("Object to update not found. Creating it.")
-                    props_str = req.args.get('props')
-                    if props_str is not None and not props_str == '':
-                        # In order to create an object, additional properties may be required
-                        props = get_dictionary_from_string(props_str)
-                        obj.set_values(props)
-                    obj.insert()
+                    updates = [dict((k, req.args.get(k)) for k in ('realm', 'key', 'name', 'value', 'props'))]
 
-                    # Call listeners
-                    self.object_created(obj)
+                self.update_properties(req, updates)
 
                 result = 'OK'
 
@@ -151,6 +279,73 @@ class GenericClassSystem(Component):
         return 'empty.html', {}, None
 
 
+    def update_properties(self, req, updates):
+        """
+        Sets the specified properties of the specified objects, 
+        creating the objects not found.
+        
+        The updates are grouped per object, so that each object is 
+        saved only once and the change listeners are called once per 
+        object. All of the objects are saved in a single transaction.
+        
+        :updates: a list of dictionaries with the 'realm', 'key', 
+                  'name' and 'value' of each property to set, and 
+                  optionally the 'props' needed to create the object.
+        """
+        author = get_reporter_id(req, 'author')
+        gclass_modelprovider = GenericClassModelProvider(self.env)
+
+        # Group the updates per object, keeping their order
+        objects = []
+        updates_by_obj = {}
+        for update in updates:
+            realm = update['realm']
+            key_str = update['key']
+            name = update['name']
+            value = update['value']
+            
+            gclass_modelprovider.check_permission(req, realm, key_str, 'set', name, value)
+
+            if (realm, key_str) not in updates_by_obj:
+                objects.append((realm, key_str))
+                updates_by_obj[(realm, key_str)] = {'props': None, 'values': []}
+            
+            obj_updates = updates_by_obj[(realm, key_str)]
+            obj_updates['values'].append((name, value))
+            if update.get('props'):
+                obj_updates['props'] = update['props']
+
+        @self.with_deferred_listeners()
+        def do_update_properties(db):
+            for realm, key_str in objects:
+                obj_updates = updates_by_obj[(realm, key_str)]
+                key = get_dictionary_from_string(key_str)
+                
+                self.env.log.debug("Setting properties %s, in %s with key %s" % (obj_updates['values'], realm, key))
+                
+                obj = gclass_modelprovider.get_object(realm, key)
+                
+                # Set the required properties
+                for name, value in obj_updates['values']:
+                    obj[name] = value
+                
+                obj.author = author
+                obj.remote_addr = req.remote_addr
+                if obj.exists:
+                    # This also calls the change listeners
+                    obj.save_changes(author, "Property changed", db=db)
+                else:
+                    self.env.log.debug("Object to update not found. Creating it.")
+                    props_str = obj_updates['props']
+                    if props_str is not None and not props_str == '':
+                        # In order to create an object, additional properties may be required
+                        props = get_dictionary_from_string(props_str)
+                        obj.set_values(props)
+                        
+                    # This also calls the change listeners
+                    obj.insert(db=db)
+
+
     # ITemplateProvider methods
     def get_templates_dirs(self):
         """
@@ -458,6 +458,36 @@ class AbstractVariableFieldsObject(object):
             if name[9:] not in values:
                 self[name[9:]] = '0'
 
+    def set_loaded_values(self, values, exists=True, db=None):
+        """
+        Sets the values of this object, already loaded from the database
+        along with the ones of many other objects, instead of fetching 
+        them with a query per object.
+        
+        With `exists` False, the values are the key and the initial 
+        values of a new object, known not to be in the database yet.
+        """
+        if exists:
+            self.values = {}
+            for name, value in values.iteritems():
+                if name in self.time_fields:
+                    self.values[name] = from_any_timestamp(value)
+                elif value is None:
+                    self.values[name] = '0'
+                else:
+                    self.values[name] = value
+        else:
+            self.values.update(values)
+
+        self.key = self.build_key_object()
+        self.resource = Resource(self.realm, self.gey_key_string())
+        self._old = {}
+
+        if exists:
+            self.post_fetch_object(db)
+
+        self.exists = exists
+
     def insert(self, when=None, db=None):
         """
         Add object to database.
@@ -533,8 +563,7 @@ class AbstractVariableFieldsObject(object):
 
         self.env.log.debug('  Calling listeners')
         from tracgenericclass.api import GenericClassSystem
-        for listener in GenericClassSystem(self.env).change_listeners:
-            listener.object_created(self.realm, self)
+        GenericClassSystem(self.env).object_created(self)
 
         self.env.log.debug('<<< insert')
         return self.key
@@ -621,8 +650,7 @@ class AbstractVariableFieldsObject(object):
         self.values['changetime'] = when
 
         from tracgenericclass.api import GenericClassSystem
-        for listener in GenericClassSystem(self.env).change_listeners:
-            listener.object_changed(self.realm, self, comment, author, old_values)
+        GenericClassSystem(self.env).object_changed(self, comment, author, old_values)
 
         self.env.log.debug('<<< save_changes')
         return True
@@ -674,8 +702,7 @@ class AbstractVariableFieldsObject(object):
             self.post_delete(db)
                 
         from tracgenericclass.api import GenericClassSystem
-        for listener in GenericClassSystem(self.env).change_listeners:
-            listener.object_deleted(self.realm, self)
+        GenericClassSystem(self.env).object_deleted(self)
         
         self.exists = False
         self.env.log.debug('<<< delete')
@@ -960,6 +987,10 @@ class AbstractWikiPageWrapper(AbstractVariableFieldsObject):
     The wiki page lifecycle is managed along with the normal object's
     one.     
     """
+    
+    # Whether deleting the object also deletes the Wiki page
+    del_wiki_page = True
+
     def __init__(self, env, realm='wiki_wrapper_obj', key=None, db=None):
         AbstractVariableFieldsObject.__init__(self, env, realm, key, db)
     
@@ -1029,6 +1060,274 @@ class AbstractWikiPageWrapper(AbstractVariableFieldsObject):
             yield result
 
 
+class UnitOfWork(object):
+    """
+    Collects the creation, modification and deletion of many objects,
+    to write them all at once, in a single transaction, with flush().
+    
+    The SQL statements are grouped per realm and table and executed
+    in batches. The change listeners receive all of the changes after
+    the commit, as with GenericClassSystem.with_deferred_listeners().
+    
+    The pre_ and post_ hooks are still called for each object. Since
+    the pre_insert hooks may depend on the objects inserted before, 
+    as for assigning an order, the base table row of each new object
+    is inserted right after its pre_insert hook.
+
+    Usage:
+        uow = UnitOfWork(env)
+        uow.register_new(obj1)
+        uow.register_dirty(obj2)
+        uow.register_deleted(obj3)
+        uow.flush(author, comment)
+    """
+    
+    CHUNK_SIZE = 500
+
+    def __init__(self, env):
+        self.env = env
+        self.new = []
+        self.dirty = []
+        self.deleted = []
+
+    def register_new(self, obj):
+        """Registers a new object, to be inserted."""
+        assert not obj.exists, 'Cannot insert an existing object'
+        
+        self.new.append(obj)
+
+    def register_dirty(self, obj):
+        """Registers a modified object, to save its changes."""
+        assert obj.exists, 'Cannot update a new object'
+        
+        if not [o for o in self.dirty if o is obj]:
+            self.dirty.append(obj)
+
+    def register_deleted(self, obj):
+        """Registers an object to be deleted."""
+        if not [o for o in self.deleted if o is obj]:
+            self.deleted.append(obj)
+
+    def flush(self, author=None, comment=None, when=None, db=None):
+        """
+        Writes all of the registered objects, in a single transaction.
+        The new objects are inserted first, then the changes are saved
+        and finally the objects are deleted.
+        
+        The `author`, `comment` and `when` arguments apply to all of 
+        the modified objects, as in save_changes().
+        """
+        self.env.log.debug('>>> flush')
+
+        if when is None:
+            when = datetime.now(utc)
+
+        new, dirty, deleted = self.new, self.dirty, self.deleted
+        self.new, self.dirty, self.deleted = [], [], []
+
+        from tracgenericclass.api import GenericClassSystem
+        gclass_system = GenericClassSystem(self.env)
+
+        @gclass_system.with_deferred_listeners(db)
+        def do_flush(db):
+            cursor = db.cursor()
+
+            inserted = self._flush_new(cursor, db, new, when)
+            saved = self._flush_dirty(cursor, db, dirty, author, comment, when)
+            removed = self._flush_deleted(cursor, db, deleted)
+
+            # Update the objects and queue the changes, only when all 
+            # the statements have been executed
+            for obj in inserted:
+                obj.exists = True
+                obj.resource = obj.resource(id=obj.get_resource_id())
+                obj._old = {}
+                gclass_system.object_created(obj)
+                
+            for obj in saved:
+                old_values = obj._old
+                obj._old = {}
+                obj.values['changetime'] = when
+                gclass_system.object_changed(obj, comment, author, old_values)
+
+            for obj in removed:
+                obj.exists = False
+                gclass_system.object_deleted(obj)
+
+        self.env.log.debug('<<< flush')
+
+    def _flush_new(self, cursor, db, objs, when):
+        inserted = []
+        custom_rows = {}
+        
+        for obj in objs:
+            if not obj.pre_insert(db):
+                self.env.log.debug('Not inserting object (pre_insert returned False)')
+                continue
+
+            obj.values['time'] = obj.values['changetime'] = when
+
+            values = dict(obj.values)
+            for field in obj.time_fields:
+                if field in values:
+                    values[field] = to_any_timestamp(values[field])
+
+            std_fields = [f['name'] for f in obj.fields if f['name'] in obj.values and not f.get('custom')]
+            cursor.execute("INSERT INTO %s (%s) VALUES (%s)"
+                           % (obj.realm,
+                              ','.join(std_fields),
+                              ','.join(['%s'] * len(std_fields))),
+                           [values[name] for name in std_fields])
+
+            key_values = obj.get_key_prop_values()
+            for f in obj.fields:
+                if f.get('custom') and f['name'] in obj.values:
+                    custom_rows.setdefault((obj.realm, tuple(obj.get_key_prop_names())), []).append(
+                        to_list((key_values, f['name'], obj[f['name']])))
+
+            inserted.append(obj)
+
+        for (realm, key_names), rows in custom_rows.iteritems():
+            cursor.executemany("INSERT INTO %s_custom (%s,name,value) VALUES (%s,%%s,%%s)"
+                % (realm, ','.join(key_names), ','.join(['%s'] * len(key_names))),
+                rows)
+
+        for obj in inserted:
+            obj.post_insert(db)
+
+        return inserted
+
+    def _flush_dirty(self, cursor, db, objs, author, comment, when):
+        when_ts = to_any_timestamp(when)
+
+        saved = []
+        for obj in objs:
+            if not obj._old and not comment:
+                # Not modified
+                continue
+                
+            if not obj.pre_save_changes(db):
+                self.env.log.debug('Not saving object changes (pre_save_changes returned False)')
+                continue
+                
+            saved.append(obj)
+
+        # Group the objects per realm, keeping their order
+        realms = []
+        objs_by_realm = {}
+        for obj in saved:
+            if obj.realm not in objs_by_realm:
+                realms.append(obj.realm)
+                objs_by_realm[obj.realm] = []
+                
+            objs_by_realm[obj.realm].append(obj)
+
+        for realm in realms:
+            realm_objs = objs_by_realm[realm]
+            
+            sample = realm_objs[0]
+            key_names = sample.get_key_prop_names()
+            custom_fields = [f['name'] for f in sample.fields if f.get('custom')]
+
+            sql_where = ' AND '.join([k + "=%s" for k in key_names])
+
+            existing_custom = self._get_existing_custom_values(cursor, realm, key_names, 
+                [obj for obj in realm_objs if [name for name in obj._old if name in custom_fields]])
+
+            std_updates = {}
+            custom_updates = []
+            custom_inserts = []
+            change_rows = []
+            
+            for obj in realm_objs:
+                key_values = obj.get_key_prop_values()
+                
+                for name in obj._old.keys():
+                    if name in custom_fields:
+                        if (tuple(key_values), name) in existing_custom:
+                            custom_updates.append(to_list((obj[name], name, key_values)))
+                        else:
+                            custom_inserts.append(to_list((key_values, name, obj[name])))
+                    else:
+                        std_updates.setdefault(name, []).append(to_list((obj[name], key_values)))
+                        
+                    if sample.metadata['has_change']:
+                        change_rows.append(to_list((key_values, when_ts, author, name, obj._old[name], obj[name])))
+
+            for name, rows in std_updates.iteritems():
+                cursor.executemany("UPDATE %s SET %s=%%s WHERE %s" % (realm, name, sql_where), rows)
+                
+            if len(custom_updates) > 0:
+                cursor.executemany("UPDATE %s_custom SET value=%%s WHERE name=%%s AND %s" % (realm, sql_where), 
+                    custom_updates)
+                    
+            if len(custom_inserts) > 0:
+                cursor.executemany("INSERT INTO %s_custom (%s,name,value) VALUES (%s,%%s,%%s)" 
+                    % (realm, ','.join(key_names), ','.join(['%s'] * len(key_names))), 
+                    custom_inserts)
+
+            if len(change_rows) > 0:
+                cursor.executemany("INSERT INTO %s_change (%s,time,author,field,oldvalue,newvalue) VALUES (%s,%%s,%%s,%%s,%%s,%%s)"
+                    % (realm, ','.join(key_names), ','.join(['%s'] * len(key_names))), 
+                    change_rows)
+
+        for obj in saved:
+            obj.post_save_changes(db)
+
+        return saved
+
+    def _get_existing_custom_values(self, cursor, realm, key_names, objs):
+        """
+        Returns the set of the (key values, name) of the custom values 
+        already stored for the specified objects.
+        """
+        result = set()
+
+        keys = set([tuple(obj.get_key_prop_values()) for obj in objs])
+        first_key_values = list(set([key[0] for key in keys]))
+        
+        for i in range(0, len(first_key_values), self.CHUNK_SIZE):
+            chunk = first_key_values[i:i+self.CHUNK_SIZE]
+            cursor.execute("SELECT %s,name FROM %s_custom WHERE %s IN (%s)" 
+                % (','.join(key_names), realm, key_names[0], ','.join(['%s'] * len(chunk))), 
+                chunk)
+            
+            for row in cursor:
+                key = tuple(row[:-1])
+                if key in keys:
+                    result.add((key, row[-1]))
+                    
+        return result
+
+    def _flush_deleted(self, cursor, db, objs):
+        removed = []
+        for obj in objs:
+            if not obj.pre_delete(db):
+                self.env.log.debug('Not deleting object (pre_delete returned False)')
+                continue
+                
+            removed.append(obj)
+
+        deletes = {}
+        for obj in removed:
+            tables = [obj.realm]
+            if obj.metadata['has_change']:
+                tables.append(obj.realm + '_change')
+            if obj.metadata['has_custom'] and [f for f in obj.fields if f.get('custom')]:
+                tables.append(obj.realm + '_custom')
+                
+            for table in tables:
+                deletes.setdefault((table, tuple(obj.get_key_prop_names())), []).append(obj.get_key_prop_values())
+
+        for (table, key_names), rows in deletes.iteritems():
+            cursor.executemany("DELETE FROM %s WHERE %s" % (table, ' AND '.join([k + "=%s" for k in key_names])), rows)
+            
+        for obj in removed:
+            obj.post_delete(db)
+
+        return removed
+
+
 class GenericClassModelProvider(Component):
     """
     This class provides a factory for generic classes and derivatives.
@@ -1384,6 +1683,7 @@ def create_db_for_realm(env, realm, realm_schema, db=None):
             cols.append(Column('oldvalue'))
             cols.append(Column('newvalue'))
             cols.append(Index(key_names))
+            cols.append(Index(['time']))
 
             change_key = copy.deepcopy(key_names)
             change_key.append('time')
@@ -205,6 +205,13 @@ def upload_file_to_subdir(env, req, subdir, param_name, target_filename):
         target_file.close()
 
 
+def db_escape_like(text, escape_char='|'):
+    """
+    Escapes the LIKE wildcards in the specified text, to be used in a
+    "LIKE %s ESCAPE '|'" clause.
+    """
+    return text.replace(escape_char, escape_char*2).replace('%', escape_char+'%').replace('_', escape_char+'_')
+
 def db_insert_or_ignore(env, tablename, propname, value, db=None):
     if db_get_config_property(env, tablename, propname, db) is None:
         db_set_config_property(env, tablename, propname, value, db)